@@ -1,13 +1,17 @@
 import argparse
 import os
+from functools import partial
 import torch
 import pandas as pd
 import numpy as np
 from sklearn.metrics import roc_auc_score, f1_score, precision_score, recall_score, accuracy_score
 from utils.utils import read_yaml
-from datasets.dataloader_factory import create_dataloader
+from datasets.loader_utils import apply_host_profile
+from datasets.dataloader_factory import create_dataloader, create_bag_dataset, create_bag_pool
 from training_methods.embedding_general import evaluation
 from models.CHIEF import CHIEF_biomaker
+from utils.bootstrap import bootstrap_ci, save_bootstrap_ci
+from cv_runner import run_folds, get_bag_pool
 
 def load_model(cfg):
     model = CHIEF_biomaker(n_classes=cfg.Data.n_classes, **cfg.Model)
@@ -16,30 +20,54 @@ def load_model(cfg):
     model.train()
     return model
 
+def eval_fold(i, cfg, result_dir, dataset_name):
+    # runs in a fold worker: bags come from the shared pool
+    model = load_model(cfg)
+    dataloader = create_dataloader(i, dataset_name, cfg, result_dir, bag_cache=get_bag_pool())
+    model.load_state_dict(
+        torch.load('./weights/IDH/s_'+str(i)+'_checkpoint.pt', map_location='cpu'))
+    evaluation(i, model, dataloader, result_dir, cfg)
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--config_path', type=str, default='./configs/colon.yaml')
 parser.add_argument('--dataset_name', type=str, default='test_set')
 parser.add_argument('--decimals', type=int, default=4)
+parser.add_argument('--n_bootstrap', type=int, default=1000, help='bootstrap resamples for AUC CIs (0 disables)')
+parser.add_argument('--n_jobs', type=int, default=1, help='processes for the bootstrap')
+parser.add_argument('--parallel_folds', type=int, default=0,
+                    help='evaluate folds in this many processes sharing one in-memory copy of the bags (0: serial)')
+parser.add_argument('--fold_threads', type=int, default=0, help='intra-op threads per fold process (0: cores / processes)')
 args = parser.parse_args()
 decimals = args.decimals
 
 if __name__ == '__main__':
 
+    apply_host_profile()
     cfg = read_yaml(args.config_path)
-    model = load_model(cfg)
     result_dir = os.path.join(cfg.General.result_dir,
                               'evaluation',args.dataset_name)
 
     os.makedirs(result_dir, exist_ok=True)
 
-    for i in range(cfg.General.fold_num):
-        dataloader = create_dataloader(i, args.dataset_name, cfg, result_dir)
-        model.load_state_dict(
-            torch.load('./weights/IDH/s_'+str(i)+'_checkpoint.pt'))
-        evaluation(i, model, dataloader, result_dir, cfg)
+    if args.parallel_folds > 0:
+        bag_pool = create_bag_pool(create_bag_dataset(cfg))
+        run_folds(partial(eval_fold, cfg=cfg, result_dir=result_dir, dataset_name=args.dataset_name),
+                  range(cfg.General.fold_num), bag_pool, n_workers=args.parallel_folds,
+                  n_threads=args.fold_threads or None)
+    else:
+        model = load_model(cfg)
+        # every fold evaluates the same cohort: preload it once and keep one
+        # loader (and its persistent workers) for all folds
+        bag_cache = create_bag_pool(create_bag_dataset(cfg)) if cfg.Data.preload else None
+        dataloader = create_dataloader(0, args.dataset_name, cfg, result_dir, bag_cache=bag_cache)
+        for i in range(cfg.General.fold_num):
+            model.load_state_dict(
+                torch.load('./weights/IDH/s_'+str(i)+'_checkpoint.pt'))
+            evaluation(i, model, dataloader, result_dir, cfg)
 
     result = {'auc': []}
     all_labels = []
+    ci_rows = []
     for i in range(cfg.General.fold_num):
         df = pd.read_csv(os.path.join(result_dir, f'preds_{i}.csv'))
         all_labels.append(df['label'].values)
@@ -47,6 +75,10 @@ if __name__ == '__main__':
         prob = df['prob_1'].values
         auc = np.around(roc_auc_score(label, prob), decimals=decimals)
         result['auc'].append(auc)
+        if args.n_bootstrap > 0:
+            ci = bootstrap_ci('auc', label, prob, n_resamples=args.n_bootstrap,
+                              seed=cfg.General.seed, n_jobs=args.n_jobs)
+            ci_rows.append({'fold': i, **ci})
 
 
     result['auc'].append(np.around(np.array(result['auc']).mean(), decimals=decimals).astype(str) + '+' + np.around(np.array(result['auc']).std(), decimals=decimals).astype(str))
@@ -54,6 +86,8 @@ if __name__ == '__main__':
     df = pd.DataFrame(result)
     print(result)
     df.to_csv(os.path.join(result_dir, 'metrics.csv'), index=False, encoding='gbk')
+    if ci_rows:
+        save_bootstrap_ci(ci_rows, result_dir, decimals=decimals)
 
 
 
@@ -0,0 +1,37 @@
+import argparse
+import os
+import torch
+from utils.utils import read_yaml, seed_torch, get_checkpoint_writer
+from datasets.loader_utils import apply_host_profile
+from datasets.dataloader_factory import create_split_dataloader
+from training_methods.sweep import create_sweep_groups, sweep_train_loop, sweep_evaluation, \
+    sweep_early_stopping, sweep_leaderboard
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', type=str, default='./configs/IDH_sweep.yaml')
+parser.add_argument('--decimals', type=int, default=4)
+args = parser.parse_args()
+
+if __name__ == '__main__':
+
+    apply_host_profile()
+    cfg = read_yaml(args.config_path)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    seed_torch(device, cfg.General.seed)
+    result_dir = os.path.join(cfg.General.result_dir, 'sweep')
+    os.makedirs(result_dir, exist_ok=True)
+
+    train_loader = create_split_dataloader(cfg.Data.train_csv, cfg, shuffle=True)
+    val_loader = create_split_dataloader(cfg.Data.val_csv, cfg)
+    groups = create_sweep_groups(cfg, device)
+
+    for epoch in range(cfg.Train.max_epochs):
+        sweep_train_loop(epoch, groups, train_loader, cfg)
+        results = sweep_evaluation(groups, val_loader, cfg)
+        best = max(results.items(), key=lambda item: item[1][0])
+        print(f'epoch {epoch}: {len(results)} replicas, best val auc {best[1][0]:.4f} (replica {best[0]})')
+        if not sweep_early_stopping(epoch, groups, results, result_dir, cfg):
+            break
+
+    get_checkpoint_writer().flush()
+    sweep_leaderboard(groups, result_dir, decimals=args.decimals)
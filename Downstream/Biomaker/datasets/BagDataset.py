@@ -1,31 +1,64 @@
-import os
-
 import h5py
 import torch
 import numpy as np
 import pandas as pd
 from torch.utils.data import Dataset
+from datasets.manifest import BagManifest
+from datasets.hdf5_bags import bag_shape, load_bag, HDF5BagReader
+
+
+class SharedBagPool:
+    """Every bag of a cohort in one contiguous shared-memory buffer.
+
+    Bags are loaded once in the parent process; worker processes receive the
+    pool through torch.multiprocessing and read zero-copy views via `get`, the
+    same interface as `BagCache`.
+    """
+    def __init__(self, paths):
+        self.paths = list(dict.fromkeys(paths))
+        self.index = {path: i for i, path in enumerate(self.paths)}
+        # sizes first, then one bag at a time: peak memory is the buffer plus one bag
+        shapes = [bag_shape(path) for path in self.paths]
+        self.offsets = np.cumsum([0] + [shape[0] for shape, _ in shapes]).tolist()
+        if not shapes:
+            self.buffer = torch.empty(0).share_memory_()
+            return
+        row_shape, dtype = shapes[0][0][1:], shapes[0][1]
+        self.buffer = torch.empty((int(self.offsets[-1]),) + row_shape, dtype=dtype).share_memory_()
+        for i, path in enumerate(self.paths):
+            self.buffer[self.offsets[i]:self.offsets[i + 1]].copy_(load_bag(path))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def get(self, path):
+        i = self.index[path]
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]]
 
 
 class BagDataset(Dataset):
-    def __init__(self, df, data_dir, label_field='label', **kwargs):
+    def __init__(self, df, data_dir, label_field='label', bag_cache=None, feature_suffix='.pt', **kwargs):
         super(BagDataset, self).__init__()
 
         self.data_dir = data_dir
         self.df = df
         self.label_field = label_field
+        self.bag_cache = bag_cache
+        self.manifest = BagManifest.from_dir(df['case_id'], data_dir, labels=df[label_field], suffix=feature_suffix)
     def __len__(self):
-        return len(self.df.values)
+        return len(self.manifest)
 
     def __getitem__(self, idx):
-        label = self.df[self.label_field].values[idx]
+        label = self.manifest.labels[idx]
 
-        slide_id = str(self.df['case_id'].values[idx])
-
-
-        full_path = os.path.join(self.data_dir, slide_id + '.pt')
-
-        features = torch.load(full_path, map_location=torch.device('cpu'))
+        full_path = self.manifest.paths[idx]
+        if self.bag_cache is not None:
+            features = self.bag_cache.get(full_path)
+        else:
+            features = load_bag(full_path)
 
         res = {
             'x': features,
@@ -35,6 +68,16 @@ class BagDataset(Dataset):
 
         return res
 
+    def get_feature_path(self, idx):
+        return self.manifest.paths[idx]
+
+    def get_region(self, idx, x0, y0, x1, y1, level=0):
+        """Features and (x, y, level) coordinates of the patches of bag `idx`
+        inside a bounding box, read through the bag's spatial index (.h5 only)."""
+        with HDF5BagReader(self.manifest.paths[idx]) as reader:
+            rows, features, coords = reader.read_region(x0, y0, x1, y1, level)
+        return features, coords
+
     def get_balance_weight(self):
         # for data balance
         label = self.df['label'].values
@@ -1,20 +1,46 @@
+import os
 import pandas as pd
-from torch.utils.data import DataLoader, WeightedRandomSampler
+from torch.utils.data import WeightedRandomSampler
+from datasets.loader_utils import build_dataloader, loader_options
 
-def create_dataloader(index, dataset, cfg, result_dir):
+def create_dataloader(index, dataset, cfg, result_dir, bag_cache=None):
 
-    return create_bag_dataloader(index, dataset, cfg, result_dir)
+    return create_bag_dataloader(index, dataset, cfg, result_dir, bag_cache)
 
 
-def create_bag_dataloader(index, dataset_name, cfg, result_dir):
-    df = pd.read_csv(cfg.Data.external_dir)
+def create_bag_dataset(cfg, bag_cache=None, csv_path=None):
+    df = pd.read_csv(csv_path or cfg.Data.external_dir)
 
     df.rename(columns={'slide_id': 'case_id'}, inplace=True)
     df.rename(columns={'image_id': 'case_id'}, inplace=True)
 
     from datasets.BagDataset import BagDataset
-    dataset = BagDataset(df, **cfg.Data)
-    dataloader = DataLoader(dataset, batch_size=None, shuffle=False,
-                                num_workers=cfg.Train.num_worker)
+    return BagDataset(df, bag_cache=bag_cache, **cfg.Data)
+
+
+def create_bag_pool(dataset):
+    """Every bag of `dataset` loaded once into one SharedBagPool."""
+    from datasets.BagDataset import SharedBagPool
+    return SharedBagPool([dataset.get_feature_path(i) for i in range(len(dataset))])
+
+
+def create_bag_dataloader(index, dataset_name, cfg, result_dir, bag_cache=None):
+    dataset = create_bag_dataset(cfg, bag_cache)
+    # bags held in memory are only copied by worker processes
+    num_workers = 0 if bag_cache is not None else cfg.Train.num_worker
+    dataloader = build_dataloader(dataset, shuffle=False, name=dataset_name,
+                                  **loader_options(cfg, num_workers=num_workers))
+
+    return dataloader
+
+
+def create_split_dataloader(csv_path, cfg, shuffle=False):
+    dataset = create_bag_dataset(cfg, csv_path=csv_path)
+    num_workers = cfg.Train.num_worker
+    if cfg.Data.preload:
+        dataset.bag_cache = create_bag_pool(dataset)
+        num_workers = 0
+    dataloader = build_dataloader(dataset, shuffle=shuffle, name=os.path.basename(csv_path),
+                                  **loader_options(cfg, num_workers=num_workers))
 
     return dataloader
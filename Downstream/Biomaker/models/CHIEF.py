@@ -1,6 +1,9 @@
+import functools
+import inspect
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from utils.utils import initialize_weights
 import numpy as np
 # from utils.loss import loss_fg,loss_bg,SupConLoss
@@ -76,12 +79,55 @@ class Attn_Net_Gated(nn.Module):
 #     subfolder="text_encoder")
 
 
+# torch < 1.11 has no use_reentrant keyword: only the reentrant checkpoint
+REENTRANT_CHECKPOINT_ONLY = 'use_reentrant' not in inspect.signature(checkpoint).parameters
+
+
+def _pool_chunk(attention_net, h):
+    A, h = attention_net(h)  # n x 1, n x D
+    A = A.float()
+    m = A.max()
+    S = torch.mm(torch.exp(A - m.detach()).t(), h)  # 1 x D, softmax numerator of the chunk
+    return A, S, m
+
+
+def _checkpoint_chunk(attention_net, h_chunk):
+    if not torch.is_grad_enabled():
+        return _pool_chunk(attention_net, h_chunk)
+    if not REENTRANT_CHECKPOINT_ONLY:
+        return checkpoint(_pool_chunk, attention_net, h_chunk, use_reentrant=False)
+    # the reentrant checkpoint takes tensor inputs only, and the weights of
+    # attention_net get gradients only if one of them requires grad
+    if not h_chunk.requires_grad:
+        h_chunk = h_chunk.detach().requires_grad_()
+    return checkpoint(functools.partial(_pool_chunk, attention_net), h_chunk)
+
+def checkpointed_attention_pool(attention_net, h, chunk_size):
+    """Attention pooling over a bag in chunks of `chunk_size` patches with
+    activation checkpointing: only the attention logits (N x 1) and one pooled
+    sum per chunk are kept for backward; the chunk activations are recomputed.
+    Chunk sums are combined with a log-sum-exp rescaling, so the result and the
+    gradients equal those of the unchunked softmax pooling.
+    Returns A_raw (1 x N) and M (1 x D)."""
+    A_list, S_list, m_list = [], [], []
+    for h_chunk in torch.split(h, chunk_size, dim=0):
+        A, S, m = _checkpoint_chunk(attention_net, h_chunk)
+        A_list.append(A)
+        S_list.append(S)
+        m_list.append(m.detach())
+    m_chunks = torch.stack(m_list)
+    m = m_chunks.max()
+    A_raw = torch.cat(A_list, dim=0)
+    Z = torch.exp(A_raw - m).sum()
+    M = (torch.exp(m_chunks - m)[:, None] * torch.cat(S_list, dim=0)).sum(dim=0, keepdim=True) / Z
+    return torch.transpose(A_raw, 1, 0), M
+
 
 
 
 class CHIEF_biomaker(nn.Module):
     def __init__(self, gate=True, size_arg="large", dropout=True, n_classes=2,
-                 instance_loss_fn=nn.CrossEntropyLoss(),**kwargs):
+                 instance_loss_fn=nn.CrossEntropyLoss(), chunk_size=None, **kwargs):
         super(CHIEF_biomaker, self).__init__()
         self.size_dict = {'xs': [384, 256, 256], "small": [768, 512, 256], "big": [1024, 512, 384], 'large': [2048, 1024, 512]}
         size = self.size_dict[size_arg]
@@ -100,6 +146,7 @@ class CHIEF_biomaker(nn.Module):
         self.instance_classifiers = nn.ModuleList(instance_classifiers)
         self.instance_loss_fn = instance_loss_fn
         self.n_classes = n_classes
+        self.chunk_size = chunk_size
         initialize_weights(self)
 
         # self.att_head = Att_Head(size[1],size[2])
@@ -118,12 +165,16 @@ class CHIEF_biomaker(nn.Module):
 
     def forward(self, h):
 
-        A, h = self.attention_net(h)
-        A = torch.transpose(A, 1, 0)
-        A_raw = A
-        A = F.softmax(A, dim=1)
+        if self.chunk_size and h.shape[0] > self.chunk_size:
+            # huge bags: bounded activation memory, same result
+            A_raw, M = checkpointed_attention_pool(self.attention_net, h, self.chunk_size)
+        else:
+            A, h = self.attention_net(h)
+            A = torch.transpose(A, 1, 0)
+            A_raw = A
+            A = F.softmax(A.float(), dim=1)
 
-        M = torch.mm(A, h)  # A: 1 * N h: N * 512 => M: 1 * 512
+            M = torch.mm(A, h)  # A: 1 * N h: N * 512 => M: 1 * 512
 
 
         # M = torch.cat([M, embed_batch], axis=1)
@@ -143,16 +194,16 @@ class CHIEF_biomaker(nn.Module):
         A, h = self.attention_net(h)
         A_raw = A
         A = torch.transpose(A, 1, 0)
-        A = F.softmax(A, dim=1)
+        A = F.softmax(A.float(), dim=1)
 
         embed_batch = self.organ_embedding[batch]
         embed_batch=self.text_to_vision(embed_batch)
         M = torch.mm(A, h)
         M = M+embed_batch
         bag_logits = self.classifiers(M)
-        bag_prob = torch.softmax(bag_logits.squeeze(), dim=0)
+        bag_prob = torch.softmax(bag_logits.squeeze().float(), dim=0)
         patch_logits = self.classifiers(h+embed_batch)
-        patch_prob = torch.sigmoid(A_raw.squeeze()) * torch.softmax(patch_logits, dim=1)[:, 1]
+        patch_prob = torch.sigmoid(A_raw.squeeze()) * torch.softmax(patch_logits.float(), dim=1)[:, 1]
 
         return{
             'bag_prob': bag_prob,
@@ -160,3 +211,61 @@ class CHIEF_biomaker(nn.Module):
             'attention_raw': A_raw.squeeze()
         }
 
+
+
+class CHIEF_biomaker_sweep(nn.Module):
+    """K gated CHIEF_biomaker heads with the same size_arg trained side by side.
+
+    Each replica is a regular CHIEF_biomaker (so its state_dict loads into the
+    evaluation model) with its own dropout rate. The forward pass stacks the
+    weights of the `active` replicas and runs them as batched GEMMs over one
+    bag: K x N x D activations instead of K separate small matmuls.
+    """
+    def __init__(self, dropouts, size_arg="small", n_classes=2, **kwargs):
+        super(CHIEF_biomaker_sweep, self).__init__()
+        self.dropouts = list(dropouts)
+        # dropout=True for every rate so all replicas share the eval model's layout;
+        # _dropout applies each replica's own rate
+        self.replicas = nn.ModuleList([CHIEF_biomaker(gate=True, size_arg=size_arg, dropout=True, n_classes=n_classes)
+                                       for _ in self.dropouts])
+        self.n_classes = n_classes
+
+    def _stack(self, active, get):
+        return torch.stack([get(self.replicas[k]) for k in active])
+
+    def _dropout(self, x, keep):
+        if not self.training:
+            return x
+        # per-replica rate: keep is K x 1 x 1
+        return x * (torch.rand_like(x) < keep).to(x.dtype) / keep
+
+    def forward(self, h, active=None):
+        active = list(range(len(self.replicas))) if active is None else list(active)
+        K = len(active)
+        keep = torch.tensor([1 - self.dropouts[k] for k in active], device=h.device, dtype=h.dtype).view(K, 1, 1)
+        fc = lambda r: r.attention_net[0]
+        att = lambda r: r.attention_net[-1]
+
+        # the first layer is shared input: one N x (K * D) GEMM
+        W1 = self._stack(active, lambda r: fc(r).weight)  # K x D x L
+        b1 = self._stack(active, lambda r: fc(r).bias)
+        h1 = torch.mm(h, W1.reshape(-1, W1.shape[-1]).t()).view(h.shape[0], K, -1).transpose(0, 1)
+        h1 = self._dropout(F.relu(h1 + b1[:, None]), keep)  # K x N x D
+
+        a = torch.baddbmm(self._stack(active, lambda r: att(r).attention_a[0].bias)[:, None], h1,
+                          self._stack(active, lambda r: att(r).attention_a[0].weight).transpose(1, 2))
+        b = torch.baddbmm(self._stack(active, lambda r: att(r).attention_b[0].bias)[:, None], h1,
+                          self._stack(active, lambda r: att(r).attention_b[0].weight).transpose(1, 2))
+        A = self._dropout(torch.tanh(a), keep) * self._dropout(torch.sigmoid(b), keep)
+        A = torch.baddbmm(self._stack(active, lambda r: att(r).attention_c.bias)[:, None], A,
+                          self._stack(active, lambda r: att(r).attention_c.weight).transpose(1, 2))  # K x N x 1
+        A_raw = A.transpose(1, 2)
+        A = F.softmax(A_raw.float(), dim=2).to(h1.dtype)
+        M = torch.bmm(A, h1)  # K x 1 x D
+
+        logits = torch.baddbmm(self._stack(active, lambda r: r.classifiers.bias)[:, None], M,
+                               self._stack(active, lambda r: r.classifiers.weight).transpose(1, 2))
+        return {
+            'bag_logits': logits.squeeze(1),  # K x n_classes
+            'attention_raw': A_raw.squeeze(1)
+        }
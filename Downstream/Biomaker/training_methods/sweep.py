@@ -0,0 +1,142 @@
+import os
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from sklearn.metrics import roc_auc_score
+from models.CHIEF import CHIEF_biomaker_sweep
+from utils.utils import autocast_context, get_checkpoint_writer
+
+
+def create_sweep_groups(cfg, device):
+    """One CHIEF_biomaker_sweep per size_arg of cfg.Sweep, holding a replica for
+    every (lr, reg, dropout) combination. Each replica is its own Adam param
+    group, so it keeps its own learning rate, weight decay and moment state."""
+    groups = []
+    replica_id = 0
+    for size_arg in cfg.Sweep.size_arg:
+        settings = []
+        for lr, reg, dropout in product(cfg.Sweep.lr, cfg.Sweep.reg, cfg.Sweep.dropout):
+            settings.append({'replica': replica_id, 'size_arg': size_arg, 'lr': lr, 'reg': reg, 'dropout': dropout})
+            replica_id += 1
+        model = CHIEF_biomaker_sweep([s['dropout'] for s in settings], size_arg=size_arg,
+                                     n_classes=cfg.Data.n_classes).to(device)
+        optimizer = torch.optim.Adam([{'params': r.parameters(), 'lr': s['lr'], 'weight_decay': s['reg']}
+                                      for r, s in zip(model.replicas, settings)])
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, **cfg.Train.CosineAnnealingLR)
+        K = len(settings)
+        groups.append({
+            'settings': settings,
+            'model': model,
+            'optimizer': optimizer,
+            'scheduler': scheduler,
+            'active': np.ones(K, dtype=bool),
+            'best_auc': np.full(K, -np.inf),
+            'best_epoch': np.zeros(K, dtype=int),
+            'counter': np.zeros(K, dtype=int),
+            'last_epoch': np.zeros(K, dtype=int),
+        })
+    return groups
+
+
+def sweep_train_loop(epoch, groups, loader, cfg):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    precision = cfg.General.precision or 'fp32'
+    for group in groups:
+        group['model'].train()
+    with tqdm(total=len(loader), desc='sweep epoch: {}'.format(epoch)) as bar:
+        for batch in loader:
+            # the bag is read once and shared by every replica
+            x, y = batch['x'].to(device, dtype=torch.float32), batch['y'].to(device, dtype=torch.long)
+            for group in groups:
+                active = np.flatnonzero(group['active'])
+                if len(active) == 0:
+                    continue
+                with autocast_context(precision, device):
+                    logits = group['model'](x, active)['bag_logits']
+                # summed, so every replica gets the gradient of its own run
+                loss = F.cross_entropy(logits.float(), y.repeat(len(active)), reduction='sum')
+                # stopped replicas keep grad None and are skipped by Adam
+                group['optimizer'].zero_grad(set_to_none=True)
+                loss.backward()
+                group['optimizer'].step()
+            bar.update(1)
+    for group in groups:
+        group['scheduler'].step()
+
+
+def sweep_evaluation(groups, loader, cfg):
+    """Validation AUC and loss of every active replica: {replica: (auc, loss)}."""
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    precision = cfg.General.precision or 'fp32'
+    logits = {id(group): [] for group in groups}
+    labels = []
+    with torch.no_grad():
+        for group in groups:
+            group['model'].eval()
+        for batch in loader:
+            x, y = batch['x'].to(device, dtype=torch.float32), batch['y'].to(device, dtype=torch.long)
+            labels.append(y)
+            for group in groups:
+                active = np.flatnonzero(group['active'])
+                if len(active) == 0:
+                    continue
+                with autocast_context(precision, device):
+                    logits[id(group)].append(group['model'](x, active)['bag_logits'].float())
+
+    labels = torch.cat(labels)
+    results = {}
+    for group in groups:
+        if not logits[id(group)]:
+            continue
+        group_logits = torch.stack(logits[id(group)], dim=1)  # K x n_samples x n_classes
+        for j, k in enumerate(np.flatnonzero(group['active'])):
+            loss = F.cross_entropy(group_logits[j], labels).item()
+            probs = torch.softmax(group_logits[j], dim=-1).cpu().numpy()
+            if cfg.Data.n_classes == 2:
+                auc = roc_auc_score(labels.cpu().numpy(), probs[:, 1])
+            else:
+                auc = roc_auc_score(labels.cpu().numpy(), probs, multi_class='ovo')
+            results[group['settings'][k]['replica']] = (auc, loss)
+    return results
+
+
+def sweep_early_stopping(epoch, groups, results, result_dir, cfg):
+    """Per-replica early stopping on the validation AUC; the best weights of
+    each replica are saved as sweep_{replica}_checkpoint.pt."""
+    patience = cfg.Train.Early_stopping.patient
+    stop_epoch = cfg.Train.Early_stopping.stop_epoch
+    writer = get_checkpoint_writer()
+    for group in groups:
+        for k in np.flatnonzero(group['active']):
+            replica = group['settings'][k]['replica']
+            auc = results[replica][0]
+            group['last_epoch'][k] = epoch
+            if auc > group['best_auc'][k]:
+                group['best_auc'][k] = auc
+                group['best_epoch'][k] = epoch
+                group['counter'][k] = 0
+                writer.save(group['model'].replicas[k].state_dict(),
+                            os.path.join(result_dir, f'sweep_{replica}_checkpoint.pt'))
+            else:
+                group['counter'][k] += 1
+                if group['counter'][k] >= patience and epoch > stop_epoch:
+                    group['active'][k] = False
+    return any(group['active'].any() for group in groups)
+
+
+def sweep_leaderboard(groups, result_dir, decimals=4):
+    rows = []
+    for group in groups:
+        for k, setting in enumerate(group['settings']):
+            rows.append({**setting,
+                         'best_auc': np.around(group['best_auc'][k], decimals=decimals),
+                         'best_epoch': group['best_epoch'][k],
+                         'last_epoch': group['last_epoch'][k]})
+    df = pd.DataFrame(rows).sort_values('best_auc', ascending=False, kind='mergesort')
+    df.to_csv(os.path.join(result_dir, 'leaderboard.csv'), index=False)
+    print(df.to_string(index=False))
+    return df
@@ -5,7 +5,11 @@ import pandas as pd
 import numpy as np
 from sklearn.metrics import roc_auc_score, f1_score, precision_score, recall_score, accuracy_score
 from utils.utils import read_yaml
-from datasets.dataloader_factory import create_dataloader
+from datasets.loader_utils import apply_host_profile
+from collections import Counter
+from datasets.dataloader_factory import create_dataloader, read_cohort
+from datasets.BagDataset import BagCache
+from datasets.manifest import resolve_paths
 from training_methods.embedding_general import evaluation
 from models.CHIEF import CHIEF
 
@@ -16,47 +20,72 @@ def load_model(cfg):
     model.train()
     return model
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--config_path', type=str, default='./configs/colon.yaml')
-parser.add_argument('--dataset_name', type=str, default='test_set')
-parser.add_argument('--decimals', type=int, default=4)
-args = parser.parse_args()
-decimals = args.decimals
+def shared_paths(cfgs):
+    """Feature files listed by more than one config; only these are kept in
+    the shared bag cache."""
+    counts = Counter()
+    for cfg in cfgs:
+        df = read_cohort(cfg)
+        counts.update(set(resolve_paths(df['case_id'], cfg.Data.data_dir, cfg.Data.get('feature_suffix', '.pt'))))
+    return [path for path, n in counts.items() if n > 1]
 
-if __name__ == '__main__':
 
-    cfg = read_yaml(args.config_path)
-    model = load_model(cfg)
+def evaluate_dataset(i, model, cfg, dataset_name, bag_cache=None):
     result_dir = os.path.join(cfg.General.result_dir,
-                              'evaluation',args.dataset_name)
+                              'evaluation', dataset_name)
 
     os.makedirs(result_dir, exist_ok=True)
 
-    i=0
-
-
-    dataloader = create_dataloader(i, args.dataset_name, cfg, result_dir)
-    model.load_state_dict(
-        torch.load('../../model_weight/CHIEF_pretraining.pth'))
+    dataloader = create_dataloader(i, dataset_name, cfg, result_dir, bag_cache)
     evaluation(i, model, dataloader, result_dir, cfg)
 
     result = {'auc': []}
-    all_labels = []
     df = pd.read_csv(os.path.join(result_dir, f'preds_{i}.csv'))
-    all_labels.append(df['label'].values)
     label = df['label'].values
     prob = df['prob_1'].values
     auc = np.around(roc_auc_score(label, prob), decimals=decimals)
     result['auc'].append(auc)
 
     df = pd.DataFrame(result)
-    print(result)
+    print(dataset_name, result)
     df.to_csv(os.path.join(result_dir, 'metrics.csv'), index=False, encoding='gbk')
+    return auc
 
 
+parser = argparse.ArgumentParser()
+# several configs (one dataset name each) are evaluated in one run with the
+# model loaded once and bags shared between cohorts
+parser.add_argument('--config_path', type=str, nargs='+', default=['./configs/colon.yaml'])
+parser.add_argument('--dataset_name', type=str, nargs='+', default=['test_set'])
+parser.add_argument('--decimals', type=int, default=4)
+args = parser.parse_args()
+decimals = args.decimals
 
+if __name__ == '__main__':
 
+    apply_host_profile()
+    if len(args.config_path) != len(args.dataset_name):
+        raise ValueError('got {} configs but {} dataset names'.format(len(args.config_path), len(args.dataset_name)))
+    cfgs = [read_yaml(path) for path in args.config_path]
+    for path, cfg in zip(args.config_path[1:], cfgs[1:]):
+        if cfg.Model != cfgs[0].Model or cfg.Data.n_classes != cfgs[0].Data.n_classes:
+            raise ValueError('{} needs a different model than {}'.format(path, args.config_path[0]))
 
+    model = load_model(cfgs[0])
+    model.load_state_dict(
+        torch.load('../../model_weight/CHIEF_pretraining.pth'))
 
+    bag_cache = None
+    if len(cfgs) > 1:
+        keep = shared_paths(cfgs)
+        if len(keep) > 0:
+            bag_cache = BagCache(keep)
 
+    i=0
+    summary = {'dataset': [], 'auc': []}
+    for cfg, dataset_name in zip(cfgs, args.dataset_name):
+        summary['dataset'].append(dataset_name)
+        summary['auc'].append(evaluate_dataset(i, model, cfg, dataset_name, bag_cache))
 
+    if len(cfgs) > 1:
+        print(pd.DataFrame(summary).to_string(index=False))
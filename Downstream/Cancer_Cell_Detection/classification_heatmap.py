@@ -0,0 +1,75 @@
+import argparse
+import os
+import torch
+import pandas as pd
+from tqdm import tqdm
+from utils.utils import read_yaml, autocast_context
+from datasets.loader_utils import apply_host_profile
+from utils.heatmap import HeatmapExporter
+from datasets.BagDataset import BagDataset
+from datasets.hdf5_bags import HDF5BagReader
+from models.CHIEF import CHIEF
+
+def load_model(cfg):
+    model = CHIEF(n_classes=cfg.Data.n_classes, **cfg.Model)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.load_state_dict(torch.load('../../model_weight/CHIEF_pretraining.pth', map_location=device))
+    model.to(device)
+    model.eval()
+    return model
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', type=str, default='./configs/colon.yaml')
+parser.add_argument('--dataset_name', type=str, default='test_set')
+parser.add_argument('--topk', type=int, default=0, help='also write the k highest patch_prob patches per slide (0 disables)')
+parser.add_argument('--topk_only', action='store_true',
+                    help='write only the top-k patches, scored with early stopping (no heatmap)')
+args = parser.parse_args()
+
+
+def topk_of(patch_prob, k, coords):
+    """patch_topk's output from the patch_prob of every patch."""
+    prob, ids = torch.topk(patch_prob.float().reshape(-1), min(k, len(coords)))
+    return {'topk_prob': prob, 'topk_index': ids, 'topk_coords': coords[ids.cpu().numpy()]}
+
+
+def write_topk(path, evidence):
+    pd.DataFrame({'patch': evidence['topk_index'].cpu().numpy(),
+                  'x': evidence['topk_coords'][:, 0], 'y': evidence['topk_coords'][:, 1],
+                  'level': evidence['topk_coords'][:, 2],
+                  'patch_prob': evidence['topk_prob'].cpu().numpy()}).to_csv(path, index=False)
+
+
+if __name__ == '__main__':
+
+    apply_host_profile()
+    if args.topk_only and args.topk <= 0:
+        raise ValueError('--topk_only needs --topk > 0')
+    cfg = read_yaml(args.config_path)
+    model = load_model(cfg)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    result_dir = os.path.join(cfg.General.result_dir, 'heatmap', args.dataset_name)
+
+    df = pd.read_csv(cfg.Data.external_dir)
+    df.rename(columns={'slide_id': 'case_id'}, inplace=True)
+    df.rename(columns={'image_id': 'case_id'}, inplace=True)
+    # heatmaps need patch coordinates: bags written by HDF5BagWriter(with_coords=True)
+    dataset = BagDataset(df, **{**cfg.Data, 'feature_suffix': '.h5'})
+    anatomic = torch.tensor([cfg.Data.anatomic], device=device)
+
+    with HeatmapExporter(result_dir, **cfg.Heatmap) as exporter:
+        with torch.no_grad():
+            for idx in tqdm(range(len(dataset))):
+                with HDF5BagReader(dataset.get_feature_path(idx)) as reader:
+                    features, coords = reader.read(), reader.read_coords()
+                with autocast_context(cfg.General.precision or 'fp32', device):
+                    if args.topk_only:
+                        # without a heatmap only the top-k patches need classifying
+                        evidence = model.patch_topk(features.to(device), anatomic, k=args.topk, coords=coords)
+                    else:
+                        result = model.patch_probs(features.to(device), anatomic)
+                        evidence = topk_of(result['patch_prob'], args.topk, coords) if args.topk > 0 else None
+                if not args.topk_only:
+                    exporter.submit(dataset.manifest.ids[idx], coords, result['patch_prob'].float().cpu().numpy())
+                if evidence is not None:
+                    write_topk(os.path.join(result_dir, dataset.manifest.ids[idx] + '_topk.csv'), evidence)
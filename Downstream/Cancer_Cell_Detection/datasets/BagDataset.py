@@ -1,42 +1,106 @@
-import os
-
+import functools
 import h5py
 import torch
 import numpy as np
 import pandas as pd
 from torch.utils.data import Dataset
+from datasets.manifest import BagManifest
+from datasets.hdf5_bags import load_bag, HDF5BagReader
+from utils.utils import read_yaml
+
+ANATOMIC_MAPPING = '../../configs/anatomic_mapping.yaml'
+
+
+@functools.lru_cache()
+def anatomic_sites(mapping_path=ANATOMIC_MAPPING):
+    """organ -> index of CHIEF's anatomic text embedding."""
+    return {site.lower(): int(i) for site, i in read_yaml(mapping_path).Anatomic.items()}
+
+
+def anatomic_ids(df, anatomic=None, mapping_path=ANATOMIC_MAPPING):
+    """Per-slide anatomic index: the csv's `anatomic` column (index or organ
+    name from `mapping_path`) where present, else the config's `anatomic`."""
+    if 'anatomic' not in df.columns:
+        if anatomic is None:
+            raise ValueError('no anatomic column in the csv and no Data.anatomic in the config')
+        return np.full(len(df), anatomic, dtype=np.int64)
+    column = df['anatomic']
+    if column.map(lambda site: isinstance(site, str)).any():
+        sites = anatomic_sites(mapping_path)
+        column = column.map(lambda site: sites.get(site.strip().lower(), site) if isinstance(site, str) else site)
+    if anatomic is not None:
+        column = column.fillna(anatomic)
+    if column.isna().any():
+        raise ValueError('{} slides have no anatomic site'.format(column.isna().sum()))
+    return pd.to_numeric(column).astype(np.int64).values
+
+
+class BagCache:
+    """In-memory store of bag features keyed by file path, shared by the
+    datasets of a multi-config run so a slide listed in several cohorts is read
+    once. With `keep`, only those paths are held; the rest are read through."""
+    def __init__(self, keep=None):
+        self.keep = None if keep is None else set(keep)
+        self.bags = {}
+
+    def __len__(self):
+        return len(self.bags)
+
+    def __contains__(self, path):
+        return path in self.bags
+
+    def get(self, path):
+        if path in self.bags:
+            return self.bags[path]
+        bag = load_bag(path)
+        if self.keep is None or path in self.keep:
+            self.bags[path] = bag
+        return bag
 
 
 class BagDataset(Dataset):
-    def __init__(self, df, data_dir,anatomic, label_field='label', **kwargs):
+    def __init__(self, df, data_dir,anatomic=None, label_field='label', feature_suffix='.pt', bag_cache=None, **kwargs):
         super(BagDataset, self).__init__()
 
         self.data_dir = data_dir
         self.df = df
         self.label_field = label_field
         self.anatomic = anatomic
+        self.bag_cache = bag_cache
+        self.anatomics = anatomic_ids(df, anatomic)
+        self.manifest = BagManifest.from_dir(df['case_id'], data_dir, labels=df[label_field], suffix=feature_suffix)
     def __len__(self):
-        return len(self.df.values)
+        return len(self.manifest)
 
     def __getitem__(self, idx):
-        label = self.df[self.label_field].values[idx]
+        label = self.manifest.labels[idx]
 
-        slide_id = str(self.df['case_id'].values[idx])
+        full_path = self.manifest.paths[idx]
 
-
-        full_path = os.path.join(self.data_dir, slide_id + '.pt')
-
-        features = torch.load(full_path, map_location=torch.device('cpu'))
+        if self.bag_cache is not None:
+            features = self.bag_cache.get(full_path)
+        else:
+            features = load_bag(full_path)
 
         res = {
             'x': features,
             'y': torch.tensor([label]),
-            'z': torch.tensor([self.anatomic])
+            'z': torch.tensor([self.anatomics[idx]])
         }
 
 
         return res
 
+    def get_feature_path(self, idx):
+        return self.manifest.paths[idx]
+
+    def get_region(self, idx, x0, y0, x1, y1, level=0):
+        """Features and (x, y, level) coordinates of the patches of bag `idx`
+        inside a bounding box, read through the bag's spatial index (.h5 only)."""
+        with HDF5BagReader(self.manifest.paths[idx]) as reader:
+            rows, features, coords = reader.read_region(x0, y0, x1, y1, level)
+        return features, coords
+
     def get_balance_weight(self):
         # for data balance
         label = self.df['label'].values
@@ -1,20 +1,27 @@
 import pandas as pd
-from torch.utils.data import DataLoader, WeightedRandomSampler
+from torch.utils.data import WeightedRandomSampler
+from datasets.loader_utils import build_dataloader, loader_options
 
-def create_dataloader(index, dataset, cfg, result_dir):
+def create_dataloader(index, dataset, cfg, result_dir, bag_cache=None):
 
-    return create_bag_dataloader(index, dataset, cfg, result_dir)
+    return create_bag_dataloader(index, dataset, cfg, result_dir, bag_cache)
 
 
-def create_bag_dataloader(index, dataset_name, cfg, result_dir):
+def read_cohort(cfg):
     df = pd.read_csv(cfg.Data.external_dir)
 
     df.rename(columns={'slide_id': 'case_id'}, inplace=True)
     df.rename(columns={'image_id': 'case_id'}, inplace=True)
+    return df
+
+
+def create_bag_dataloader(index, dataset_name, cfg, result_dir, bag_cache=None):
+    df = read_cohort(cfg)
 
     from datasets.BagDataset import BagDataset
-    dataset = BagDataset(df, **cfg.Data)
-    dataloader = DataLoader(dataset, batch_size=None, shuffle=False,
-                                num_workers=cfg.Train.num_worker)
+    dataset = BagDataset(df, bag_cache=bag_cache, **cfg.Data)
+    # a shared cache lives in this process, so it is read without workers
+    num_workers = 0 if bag_cache is not None else None
+    dataloader = build_dataloader(dataset, shuffle=False, name=dataset_name, **loader_options(cfg, num_workers))
 
     return dataloader
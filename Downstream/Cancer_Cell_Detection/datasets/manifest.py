@@ -0,0 +1,68 @@
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def resolve_paths(ids, data_dir, suffix='.pt'):
+    """data_dir/<id><suffix> for a whole column at once; ids that already end
+    with `suffix` are kept as they are."""
+    ids = pd.Series(ids).astype(str)
+    names = ids.where(ids.str.endswith(suffix), ids + suffix)
+    return (os.path.join(data_dir, '') + names).values
+
+
+def check_bag(path):
+    """(size in bytes, status) of a feature file; status is 'ok', 'missing' or
+    'corrupt' (empty, or a torch zip archive without its central directory,
+    i.e. a truncated write)."""
+    try:
+        size = os.stat(path).st_size
+    except OSError:
+        return 0, 'missing'
+    if size == 0:
+        return 0, 'corrupt'
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'PK' and not zipfile.is_zipfile(path):
+        return size, 'corrupt'
+    return size, 'ok'
+
+
+class BagManifest:
+    """The bags of one csv as compact arrays (ids, paths, labels, sizes).
+
+    Paths are resolved once, when the manifest is built, and every file is
+    checked with a parallel stat, so missing or corrupt bags are reported
+    before the run instead of at the first epoch that reaches them.
+    """
+    def __init__(self, ids, paths, labels=None, check=True, n_threads=16):
+        self.ids = np.asarray(ids).astype(str)
+        self.paths = np.asarray(paths).astype(str)
+        self.labels = None if labels is None else np.asarray(labels)
+        self.sizes = np.zeros(len(self.paths), dtype=np.int64)
+        self.status = np.full(len(self.paths), 'ok', dtype=object)
+        if check:
+            self.check(n_threads)
+
+    @classmethod
+    def from_dir(cls, ids, data_dir, labels=None, suffix='.pt', **kwargs):
+        return cls(ids, resolve_paths(ids, data_dir, suffix), labels, **kwargs)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def check(self, n_threads=16):
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            results = list(pool.map(check_bag, self.paths))
+        self.sizes[:] = [size for size, _ in results]
+        self.status[:] = [status for _, status in results]
+        bad = np.flatnonzero(self.status != 'ok')
+        if len(bad) > 0:
+            lines = ['  {} ({})'.format(self.paths[i], self.status[i]) for i in bad[:20]]
+            if len(bad) > 20:
+                lines.append('  ...')
+            raise FileNotFoundError('{} of {} bags are missing or corrupt:\n{}'.format(
+                len(bad), len(self.paths), '\n'.join(lines)))
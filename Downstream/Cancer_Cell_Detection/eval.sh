@@ -1,6 +1,13 @@
 
 
-CUDA_VISIBLE_DEVICES=0 python3 classification_eval.py --config_path configs/colon.yaml --dataset_name Dataset_PT
 
 
-CUDA_VISIBLE_DEVICES=0 python3 classification_eval.py --config_path configs/breast.yaml --dataset_name DROID_breast
\ No newline at end of file
+# every organ config in one run: the model is loaded once and slides listed in
+# several cohorts are read once
+CUDA_VISIBLE_DEVICES=0 python3 classification_eval.py \
+    --config_path configs/colon.yaml configs/breast.yaml \
+    --dataset_name Dataset_PT DROID_breast
+
+
+# pyramidal TIFF heatmaps of patch_prob (needs .h5 bags with coordinates)
+CUDA_VISIBLE_DEVICES=0 python3 classification_heatmap.py --config_path configs/colon.yaml --dataset_name Dataset_PT
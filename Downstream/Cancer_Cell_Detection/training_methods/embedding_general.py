@@ -5,6 +5,7 @@ import torch
 import numpy as np
 from tqdm import tqdm
 from sklearn.metrics import roc_auc_score, f1_score, precision_score, recall_score, accuracy_score
+from utils.utils import autocast_context
 
 
 def train_loop(epoch, model, loader, optimizer, writer, cfg):
@@ -13,15 +14,17 @@ def train_loop(epoch, model, loader, optimizer, writer, cfg):
     loss_fn = torch.nn.CrossEntropyLoss()
     train_loss = 0
     model.to(device)
+    precision = cfg.General.precision or 'fp32'
 
     with tqdm(total=len(loader), desc='train epoch: {}'.format(epoch)) as bar:
         for idx, batch in enumerate(loader):
             x, y = batch['x'].to(device, dtype=torch.float32), \
                                                batch['y'].to(device, dtype=torch.long)
 
-            result = model(x) # (B, n_classes)
+            with autocast_context(precision, device):
+                result = model(x) # (B, n_classes)
             logits = result[cfg.Model.logits_field]
-            loss = loss_fn(logits, y)
+            loss = loss_fn(logits.float(), y)
 
             bar.set_postfix({'loss' : '{:.5f}'.format(loss)})
             optimizer.zero_grad()
@@ -48,6 +51,7 @@ def evaluation(index, model, loader, result_dir, cfg):
     loss_fn = torch.nn.CrossEntropyLoss()
     val_loss = 0
     model.to(device)
+    precision = cfg.General.precision or 'fp32'
     probs = []
     labels = []
     with torch.no_grad():
@@ -56,10 +60,11 @@ def evaluation(index, model, loader, result_dir, cfg):
                 x, y, tmp_z= batch['x'].to(device, dtype=torch.float32), \
                              batch['y'].to(device, dtype=torch.long), \
                             batch['z'].to(device, dtype=torch.long)
-                result = model(x,x_anatomic=tmp_z)
+                with autocast_context(precision, device):
+                    result = model(x,x_anatomic=tmp_z)
                 logits = result[cfg.Model.logits_field]
-                y_prob = torch.softmax(logits, dim=-1)
-                loss = loss_fn(logits, y)
+                y_prob = torch.softmax(logits.float(), dim=-1)
+                loss = loss_fn(logits.float(), y)
 
                 probs.append(y_prob)
                 labels.append(y)
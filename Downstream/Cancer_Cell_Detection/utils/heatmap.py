@@ -0,0 +1,108 @@
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tifffile
+
+
+def jet_lut():
+    """256 x 3 uint8 jet colormap."""
+    x = np.linspace(0, 1, 256)
+    rgb = np.stack([1.5 - np.abs(4 * x - 3), 1.5 - np.abs(4 * x - 2), 1.5 - np.abs(4 * x - 1)], axis=1)
+    return (np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+
+def rasterize(coords, values, patch_size, pixels_per_patch=1, level=None):
+    """Patch values scattered onto the tile grid: float32 [H, W] with one
+    `pixels_per_patch` x `pixels_per_patch` block per tile and NaN where there
+    is no patch. coords are the (x, y[, level]) pixel positions of the patches;
+    with a level column only the patches at `level` are drawn (None: the bag
+    must hold a single level). No patches give one NaN tile."""
+    values = np.asarray(values, dtype=np.float32).reshape(-1)
+    coords = np.asarray(coords).reshape(len(values), -1) if len(values) else np.zeros((0, 2), dtype=np.int64)
+    if coords.shape[1] > 2 and len(coords):
+        levels = np.unique(coords[:, 2])
+        if level is None and len(levels) > 1:
+            raise ValueError(f'patches from levels {levels.tolist()} cannot share one grid: pass level=')
+        if level is not None:
+            keep = coords[:, 2] == level
+            coords, values = coords[keep], values[keep]
+    if len(values) == 0:
+        return np.full((pixels_per_patch, pixels_per_patch), np.nan, dtype=np.float32)
+    grid_xy = coords[:, :2].astype(np.int64) // patch_size
+    height, width = grid_xy[:, 1].max() + 1, grid_xy[:, 0].max() + 1
+    grid = np.full((height, width), -np.inf, dtype=np.float32)
+    # overlapping patches on one tile keep the highest value
+    np.maximum.at(grid, (grid_xy[:, 1], grid_xy[:, 0]), values)
+    grid[np.isneginf(grid)] = np.nan
+    if pixels_per_patch > 1:
+        grid = np.repeat(np.repeat(grid, pixels_per_patch, axis=0), pixels_per_patch, axis=1)
+    return grid
+
+
+def downsample(grid):
+    """2x mean downsampling that ignores NaN (background) pixels."""
+    height, width = grid.shape
+    padded = np.full((height + height % 2, width + width % 2), np.nan, dtype=grid.dtype)
+    padded[:height, :width] = grid
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+def colorize(grid, lut):
+    """Values in [0, 1] to RGB; background stays white."""
+    index = np.clip(np.nan_to_num(grid, nan=0.) * 255 + 0.5, 0, 255).astype(np.uint8)
+    rgb = lut[index]
+    rgb[np.isnan(grid)] = 255
+    return rgb
+
+
+def write_pyramid_tiff(path, grid, tile_size=256, compression='zlib', lut=None):
+    """Tiled pyramidal TIFF: the full grid plus 2x downsampled levels (as
+    SubIFDs) until a level fits in one tile."""
+    lut = jet_lut() if lut is None else lut
+    levels = [grid]
+    while max(levels[-1].shape) > tile_size:
+        levels.append(downsample(levels[-1]))
+    options = dict(tile=(tile_size, tile_size), photometric='rgb', compression=compression)
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(colorize(levels[0], lut), subifds=len(levels) - 1, **options)
+        for level in levels[1:]:
+            tif.write(colorize(level, lut), subfiletype=1, **options)
+    return path
+
+
+def export_heatmap(path, coords, values, patch_size=256, pixels_per_patch=8, tile_size=256, compression='zlib',
+                   level=None):
+    grid = rasterize(coords, values, patch_size, pixels_per_patch, level)
+    return write_pyramid_tiff(path, grid, tile_size, compression)
+
+
+class HeatmapExporter:
+    """Rasterizes and writes heatmaps in a process pool, so the model can
+    score the next slide while earlier ones are written."""
+    def __init__(self, result_dir, n_workers=4, **options):
+        self.result_dir = result_dir
+        self.options = options
+        self.pool = ProcessPoolExecutor(max_workers=n_workers)
+        self.futures = []
+        os.makedirs(result_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, slide_id, coords, values):
+        path = os.path.join(self.result_dir, slide_id + '.tif')
+        self.futures.append(self.pool.submit(export_heatmap, path, np.asarray(coords), np.asarray(values), **self.options))
+
+    def close(self):
+        """Waits for every heatmap and returns their paths."""
+        paths = [future.result() for future in self.futures]
+        self.pool.shutdown()
+        return paths
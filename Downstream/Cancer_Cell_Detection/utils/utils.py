@@ -1,3 +1,4 @@
+import contextlib
 import yaml
 import random
 import os
@@ -36,6 +37,17 @@ def seed_torch(device, seed=7):
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
 
+def autocast_context(precision='fp32', device=torch.device('cpu')):
+    """Mixed precision for the aggregator forward pass. 'bf16' runs the
+    linear layers in bfloat16 (AMX/AVX512-BF16 on recent CPUs); softmax and
+    losses are kept in fp32 by the callers. 'fp32' is a no-op."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision == 'bf16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    raise NotImplementedError(precision)
+
+
 
 class EarlyStopping:
     def __init__(self, patience=20, stop_epoch=50, type='min', verbose=False):
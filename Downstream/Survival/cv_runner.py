@@ -0,0 +1,44 @@
+import os
+import torch
+import torch.multiprocessing as mp
+
+_bag_pool = None
+
+
+def get_bag_pool():
+    """The shared bag pool of the current fold worker (None in the parent)."""
+    return _bag_pool
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _init_worker(bag_pool, n_threads, counter):
+    global _bag_pool
+    _bag_pool = bag_pool
+    with counter.get_lock():
+        rank = counter.value
+        counter.value += 1
+    # pin each worker to its own block of cores
+    cpus = available_cpus()
+    if hasattr(os, 'sched_setaffinity') and (rank + 1) * n_threads <= len(cpus):
+        os.sched_setaffinity(0, cpus[rank * n_threads:(rank + 1) * n_threads])
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(1)
+
+
+def run_folds(fold_fn, folds, bag_pool, n_workers=None, n_threads=None):
+    """Runs `fold_fn(i)` for every fold in a pool of worker processes and
+    returns the results in fold order. Workers share `bag_pool` (see
+    SharedBagPool) and get `n_threads` intra-op threads each, by default an
+    equal share of the available cores."""
+    folds = list(folds)
+    n_workers = min(n_workers or len(folds), len(folds))
+    n_threads = n_threads or max(1, len(available_cpus()) // n_workers)
+    ctx = mp.get_context('spawn')
+    counter = ctx.Value('i', 0)
+    with ctx.Pool(n_workers, initializer=_init_worker, initargs=(bag_pool, n_threads, counter)) as pool:
+        return pool.map(fold_fn, folds, chunksize=1)
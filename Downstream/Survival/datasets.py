@@ -7,19 +7,145 @@ from torch.utils.data import Dataset, DataLoader
 from sklearn.preprocessing import  OneHotEncoder
 from sklearn.compose import ColumnTransformer
 import warnings
+from utils.manifest import BagManifest, resolve_paths
+
+class BagCache:
+    """In-memory store of bag features keyed by file path.
+
+    One cache can be shared by several datasets (e.g. the train and validation
+    sets of every fold), so each feature file is read from disk only once.
+    """
+    def __init__(self):
+        self.bags = {}
+
+    def __len__(self):
+        return len(self.bags)
+
+    def __contains__(self, path):
+        return path in self.bags
+
+    def get(self, path):
+        if path not in self.bags:
+            self.bags[path] = torch.load(path, map_location=torch.device('cpu'))
+        return self.bags[path]
+
+    def preload(self, paths):
+        for path in paths:
+            self.get(path)
+
+
+def bag_shape(path):
+    """(shape, dtype) of a .pt bag, memory-mapped so its features are not kept
+    in memory (a full load on torch < 2.1 or for legacy-format files)."""
+    try:
+        bag = torch.load(path, map_location=torch.device('cpu'), mmap=True)
+    except (TypeError, RuntimeError):
+        bag = torch.load(path, map_location=torch.device('cpu'))
+    return tuple(bag.shape), bag.dtype
+
+
+class SharedBagPool:
+    """Every bag of a cohort in one contiguous shared-memory buffer.
+
+    Bags are loaded once in the parent process; worker processes receive the
+    pool through torch.multiprocessing and read zero-copy views via `get`, the
+    same interface as `BagCache`.
+    """
+    def __init__(self, paths):
+        self.paths = list(dict.fromkeys(paths))
+        self.index = {path: i for i, path in enumerate(self.paths)}
+        # sizes first, then one bag at a time: peak memory is the buffer plus one bag
+        shapes = [bag_shape(path) for path in self.paths]
+        self.offsets = np.cumsum([0] + [shape[0] for shape, _ in shapes]).tolist()
+        if not shapes:
+            self.buffer = torch.empty(0).share_memory_()
+            return
+        row_shape, dtype = shapes[0][0][1:], shapes[0][1]
+        self.buffer = torch.empty((int(self.offsets[-1]),) + row_shape, dtype=dtype).share_memory_()
+        for i, path in enumerate(self.paths):
+            bag = torch.load(path, map_location=torch.device('cpu'))
+            self.buffer[self.offsets[i]:self.offsets[i + 1]].copy_(bag)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def get(self, path):
+        i = self.index[path]
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]]
+
+
+class RiskSetBatchSampler(object):
+    """Shuffled minibatches of bag indices for survival training.
+
+    Cox partial likelihood is only defined over a risk set, so every batch is
+    guaranteed to contain at least one uncensored case; batches without an event
+    are merged into the next one and a trailing batch without one is dropped.
+    """
+    def __init__(self, censorship, batch_size=32, shuffle=True, drop_last=False):
+        self.censorship = np.asarray(censorship)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self._planned = None
+
+    def _plan(self):
+        n = len(self.censorship)
+        order = np.random.permutation(n) if self.shuffle else np.arange(n)
+        batches, batch = [], []
+        for idx in order:
+            batch.append(int(idx))
+            if len(batch) >= self.batch_size and (self.censorship[batch] == 0).any():
+                batches.append(batch)
+                batch = []
+        if len(batch) > 1 and (self.censorship[batch] == 0).any() and not self.drop_last:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        batches = self._planned if self._planned is not None else self._plan()
+        self._planned = None
+        return iter(batches)
+
+    def __len__(self):
+        # merged and dropped batches depend on the shuffle: plan the next pass
+        # now so the count is exact and __iter__ yields those same batches
+        if self._planned is None:
+            self._planned = self._plan()
+        return len(self._planned)
+
 
 class SurvivalBagDataset(Dataset):
-    def __init__(self, df, data_dir, label_field='status', extra_df=None, csv_path=None, **kwargs):
+    def __init__(self, df, data_dir, label_field='status', extra_df=None, csv_path=None, bag_cache=None, **kwargs):
         super(SurvivalBagDataset, self).__init__()
         self.data_dir = data_dir
         self.label_field = label_field
         self.extra_df = None
+        self.bag_cache = bag_cache
         # inverse censorship 
         df.status = 1-df.status
         self.df = df
+        self.manifest = self.build_manifest(df, data_dir, label_field)
+        self.time = df['time'].values
+        self.status = df['status'].values
+
+    @staticmethod
+    def build_manifest(df, data_dir, label_field='status'):
+        filename = df['filename']
+        if filename.dtype == np.float64:
+            filename = filename.astype(int)
+        if 'feature_path' in df.columns:
+            paths = df['feature_path'].values
+        elif os.path.exists(os.path.join(data_dir, 'patch_feature')):
+            paths = resolve_paths(filename, os.path.join(data_dir, 'patch_feature'))
+        else:
+            paths = resolve_paths(filename, data_dir)
+        return BagManifest(filename, paths, labels=df[label_field])
 
     def __len__(self):
-        return len(self.df.values)
+        return len(self.manifest)
 
     def get_data_df(self):
         return self.df
@@ -43,24 +169,21 @@ class SurvivalBagDataset(Dataset):
 
         return weight
 
+    def get_feature_path(self, idx):
+        return self.manifest.paths[idx]
+
     def __getitem__(self, idx):
         if self.extra_df is None:
-            label = self.df[self.label_field].values[idx]
-            status = self.df['status'].values[idx]
+            label = self.manifest.labels[idx]
+            status = self.status[idx]
             #patient_id = self.df['patient_id'].values[idx]
-            if type(self.df['filename'])==np.float64:
-                self.df['filename'] = self.df['filename'].astype(int)
-            slide_id = str(self.df['filename'].values[idx])
-            time = self.df['time'].values[idx]
+            time = self.time[idx]
             # load from pt files
-            if 'feature_path' in self.df.columns:
-                full_path = self.df['feature_path'].values[idx]
+            full_path = self.manifest.paths[idx]
+            if self.bag_cache is not None:
+                features = self.bag_cache.get(full_path)
             else:
-                if os.path.exists(os.path.join(self.data_dir, 'patch_feature')):
-                    full_path = os.path.join(self.data_dir, 'patch_feature', slide_id if slide_id.endswith('.pt') else slide_id + '.pt')
-                else:
-                    full_path = os.path.join(self.data_dir, slide_id if slide_id.endswith('.pt') else slide_id + '.pt')
-            features = torch.load(full_path, map_location=torch.device('cpu'))
+                features = torch.load(full_path, map_location=torch.device('cpu'))
             res = {
                 'feature': features,
                 'label': torch.tensor([label]),
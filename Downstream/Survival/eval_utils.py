@@ -8,6 +8,7 @@ import torch.nn as nn
 ## metrics
 from sklearn.metrics import roc_auc_score, f1_score, precision_score, recall_score, accuracy_score
 from sksurv.metrics import concordance_index_censored
+from utils.utils import autocast_context
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -23,6 +24,7 @@ def evaluation(index, model, loader, result_dir, cfg, gc=16):
     pred_each = None
     val_loss = 0
     model.to(device)
+    precision = cfg.General.precision or 'fp32'
     with torch.no_grad():
         #with tqdm(total=len(loader)) as bar:
         for idx, batch in enumerate(loader):
@@ -30,8 +32,9 @@ def evaluation(index, model, loader, result_dir, cfg, gc=16):
                             batch['label'].to(device, dtype=torch.long), \
                             batch['time'].to(device), \
                             batch['status'].to(device)
-            result = model(x) # (1, n_classes)
-            bag_logits = result['bag_logits']
+            with autocast_context(precision, device):
+                result = model(x) # (1, n_classes)
+            bag_logits = result['bag_logits'].float()
             pred = bag_logits[0][1:]
             res_df.loc[idx, 'risk'] = pred.cpu().numpy()
             iter_ = idx % gc +1
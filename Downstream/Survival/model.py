@@ -95,7 +95,7 @@ class CHIEF_survival(nn.Module):
         if attention_only:
             return A
         A_raw = A
-        A = F.softmax(A, dim=1)  # softmax over N
+        A = F.softmax(A.float(), dim=1)  # softmax over N
 
         M = torch.mm(A, h)  # A: 1 * N h: N * 512 => M: 1 * 512
         # M = torch.cat([M, embed_batch], axis=1)
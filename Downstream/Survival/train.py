@@ -0,0 +1,59 @@
+import argparse
+import os
+from functools import partial
+import torch
+import warnings
+from utils.utils import read_yaml, seed_torch
+from utils.loader_utils import apply_host_profile
+from utils.dataloader_factory import create_fold_datasets, cohort_feature_paths
+from datasets import BagCache, SharedBagPool
+from cv_runner import run_folds, get_bag_pool
+from train_utils import train_fold, summarize_folds
+from model import CHIEF_survival
+warnings.filterwarnings("ignore")
+
+
+def load_model(cfg):
+    model = CHIEF_survival(n_classes=cfg.Data.n_classes, **cfg.Model)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    model.train()
+    return model
+
+def train_one_fold(i, cfg, result_dir, bag_cache=None):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    seed_torch(device, cfg.General.seed)
+    # in a fold worker the bags come from the shared pool
+    train_set, val_set = create_fold_datasets(i, cfg, bag_cache if bag_cache is not None else get_bag_pool())
+    model = load_model(cfg)
+    return train_fold(i, model, train_set, val_set, result_dir, cfg)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', type=str, default='./cfg_rcc_cox_dss.yaml')
+parser.add_argument('--k_start', type=int, default=0)
+parser.add_argument('--k_end', type=int, default=-1, help='last fold (default: -1, all folds)')
+parser.add_argument('--n_bootstrap', type=int, default=1000, help='bootstrap resamples for c-index CIs (0 disables)')
+parser.add_argument('--n_jobs', type=int, default=1, help='processes for the bootstrap')
+parser.add_argument('--parallel_folds', type=int, default=0,
+                    help='train folds in this many processes sharing one in-memory copy of the bags (0: serial)')
+parser.add_argument('--fold_threads', type=int, default=0, help='intra-op threads per fold process (0: cores / processes)')
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    apply_host_profile()
+    cfg = read_yaml(args.config_path)
+    result_dir = os.path.join(cfg.General.result_dir, 'train', cfg.Data.project)
+    os.makedirs(result_dir, exist_ok=True)
+
+    k_end = cfg.General.fold_num if args.k_end == -1 else args.k_end
+    folds = range(args.k_start, k_end)
+    if args.parallel_folds > 0:
+        bag_pool = SharedBagPool(cohort_feature_paths(cfg))
+        cindex_list = run_folds(partial(train_one_fold, cfg=cfg, result_dir=result_dir), folds, bag_pool,
+                                n_workers=args.parallel_folds, n_threads=args.fold_threads or None)
+    else:
+        # one cache for all folds: every bag is read from disk once
+        bag_cache = SharedBagPool(cohort_feature_paths(cfg)) if cfg.Data.preload else BagCache()
+        cindex_list = [train_one_fold(i, cfg, result_dir, bag_cache) for i in folds]
+    summarize_folds(folds, cindex_list, result_dir, n_bootstrap=args.n_bootstrap,
+                    seed=cfg.General.seed, n_jobs=args.n_jobs)
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+from losses.losses import CoxSurvLoss, NLLSurvLoss
+from datasets import RiskSetBatchSampler
+from eval_utils import evaluation
+from utils.utils import EarlyStopping, load_task_state, save_task_state, autocast_context, get_checkpoint_writer
+from utils.dataloader_factory import create_val_dataloader
+from utils.bootstrap import bootstrap_ci, save_bootstrap_ci
+
+
+def survival_cox(outputs, batch, loss_fn):
+    # risk is the second logit, matching `evaluation`
+    risk = torch.cat([out['bag_logits'][:, 1:] for out in outputs], dim=0).float()
+    time = np.asarray([b['time'].item() for b in batch])
+    c = np.asarray([b['status'].item() for b in batch])
+    return loss_fn(hazards=risk, time=time, c=c)
+
+def survival_nll(outputs, batch, loss_fn):
+    logits = torch.cat([out['bag_logits'] for out in outputs], dim=0).float()
+    hazards = torch.sigmoid(logits)
+    S = torch.cumprod(1 - hazards, dim=1)
+    Y = torch.cat([b['label'] for b in batch]).long().to(logits.device)
+    c = torch.stack([b['status'] for b in batch]).to(logits.device)
+    return loss_fn(hazards, S, Y, c)
+
+TRAIN_FUNCTIONS = {
+    'survival_cox': (survival_cox, CoxSurvLoss),
+    'survival_nll': (survival_nll, NLLSurvLoss),
+}
+
+
+def train_loop(epoch, model, dataset, batch_sampler, optimizer, cfg):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    batch_loss_fn, loss_cls = TRAIN_FUNCTIONS[cfg.Train.train_function]
+    loss_fn = loss_cls()
+    model.train()
+    model.to(device)
+    precision = cfg.General.precision or 'fp32'
+    train_loss = 0.
+    n_steps = 0
+    with tqdm(total=len(batch_sampler), desc='train epoch: {}'.format(epoch)) as bar:
+        for indices in batch_sampler:
+            batch = [dataset[i] for i in indices]
+            # bags have different lengths: forward them one by one and backward
+            # once through the whole risk set
+            with autocast_context(precision, device):
+                outputs = [model(b['feature'].to(device, dtype=torch.float32)) for b in batch]
+            loss = batch_loss_fn(outputs, batch, loss_fn)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            train_loss += loss.item()
+            n_steps += 1
+            bar.set_postfix({'loss': '{:.5f}'.format(loss.item())})
+            bar.update(1)
+    return train_loss / max(n_steps, 1)
+
+
+def train_fold(index, model, train_set, val_set, result_dir, cfg):
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()),
+                                 lr=cfg.Train.lr, weight_decay=cfg.Train.reg)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, **cfg.Train.CosineAnnealingLR)
+    # early stopping monitors the validation c-index: higher is better
+    early_stopping = EarlyStopping(patience=cfg.Train.Early_stopping.patient,
+                                   stop_epoch=cfg.Train.Early_stopping.stop_epoch, type='max')
+    batch_sampler = RiskSetBatchSampler(train_set.df['status'].values, batch_size=cfg.Train.batch_size)
+    val_loader = create_val_dataloader(val_set)
+    ckpt_name = os.path.join(result_dir, f's_{index}_checkpoint.pt')
+
+    start_epoch = 0
+    if os.path.exists(os.path.join(result_dir, f'task_state_{index}.yaml')):
+        start_epoch = load_task_state(result_dir, early_stopping, scheduler, model, index) - 1
+
+    for epoch in range(start_epoch, cfg.Train.max_epochs):
+        save_task_state(result_dir, early_stopping, epoch + 1, model, index)
+        train_loss = train_loop(epoch, model, train_set, batch_sampler, optimizer, cfg)
+        _, cindex = evaluation(index, model, val_loader, result_dir, cfg)
+        print(f'fold {index} epoch {epoch}: train loss {train_loss:.5f}, val cindex {cindex:.4f}')
+        early_stopping(epoch, [cindex], None, model, ckpt_name=ckpt_name)
+        scheduler.step()
+        if early_stopping.early_stop:
+            break
+
+    get_checkpoint_writer().flush()
+    model.load_state_dict(torch.load(ckpt_name))
+    res_df, cindex = evaluation(index, model, val_loader, result_dir, cfg)
+    res_df.to_csv(os.path.join(result_dir, f'preds_{index}.csv'), index=False, encoding='utf-8-sig')
+    return cindex
+
+
+def summarize_folds(folds, cindex_list, result_dir, n_bootstrap=1000, seed=2023, n_jobs=1, decimals=4):
+    result = {'cindex': [np.around(c, decimals=decimals) for c in cindex_list]}
+    result['cindex'].append(np.around(np.mean(cindex_list), decimals=decimals).astype(str) + '+' +
+                            np.around(np.std(cindex_list), decimals=decimals).astype(str))
+    pd.DataFrame(result).to_csv(os.path.join(result_dir, 'metrics.csv'), index=False)
+    print(result)
+
+    if n_bootstrap > 0:
+        ci_rows = []
+        for i in folds:
+            # status in the saved predictions is the event indicator again
+            df = pd.read_csv(os.path.join(result_dir, f'preds_{i}.csv'))
+            ci = bootstrap_ci('cindex', df['status'].values, df['time'].values, df['risk'].values,
+                              n_resamples=n_bootstrap, seed=seed, n_jobs=n_jobs)
+            ci_rows.append({'fold': i, **ci})
+        save_bootstrap_ci(ci_rows, result_dir, decimals=decimals)
@@ -0,0 +1,128 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def bootstrap_indices(n, n_resamples=1000, seed=2023):
+    """Index matrix [n_resamples, n], drawn once and shared by every metric."""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, n, size=(n_resamples, n))
+
+
+def resample_weights(idx, n):
+    """How often each sample is drawn in each resample: [n_resamples, n]."""
+    B = idx.shape[0]
+    flat = (idx + np.arange(B)[:, None] * n).ravel()
+    return np.bincount(flat, minlength=B * n).reshape(B, n).astype(np.float64)
+
+
+def _weighted_auc(scores, is_pos, weights):
+    # Mann-Whitney U with multiplicities: each tie group of scores contributes
+    # pos_weight * (neg_weight_below + 0.5 * neg_weight_tied)
+    order = np.argsort(scores, kind='mergesort')
+    s = scores[order]
+    pos = is_pos[order]
+    w = weights[:, order]
+    starts = np.flatnonzero(np.r_[True, s[1:] != s[:-1]])
+    wp = np.add.reduceat(w * pos, starts, axis=1)
+    wn = np.add.reduceat(w * ~pos, starts, axis=1)
+    neg_below = np.cumsum(wn, axis=1) - wn
+    num = (wp * (neg_below + 0.5 * wn)).sum(axis=1)
+    den = wp.sum(axis=1) * wn.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 0, num / den, np.nan)
+
+
+def auc_binary(labels, scores, weights):
+    labels = np.asarray(labels)
+    return _weighted_auc(np.asarray(scores, dtype=np.float64), labels == 1, weights)
+
+
+def auc_ovo(labels, probs, weights):
+    """Macro one-vs-one AUC (Hand & Till), as roc_auc_score(multi_class='ovo').
+    Class pairs missing from a resample are ignored for that resample."""
+    labels = np.asarray(labels)
+    probs = np.asarray(probs, dtype=np.float64)
+    pair_aucs = []
+    for a in range(probs.shape[1]):
+        for b in range(a + 1, probs.shape[1]):
+            mask = (labels == a) | (labels == b)
+            if not mask.any():
+                continue
+            is_a = labels[mask] == a
+            w = weights[:, mask]
+            auc_ab = _weighted_auc(probs[mask, a], is_a, w)
+            auc_ba = _weighted_auc(probs[mask, b], ~is_a, w)
+            pair_aucs.append((auc_ab + auc_ba) / 2)
+    pair_aucs = np.stack(pair_aucs, axis=1)
+    with np.errstate(invalid='ignore'):
+        return np.nanmean(pair_aucs, axis=1)
+
+
+def accuracy(labels, preds, weights):
+    correct = (np.asarray(labels) == np.asarray(preds)).astype(np.float64)
+    return weights @ correct / weights.sum(axis=1)
+
+
+def cindex(event, time, risk, weights, tied_tol=1e-8):
+    """Harrell's c-index with the comparability rules of sksurv's
+    concordance_index_censored, computed for all resamples as w^T K w."""
+    event = np.asarray(event).astype(bool)
+    time = np.asarray(time, dtype=np.float64)
+    risk = np.asarray(risk, dtype=np.float64)
+    # pair (i, j) is comparable if i has an event and j is still at risk after
+    # t_i, or is censored at t_i
+    later = time[None, :] > time[:, None]
+    tied_censored = (time[None, :] == time[:, None]) & ~event[None, :]
+    comparable = event[:, None] & (later | tied_censored)
+    diff = risk[:, None] - risk[None, :]
+    concordant = np.where(np.abs(diff) <= tied_tol, 0.5, (diff > 0).astype(np.float64))
+    num = ((weights @ (comparable * concordant)) * weights).sum(axis=1)
+    den = ((weights @ comparable.astype(np.float64)) * weights).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 0, num / den, np.nan)
+
+
+METRICS = {
+    'auc': auc_binary,
+    'auc_ovo': auc_ovo,
+    'accuracy': accuracy,
+    'cindex': cindex,
+}
+
+
+def _bootstrap_chunk(metric, arrays, idx, n):
+    return METRICS[metric](*arrays, resample_weights(idx, n))
+
+
+def bootstrap_ci(metric, *arrays, n_resamples=1000, alpha=0.05, seed=2023, n_jobs=1, chunk_size=250):
+    """Point estimate and percentile CI of `metric` (a key of METRICS) over
+    `n_resamples` bootstrap resamples of the samples in `arrays`."""
+    n = len(arrays[0])
+    idx = bootstrap_indices(n, n_resamples, seed)
+    chunks = [idx[i:i + chunk_size] for i in range(0, n_resamples, chunk_size)]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            values = list(pool.map(_bootstrap_chunk, [metric] * len(chunks), [arrays] * len(chunks),
+                                   chunks, [n] * len(chunks)))
+    else:
+        values = [_bootstrap_chunk(metric, arrays, chunk, n) for chunk in chunks]
+    values = np.concatenate(values)
+    point = METRICS[metric](*arrays, np.ones((1, n)))[0]
+    return {
+        'metric': metric,
+        'estimate': point,
+        'ci_lower': np.nanpercentile(values, 100 * alpha / 2),
+        'ci_upper': np.nanpercentile(values, 100 * (1 - alpha / 2)),
+        'std': np.nanstd(values),
+        'n_resamples': n_resamples,
+    }
+
+
+def save_bootstrap_ci(rows, result_dir, file_name='bootstrap_ci.csv', decimals=4):
+    df = pd.DataFrame(rows).round(decimals)
+    df.to_csv(os.path.join(result_dir, file_name), index=False)
+    print(df)
+    return df
@@ -5,10 +5,11 @@ import math
 
 import numpy as np
 import pandas as pd
-from torch.utils.data import DataLoader, WeightedRandomSampler
+from torch.utils.data import WeightedRandomSampler
 from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
 from exhaustive_weighted_random_sampler import ExhaustiveWeightedRandomSampler
 from sklearn.model_selection import StratifiedKFold
+from utils.loader_utils import build_dataloader, loader_options
 
 
 def create_dataloader(index, dataset, cfg, result_dir):
@@ -20,8 +21,39 @@ def create_dataloader(index, dataset, cfg, result_dir):
 def create_bag_dataloader(index, dataset_name, cfg, result_dir):
     df = pd.read_csv(os.path.join(cfg.Data.split_dir, f'split_{index}.csv'))
     from datasets import SurvivalBagDataset
+    from datasets import SharedBagPool
     dataset = SurvivalBagDataset(df,istrain=False, **cfg.Data)
-    dataloader = DataLoader(dataset, batch_size=None, shuffle=False,
-                                    num_workers=cfg.Train.num_worker)
+    num_workers = cfg.Train.num_worker
+    if cfg.Data.preload:
+        # one shared-memory copy of the cohort instead of a torch.load per worker
+        dataset.bag_cache = SharedBagPool([dataset.get_feature_path(i) for i in range(len(dataset))])
+        num_workers = 0
+    dataloader = build_dataloader(dataset, shuffle=False, name=f'split_{index}',
+                                  **loader_options(cfg, num_workers=num_workers))
 
     return dataloader
+
+def create_fold_datasets(index, cfg, bag_cache=None):
+    """Cross-validation fold `index`: validate on split_{index}.csv and train
+    on the union of the remaining splits. Datasets built with the same
+    `bag_cache` share loaded features across folds."""
+    from datasets import SurvivalBagDataset
+    split_dfs = [pd.read_csv(os.path.join(cfg.Data.split_dir, f'split_{i}.csv'))
+                 for i in range(cfg.General.fold_num)]
+    train_df = pd.concat([df for i, df in enumerate(split_dfs) if i != index], ignore_index=True)
+    val_df = split_dfs[index]
+    train_set = SurvivalBagDataset(train_df, istrain=True, bag_cache=bag_cache, **cfg.Data)
+    val_set = SurvivalBagDataset(val_df, istrain=False, bag_cache=bag_cache, **cfg.Data)
+    return train_set, val_set
+
+def cohort_feature_paths(cfg):
+    """Feature paths of every bag in the cross-validation splits."""
+    from datasets import SurvivalBagDataset
+    df = pd.concat([pd.read_csv(os.path.join(cfg.Data.split_dir, f'split_{i}.csv'))
+                    for i in range(cfg.General.fold_num)], ignore_index=True)
+    dataset = SurvivalBagDataset(df, istrain=False, **cfg.Data)
+    return [dataset.get_feature_path(i) for i in range(len(dataset))]
+
+def create_val_dataloader(dataset):
+    # bags live in the in-process cache, so worker processes would only copy them
+    return build_dataloader(dataset, shuffle=False, name='val')
@@ -1,3 +1,7 @@
+import atexit
+import collections
+import contextlib
+import threading
 import yaml
 import random
 import os
@@ -31,6 +35,115 @@ def seed_torch(device, seed=7):
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
 
+def autocast_context(precision='fp32', device=torch.device('cpu')):
+    """Mixed precision for the aggregator forward pass. 'bf16' runs the
+    linear layers in bfloat16 (AMX/AVX512-BF16 on recent CPUs); softmax and
+    losses are kept in fp32 by the callers. 'fp32' is a no-op."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision == 'bf16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    raise NotImplementedError(precision)
+
+
+
+def snapshot_state(obj):
+    """Staging copy of a (nested) state dict: tensors are copied to CPU so the
+    caller can keep training while the copy is written."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_state(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    return obj
+
+def atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread.
+
+    Jobs are keyed (by default on the target path); a job submitted while an
+    older one with the same key is still queued replaces it, so only the
+    newest state is written. Every file is written to a temporary name and
+    renamed, so a crash never leaves a truncated checkpoint. Pending jobs are
+    flushed by `flush`, on interpreter exit and when used as a context manager.
+    """
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def submit(self, key, write_fn, *args):
+        with self.cond:
+            self._raise_error()
+            self.pending[key] = (write_fn, args)
+            self.cond.notify_all()
+
+    def save(self, obj, path):
+        self.submit(path, atomic_save, snapshot_state(obj), path)
+
+    def flush(self):
+        with self.cond:
+            while self.pending or self.busy:
+                self.cond.wait()
+            self._raise_error()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            print(f'CheckpointWriter: last write failed: {self.error!r}')
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                _, (write_fn, args) = self.pending.popitem(last=False)
+                self.busy = True
+            try:
+                write_fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+_checkpoint_writer = None
+
+def get_checkpoint_writer():
+    global _checkpoint_writer
+    if _checkpoint_writer is None:
+        _checkpoint_writer = CheckpointWriter()
+    return _checkpoint_writer
+
 
 class EarlyStopping:
     def __init__(self, patience=20, stop_epoch=50, type='min', verbose=False):
@@ -93,14 +206,16 @@ class EarlyStopping:
             print(f'metric decreased ({-self.best_score:.6f} --> {-score:.6f}).  Saving model ...')
         else:
             raise NotImplementedError
+        writer = get_checkpoint_writer()
         if isinstance(model, dict):
             os.makedirs(ckpt_name[:-3], exist_ok=True)
             for key, value in model.items():
-                torch.save(model[key].state_dict(), os.path.join(ckpt_name[:-3], key + '.pt'))
+                writer.save(model[key].state_dict(), os.path.join(ckpt_name[:-3], key + '.pt'))
         else:
-            torch.save(model.state_dict(), ckpt_name)
+            writer.save(model.state_dict(), ckpt_name)
 
 def load_task_state(result_dir, early_stopping, scheduler, model, index):
+    get_checkpoint_writer().flush()
     task_state = read_yaml(os.path.join(result_dir, f'task_state_{index}.yaml'))
     early_stopping.counter = task_state.early_stop_count
     for _ in range(task_state.current_epoch-1):
@@ -118,10 +233,16 @@ def save_task_state(result_dir, early_stopping, current_epoch, model, index):
         'early_stop_count': early_stopping.counter
     }
 
-    with open(os.path.join(result_dir, f'task_state_{index}.yaml'), "w") as f:
-        yaml.dump(task_state, f)
-
     os.makedirs(os.path.join(result_dir, 'last_model_state'), exist_ok=True)
     state_dict_path = os.path.join(result_dir, 'last_model_state', f'checkpoint_{index}.pt')
-    torch.save(model.state_dict(), state_dict_path)
+    task_state_path = os.path.join(result_dir, f'task_state_{index}.yaml')
+    # one job: the yaml is only updated once the matching weights are on disk
+    get_checkpoint_writer().submit(task_state_path, _write_task_state, task_state, snapshot_state(model.state_dict()),
+                                   task_state_path, state_dict_path)
+
+def _write_task_state(task_state, state_dict, task_state_path, state_dict_path):
+    atomic_save(state_dict, state_dict_path)
+    with open(task_state_path + '.tmp', "w") as f:
+        yaml.dump(task_state, f)
+    os.replace(task_state_path + '.tmp', task_state_path)
 
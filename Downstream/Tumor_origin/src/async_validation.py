@@ -0,0 +1,75 @@
+import queue
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from dataset import MultiModalDataset
+from file_utils import snapshot_state
+from metrics import MetricsAccumulator
+from network import CHIEF_Tumor_origin, autocast_context
+
+
+def valid_worker(args, device, job_queue, result_queue):
+    """Validation process: loads the validation bags once, then evaluates each
+    weight snapshot it receives until it gets None."""
+    torch.set_num_threads(args.async_valid_threads)
+    device = torch.device(device)
+    dataset = MultiModalDataset(args.gt_csv, args.val_csv, args.label_dict, args.histology_feature_path,
+                                split_name='valid', site_name=args.site_name, feature_suffix=args.feature_suffix)
+    bags = [dataset[i] for i in range(len(dataset))]
+    model = CHIEF_Tumor_origin(n_classes=args.n_classes).to(device)
+    model.eval()
+    loss_fn = nn.CrossEntropyLoss()
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        epoch, state_dict = job
+        model.load_state_dict(state_dict)
+        metrics = MetricsAccumulator(len(bags), args.n_classes, device)
+        with torch.no_grad():
+            for h_features, label, _ in bags:
+                h_features = h_features.unsqueeze(0).to(device)
+                label = torch.tensor([label], device=device)
+                with autocast_context(args.precision, device):
+                    logits, probs = model(h_features)
+                metrics.update(logits, label, loss_fn(logits.float(), label))
+        result_queue.put((epoch,) + tuple(metrics.compute()))
+
+
+class AsyncValidator:
+    """Runs `valid_loop` for epoch e in a separate process while epoch e+1
+    trains. The weights of every submitted epoch are kept until its result has
+    been collected, so the caller can still save the best epoch's weights."""
+    def __init__(self, args, device):
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.snapshots = {}
+        self.process = ctx.Process(target=valid_worker, args=(args, str(device), self.jobs, self.results), daemon=True)
+        self.process.start()
+
+    def submit(self, epoch, state_dict):
+        snapshot = snapshot_state(state_dict)
+        self.snapshots[epoch] = snapshot
+        self.jobs.put((epoch, snapshot))
+
+    def get(self):
+        """Blocks for the oldest pending result:
+        (epoch, valid_loss, valid_acc, valid_auc, state_dict)."""
+        while True:
+            try:
+                epoch, loss, acc, auc = self.results.get(timeout=5)
+                return epoch, loss, acc, auc, self.snapshots.pop(epoch)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('validation worker exited with code %s' % self.process.exitcode)
+
+    def close(self):
+        """Collects all outstanding results and stops the worker."""
+        pending = [self.get() for _ in range(len(self.snapshots))]
+        self.jobs.put(None)
+        self.process.join()
+        return pending
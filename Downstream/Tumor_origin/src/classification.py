@@ -8,12 +8,15 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 
-from sklearn.metrics import accuracy_score, roc_auc_score
-
 from dataset import MultiModalDataset
-from file_utils import save_pkl
+from file_utils import save_pkl, get_checkpoint_writer
+from bootstrap import bootstrap_ci, save_bootstrap_ci
+from metrics import MetricsAccumulator
+from pruning import AttentionPruner
+from async_validation import AsyncValidator
+from loader_utils import host_setting
 
-from network import CHIEF_Tumor_origin
+from network import CHIEF_Tumor_origin, autocast_context
 
 
 
@@ -35,6 +38,8 @@ class Tumor_origin:
         self.model = None
         self.optimizer = None
         self.loss_fn = None
+        self.pruner = AttentionPruner(topk=args.prune_topk, explore=args.prune_explore,
+                                      full_every=args.prune_full_every, warmup=args.prune_warmup, seed=args.seed)
 
     def set_seed(self, seed=1):
         random.seed(seed)
@@ -47,16 +52,23 @@ class Tumor_origin:
         torch.backends.cudnn.benchmark = False
         torch.backends.cudnn.deterministic = True
 
+    def loader_options(self):
+        return dict(num_workers=host_setting(self.args.num_workers, 'bag_workers', 4), persistent_workers=self.args.persistent_workers,
+                    prefetch_factor=self.args.prefetch_factor, pin_memory=self.args.pin_memory,
+                    worker_affinity=self.args.worker_affinity, read_ahead=self.args.read_ahead)
+
     def init_data_loader(self, split_csv):
-        self.train_dataset = MultiModalDataset(self.args.gt_csv, self.args.train_csv, self.args.label_dict, self.args.histology_feature_path, split_name='train', balance_met=self.args.balance_met)
-        self.valid_dataset = MultiModalDataset(self.args.gt_csv, self.args.val_csv, self.args.label_dict, self.args.histology_feature_path, split_name='valid', site_name=self.args.site_name)
-        self.test_dataset = MultiModalDataset(self.args.gt_csv, self.args.test_csv, self.args.label_dict, self.args.histology_feature_path, split_name='test')
-        self.train_loader = MultiModalDataset.get_data_loader(self.train_dataset, batch_size=self.args.batch_size, training=True)
-        self.valid_loader = MultiModalDataset.get_data_loader(self.valid_dataset, batch_size=self.args.batch_size, training=False)
-        self.test_loader = MultiModalDataset.get_data_loader(self.test_dataset, batch_size=self.args.batch_size, training=False)
+        self.train_dataset = MultiModalDataset(self.args.gt_csv, self.args.train_csv, self.args.label_dict, self.args.histology_feature_path, split_name='train', balance_met=self.args.balance_met, feature_suffix=self.args.feature_suffix)
+        self.valid_dataset = MultiModalDataset(self.args.gt_csv, self.args.val_csv, self.args.label_dict, self.args.histology_feature_path, split_name='valid', site_name=self.args.site_name, feature_suffix=self.args.feature_suffix)
+        self.test_dataset = MultiModalDataset(self.args.gt_csv, self.args.test_csv, self.args.label_dict, self.args.histology_feature_path, split_name='test', feature_suffix=self.args.feature_suffix)
+        if self.args.preload:
+            MultiModalDataset.preload([self.train_dataset, self.valid_dataset, self.test_dataset])
+        self.train_loader = MultiModalDataset.get_data_loader(self.train_dataset, batch_size=self.args.batch_size, training=True, **self.loader_options())
+        self.valid_loader = MultiModalDataset.get_data_loader(self.valid_dataset, batch_size=self.args.batch_size, training=False, **self.loader_options())
+        self.test_loader = MultiModalDataset.get_data_loader(self.test_dataset, batch_size=self.args.batch_size, training=False, **self.loader_options())
 
     def init_model(self, is_train=False):
-        self.model=CHIEF_Tumor_origin(n_classes=self.args.n_classes)
+        self.model=CHIEF_Tumor_origin(n_classes=self.args.n_classes, chunk_size=self.args.checkpoint_chunk_size)
 
         self.model.load_state_dict(
             torch.load(
@@ -92,38 +104,61 @@ class Tumor_origin:
         result_dict = {'train_loss': [], 'valid_loss': [],
                        'train_acc': [], 'valid_acc': [],
                        'train_auc': [], 'valid_auc': []}
+        validator = AsyncValidator(self.args, self.device) if self.args.async_valid else None
         for epoch in range(self.args.max_epochs):
             start_time = time.time()
 
-            train_loss, train_acc, train_auc = self.train_loop(self.train_loader)
+            train_loss, train_acc, train_auc = self.train_loop(self.train_loader, epoch)
             print('\rTrain Epoch: {}, train_loss: {:.4f}, train_acc: {:.4f}, train_auc: {:.4f}                 '.format(
                 epoch, train_loss, train_acc, train_auc))
             result_dict['train_loss'].append(train_loss)
             result_dict['train_acc'].append(train_acc)
             result_dict['train_auc'].append(train_auc)
 
-            valid_loss, valid_acc, valid_auc = self.valid_loop(self.valid_loader)
-            print('\rValid Epoch: {}, valid_loss: {:.4f}, valid_acc: {:.4f}, valid_auc: {:.4f}                 '.format(
-                epoch, valid_loss, valid_acc, valid_auc))
-            result_dict['valid_loss'].append(valid_loss)
-            result_dict['valid_acc'].append(valid_acc)
-            result_dict['valid_auc'].append(valid_auc)
-
-            if self.lowest_loss > valid_loss:
-                print('--------------------Saving best model--------------------')
-                torch.save(self.model.state_dict(), os.path.join(self.args.results_dir, 'checkpoint.pt'))
-                self.lowest_loss = valid_loss
-                self.counter = 0
+            if validator is None:
+                valid_loss, valid_acc, valid_auc = self.valid_loop(self.valid_loader)
+                stop = self.reconcile_valid(epoch, valid_loss, valid_acc, valid_auc, self.model.state_dict(), result_dict)
             else:
-                self.counter += 1
-                print('Loss is not decreased in last %d epochs' % self.counter)
+                # epoch e is validated while e+1 trains; decide on e-1 now
+                validator.submit(epoch, self.model.state_dict())
+                stop = epoch > 0 and self.reconcile_valid(*validator.get(), result_dict)
 
-            if (self.counter > self.args.patience) and (epoch >= self.args.minimum_epochs):
+            if stop:
                 break
 
             total_time = time.time() - start_time
             print('Time to process epoch({}): {:.4f} minutes                             \n'.format(epoch, total_time/60))
-            pd.DataFrame.from_dict(result_dict).to_csv(os.path.join(self.args.results_dir, 'training_stats.csv'))
+            self.save_training_stats(result_dict)
+
+        if validator is not None:
+            for valid_result in validator.close():
+                self.reconcile_valid(*valid_result, result_dict)
+            self.save_training_stats(result_dict)
+        get_checkpoint_writer().flush()
+
+    def reconcile_valid(self, epoch, valid_loss, valid_acc, valid_auc, state_dict, result_dict):
+        """Book-keeping for one validated epoch; returns True to stop early."""
+        print('\rValid Epoch: {}, valid_loss: {:.4f}, valid_acc: {:.4f}, valid_auc: {:.4f}                 '.format(
+            epoch, valid_loss, valid_acc, valid_auc))
+        result_dict['valid_loss'].append(valid_loss)
+        result_dict['valid_acc'].append(valid_acc)
+        result_dict['valid_auc'].append(valid_auc)
+
+        if self.lowest_loss > valid_loss:
+            print('--------------------Saving best model--------------------')
+            get_checkpoint_writer().save(state_dict, os.path.join(self.args.results_dir, 'checkpoint.pt'))
+            self.lowest_loss = valid_loss
+            self.counter = 0
+        else:
+            self.counter += 1
+            print('Loss is not decreased in last %d epochs' % self.counter)
+
+        return (self.counter > self.args.patience) and (epoch >= self.args.minimum_epochs)
+
+    def save_training_stats(self, result_dict):
+        # with asynchronous validation the valid columns lag one epoch behind
+        df = pd.DataFrame({key: pd.Series(value, dtype=float) for key, value in result_dict.items()})
+        df.to_csv(os.path.join(self.args.results_dir, 'training_stats.csv'))
 
     def eval(self, split_name='test'):
         self.set_seed()
@@ -135,9 +170,11 @@ class Tumor_origin:
 
 
         dataset = MultiModalDataset(self.args.gt_csv, self.args.test_csv, self.args.label_dict,self.args.histology_feature_path,
-                                    split_name=split_name)
+                                    split_name=split_name, feature_suffix=self.args.feature_suffix)
+        if self.args.preload:
+            MultiModalDataset.preload([dataset])
 
-        dataset_loader = MultiModalDataset.get_data_loader(dataset, batch_size=self.args.batch_size, training=False)
+        dataset_loader = MultiModalDataset.get_data_loader(dataset, batch_size=self.args.batch_size, training=False, **self.loader_options())
 
         self.init_model()
         self.load_model()
@@ -147,130 +184,114 @@ class Tumor_origin:
         classifier_name = 'Toumor_origin'
         os.makedirs(os.path.join(self.args.results_dir, classifier_name), exist_ok=True)
         save_pkl(os.path.join(self.args.results_dir, classifier_name, '%s.pkl' % split_name), stats_dict)
+        if self.args.n_bootstrap > 0:
+            gt_labels = np.asarray(stats_dict['gt_labels'])
+            pred_probs = stats_dict['pred_probs']
+            ci_rows = [bootstrap_ci('accuracy', gt_labels, np.argmax(pred_probs, axis=1),
+                                    n_resamples=self.args.n_bootstrap, seed=self.args.seed, n_jobs=self.args.n_jobs),
+                       bootstrap_ci('auc_ovo', gt_labels, pred_probs,
+                                    n_resamples=self.args.n_bootstrap, seed=self.args.seed, n_jobs=self.args.n_jobs)]
+            save_bootstrap_ci(ci_rows, os.path.join(self.args.results_dir, classifier_name),
+                              file_name='%s_bootstrap_ci.csv' % split_name)
         return acc, auc
 
-    def train_loop(self, data_loader):
-        total_loss = 0
-        gt_labels = []
-        pred_labels = []
-        pred_probs = None
+    def precision_report(self):
+        """Accuracy/AUC of the trained checkpoint in fp32 and bf16 on the
+        bundled train/valid/test csv splits."""
+        self.set_seed()
+        self.init_model()
+        self.load_model()
+        rows = []
+        for split_name, split_csv in [('train', self.args.train_csv), ('valid', self.args.val_csv), ('test', self.args.test_csv)]:
+            dataset = MultiModalDataset(self.args.gt_csv, split_csv, self.args.label_dict, self.args.histology_feature_path,
+                                        split_name=split_name, feature_suffix=self.args.feature_suffix)
+            if self.args.preload:
+                MultiModalDataset.preload([dataset])
+            dataset_loader = MultiModalDataset.get_data_loader(dataset, batch_size=self.args.batch_size, training=False, **self.loader_options())
+            acc_32, auc_32, stats_32 = self.test_loop(dataset_loader, precision='fp32')
+            acc_16, auc_16, stats_16 = self.test_loop(dataset_loader, precision='bf16')
+            rows.append({'split': split_name,
+                         'acc_fp32': acc_32, 'acc_bf16': acc_16, 'acc_delta': acc_16 - acc_32,
+                         'auc_fp32': auc_32, 'auc_bf16': auc_16, 'auc_delta': auc_16 - auc_32,
+                         'max_prob_diff': np.abs(stats_16['pred_probs'] - stats_32['pred_probs']).max(),
+                         'pred_agreement': (stats_16['pred_probs'].argmax(1) == stats_32['pred_probs'].argmax(1)).mean()})
+        df = pd.DataFrame(rows)
+        print()
+        print(df)
+        df.to_csv(os.path.join(self.args.results_dir, 'precision_report.csv'), index=False)
+        return df
+
+    def train_loop(self, data_loader, epoch=0):
         batch_count = len(data_loader)
+        metrics = MetricsAccumulator(len(data_loader.dataset), self.args.n_classes, self.device)
+        full_epoch = self.pruner.is_full_epoch(epoch)
         self.model.train()
-        for batch_idx, (h_features_batch, label_batch, _) in enumerate(data_loader):
-            if len(gt_labels) == 0:
-                gt_labels = label_batch.cpu().numpy().tolist()
-            else:
-                gt_labels.extend(label_batch.cpu().numpy().tolist())
+        for batch_idx, (h_features_batch, label_batch, case_batch) in enumerate(data_loader):
+            keep_ids = None
+            if not full_epoch:
+                # pruning assumes one bag per batch, as does the model's squeeze(0)
+                keep_ids = self.pruner.select(case_batch[0], h_features_batch.shape[1])
+                if keep_ids is not None:
+                    h_features_batch = h_features_batch[:, keep_ids]
 
             h_features_batch = h_features_batch.to(self.device)
-            label_batch = label_batch.to(self.device)
-            logits, probs = self.model(h_features_batch)
+            label_batch = label_batch.to(self.device, non_blocking=True)
+            with autocast_context(self.args.precision, self.device):
+                logits, probs, attention_raw = self.model(h_features_batch, return_attention=True)
+
+            if self.pruner.enabled and keep_ids is None:
+                self.pruner.record(case_batch[0], attention_raw)
 
-            # else:
-            probs = probs
-            loss = self.loss_fn(logits, label_batch)
+            loss = self.loss_fn(logits.float(), label_batch)
 
             loss.backward()
             self.optimizer.step()
             self.optimizer.zero_grad()
 
-            total_loss += loss.cpu().item()
+            metrics.update(logits, label_batch, loss)
 
-            p_labels = torch.argmax(probs, dim=1)
-            p_labels = p_labels.detach().cpu().numpy().tolist()
-            p_probs = probs.detach().cpu().numpy()
+            sys.stdout.write('\rTraining Batch {}/{}'.format(batch_idx+1, batch_count))
 
-            if len(pred_labels) == 0:
-                pred_probs = p_probs
-                pred_labels = p_labels
-            else:
-                pred_probs = np.concatenate((pred_probs, p_probs), axis=0)
-                pred_labels.extend(p_labels)
-
-            sys.stdout.write('\rTraining Batch {}/{}, avg loss: {:.4f}'.format(
-                batch_idx+1, batch_count, total_loss/(batch_idx+1)))
-
-        acc = accuracy_score(gt_labels, pred_labels)
-        auc = roc_auc_score(gt_labels, pred_probs, multi_class='ovo', labels=[class_id for class_id in range(pred_probs.shape[1])])
-        return total_loss/batch_count, acc, auc
+        return metrics.compute()
 
     def valid_loop(self, data_loader):
-        total_loss = 0
-        gt_labels = []
-        pred_labels = []
-        pred_probs = None
         batch_count = len(data_loader)
+        metrics = MetricsAccumulator(len(data_loader.dataset), self.args.n_classes, self.device)
         self.model.eval()
         with torch.no_grad():
             for batch_idx, ( h_features_batch, label_batch, _) in enumerate(data_loader):
-                if len(gt_labels) == 0:
-                    gt_labels = label_batch.cpu().numpy().tolist()
-                else:
-                    gt_labels.extend(label_batch.cpu().numpy().tolist())
-
                 h_features_batch = h_features_batch.to(self.device)
+                label_batch = label_batch.to(self.device, non_blocking=True)
+                with autocast_context(self.args.precision, self.device):
+                    logits, probs = self.model(h_features_batch)
 
-                label_batch = label_batch.to(self.device)
-                logits, probs = self.model(h_features_batch)
-
-                probs = probs
-                loss = self.loss_fn(logits, label_batch)
+                loss = self.loss_fn(logits.float(), label_batch)
 
-                total_loss += loss.cpu().item()
+                metrics.update(logits, label_batch, loss)
 
-                p_labels = torch.argmax(probs, dim=1)
-                p_labels = p_labels.detach().cpu().numpy().tolist()
-                p_probs = probs.detach().cpu().numpy()
+                sys.stdout.write('\rValidation Batch {}/{}'.format(batch_idx + 1, batch_count))
 
-                if len(pred_labels) == 0:
-                    pred_probs = p_probs
-                    pred_labels = p_labels
-                else:
-                    pred_probs = np.concatenate((pred_probs, p_probs), axis=0)
-                    pred_labels.extend(p_labels)
+        return metrics.compute()
 
-                sys.stdout.write('\rValidation Batch {}/{}, avg loss: {:.4f}'.format(
-                    batch_idx + 1, batch_count, total_loss / (batch_idx + 1)))
-
-        acc = accuracy_score(gt_labels, pred_labels)
-        auc = roc_auc_score(gt_labels, pred_probs, multi_class='ovo', labels=[class_id for class_id in range(pred_probs.shape[1])])
-        return total_loss / batch_count, acc, auc
-
-    def test_loop(self, data_loader):
-        gt_labels = []
-        pred_labels = []
-        pred_probs = None
+    def test_loop(self, data_loader, precision=None):
+        precision = precision or self.args.precision
         case_list = []
         batch_count = len(data_loader)
+        metrics = MetricsAccumulator(len(data_loader.dataset), self.args.n_classes, self.device)
         self.model.eval()
         with torch.no_grad():
             for batch_idx, (h_features_batch, label_batch, case_batch) in enumerate(data_loader):
-                if len(gt_labels) == 0:
-                    gt_labels = label_batch.numpy().tolist()
-                    case_list = list(case_batch)
-                else:
-                    gt_labels.extend(label_batch.numpy().tolist())
-                    case_list.extend(list(case_batch))
-
+                case_list.extend(list(case_batch))
 
                 h_features_batch = h_features_batch.to(self.device)
-                logits, probs = self.model(h_features_batch)
-                probs = probs
-
-                p_labels = torch.argmax(probs, dim=1)
-                p_labels = p_labels.detach().cpu().numpy().tolist()
-                p_probs = probs.detach().cpu().numpy()
+                label_batch = label_batch.to(self.device, non_blocking=True)
+                with autocast_context(precision, self.device):
+                    logits, probs = self.model(h_features_batch)
 
-                if len(pred_labels) == 0:
-                    pred_probs = p_probs
-                    pred_labels = p_labels
-                else:
-                    pred_probs = np.concatenate((pred_probs, p_probs), axis=0)
-                    pred_labels.extend(p_labels)
+                metrics.update(logits, label_batch)
 
                 sys.stdout.write('\rTest Batch {}/{}'.format(batch_idx + 1, batch_count))
 
-        acc = accuracy_score(gt_labels, pred_labels)
-        auc = roc_auc_score(gt_labels, pred_probs, multi_class='ovo', labels=[class_id for class_id in range(pred_probs.shape[1])])
-        stats_dict = {'case_names': case_list, 'gt_labels': gt_labels, 'pred_probs': pred_probs}
-        return acc, auc, stats_dict
\ No newline at end of file
+        _, acc, auc = metrics.compute()
+        stats_dict = {'case_names': case_list, 'gt_labels': metrics.gt_labels().tolist(), 'pred_probs': metrics.probs()}
+        return acc, auc, stats_dict
@@ -2,11 +2,46 @@ import torch
 import numpy as np
 import pandas as pd
 import random
-from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler, SequentialSampler
-import os
+from torch.utils.data import Dataset, WeightedRandomSampler, SequentialSampler
+from loader_utils import build_dataloader
+from manifest import BagManifest
+from file_utils import bag_shape, load_bag
+
+class SharedBagPool:
+    """Every bag of a cohort in one contiguous shared-memory buffer.
+
+    Bags are loaded once in the parent process; worker processes receive the
+    pool through torch.multiprocessing and read zero-copy views via `get`, the
+    same interface as `BagCache`.
+    """
+    def __init__(self, paths):
+        self.paths = list(dict.fromkeys(paths))
+        self.index = {path: i for i, path in enumerate(self.paths)}
+        # sizes first, then one bag at a time: peak memory is the buffer plus one bag
+        shapes = [bag_shape(path) for path in self.paths]
+        self.offsets = np.cumsum([0] + [shape[0] for shape, _ in shapes]).tolist()
+        if not shapes:
+            self.buffer = torch.empty(0).share_memory_()
+            return
+        row_shape, dtype = shapes[0][0][1:], shapes[0][1]
+        self.buffer = torch.empty((int(self.offsets[-1]),) + row_shape, dtype=dtype).share_memory_()
+        for i, path in enumerate(self.paths):
+            self.buffer[self.offsets[i]:self.offsets[i + 1]].copy_(load_bag(path))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def get(self, path):
+        i = self.index[path]
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]]
+
 
 class MultiModalDataset(Dataset):
-    def __init__(self, gt_csv, split_csv, label_dict,histology_features, split_name='train', site_name=None, balance_met=False):
+    def __init__(self, gt_csv, split_csv, label_dict,histology_features, split_name='train', site_name=None, balance_met=False, bag_pool=None, feature_suffix='.pt'):
+        self.bag_pool = bag_pool
         self.label_dict = label_dict
         self.balance_met = balance_met
         self.split_name = split_name
@@ -14,18 +49,12 @@ class MultiModalDataset(Dataset):
         self.balance_met = balance_met
         self.histology_features=histology_features
 
-        self.x = []
-        self.labels = []
-        self.pro_labels = []
-
         gt_df = pd.read_csv(split_csv)
 
-        for i, row in gt_df.iterrows():
-            self.x.append(row['case_id'])
-            self.labels.append(self.label_dict[row['label']])
-
-            self.pro_labels.append(row['site'])
-
+        self.x = gt_df['case_id'].astype(str).tolist()
+        self.labels = [self.label_dict[label] for label in gt_df['label']]
+        self.pro_labels = gt_df['site'].tolist()
+        self.manifest = BagManifest.from_dir(self.x, histology_features, labels=self.labels, suffix=feature_suffix)
 
 
     def case_level_dataset(self, gt_df, case_list, genomic_features, histology_features):
@@ -65,7 +94,19 @@ class MultiModalDataset(Dataset):
         return pd.DataFrame(class_counts, index=row_labels, columns=[col_name])
 
     @staticmethod
-    def get_data_loader(dataset, batch_size=4, training=False):
+    def preload(datasets):
+        """Loads the bags of all `datasets` once into one SharedBagPool that
+        they share; loaders then read views of it instead of torch.load."""
+        bag_pool = SharedBagPool([dataset.get_feature_path(i) for dataset in datasets for i in range(len(dataset.x))])
+        for dataset in datasets:
+            dataset.bag_pool = bag_pool
+        return bag_pool
+
+    @staticmethod
+    def get_data_loader(dataset, batch_size=4, training=False, num_workers=4, **loader_kwargs):
+        # preloaded bags are already in memory: workers would only copy them
+        if dataset.bag_pool is not None:
+            num_workers = 0
         if training:
             n = float(len(dataset))
             weight = [0] * int(n)
@@ -91,12 +132,17 @@ class MultiModalDataset(Dataset):
                     weight[idx] = weight_per_class[label]
 
             weight = torch.DoubleTensor(weight)
-            loader = DataLoader(dataset, batch_size=batch_size, sampler=WeightedRandomSampler(weight, len(weight)), drop_last=True, num_workers=4)
+            loader = build_dataloader(dataset, batch_size=batch_size, sampler=WeightedRandomSampler(weight, len(weight)), drop_last=True,
+                                      num_workers=num_workers, name=dataset.split_name, **loader_kwargs)
         else:
-            loader = DataLoader(dataset, batch_size=batch_size, sampler=SequentialSampler(dataset), drop_last=False, num_workers=4)
+            loader = build_dataloader(dataset, batch_size=batch_size, sampler=SequentialSampler(dataset), drop_last=False,
+                                      num_workers=num_workers, name=dataset.split_name, **loader_kwargs)
 
         return loader
 
+    def get_feature_path(self, idx):
+        return self.manifest.paths[idx]
+
     def __len__(self):
         print(11,len(self.x))
 
@@ -106,11 +152,12 @@ class MultiModalDataset(Dataset):
 
 
         case_id, label,tmp_pro = self.x[idx], self.labels[idx],self.pro_labels[idx]
-        full_path = os.path.join(self.histology_features, case_id + '.pt')
-
+        full_path = self.manifest.paths[idx]
 
-
-        h_features = torch.load(full_path)
+        if self.bag_pool is not None:
+            h_features = self.bag_pool.get(full_path)
+        else:
+            h_features = load_bag(full_path)
         new_tensor = h_features
 
 
@@ -1,5 +1,11 @@
+import atexit
+import collections
+import os
 import pickle
+import threading
 import h5py
+import numpy as np
+import torch
 
 
 def save_pkl(filename, save_object):
@@ -19,7 +25,8 @@ def save_hdf5(output_path, asset_dict, attr_dict= None, mode='a'):
         data_shape = val.shape
         if key not in file:
             data_type = val.dtype
-            chunk_shape = (1, ) + data_shape[1:]
+            # resizable along rows: size chunks for the whole bag, not the first append
+            chunk_shape = (hdf5_chunk_rows(data_shape[1:], data_type.itemsize), ) + data_shape[1:]
             maxshape = (None, ) + data_shape[1:]
             dset = file.create_dataset(key, shape=data_shape, maxshape=maxshape, chunks=chunk_shape, dtype=data_type)
             dset[:] = val
@@ -32,4 +39,339 @@ def save_hdf5(output_path, asset_dict, attr_dict= None, mode='a'):
             dset.resize(len(dset) + data_shape[0], axis=0)
             dset[-data_shape[0]:] = val
     file.close()
-    return output_path
\ No newline at end of file
+    return output_path
+
+
+def hdf5_chunk_rows(row_shape, itemsize, target_bytes=1 << 20):
+    """Rows per chunk so that one chunk holds about `target_bytes`."""
+    row_bytes = int(np.prod(row_shape, dtype=np.int64)) * itemsize
+    return max(1, target_bytes // max(row_bytes, 1))
+
+
+class SpatialIndex:
+    """Uniform grid over per-patch (x, y, level) coordinates.
+
+    Row ids are sorted by grid cell, so a cell is one contiguous run of
+    `order`; region and neighborhood queries visit only the cells they overlap
+    and return sorted row ids that can be passed straight to HDF5BagReader.
+    """
+    def __init__(self, coords, cell_size=4096, order=None, cell_keys=None, cell_offsets=None):
+        self.coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        self.cell_size = int(cell_size)
+        if order is None:
+            keys = self._keys(self.coords[:, 0] // self.cell_size, self.coords[:, 1] // self.cell_size, self.coords[:, 2])
+            order = np.argsort(keys, kind='stable')
+            cell_keys, starts = np.unique(keys[order], return_index=True)
+            cell_offsets = np.append(starts, len(keys))
+        self.order = np.asarray(order, dtype=np.int64)
+        self.cell_keys = np.asarray(cell_keys, dtype=np.int64)
+        self.cell_offsets = np.asarray(cell_offsets, dtype=np.int64)
+
+    @staticmethod
+    def _keys(gx, gy, level):
+        # level | gy | gx packed in 10 | 26 | 26 bits
+        return (np.asarray(level, dtype=np.int64) << 52) | (np.asarray(gy, dtype=np.int64) << 26) | np.asarray(gx, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def query(self, x0, y0, x1, y1, level=0):
+        """Rows of the patches with x0 <= x < x1 and y0 <= y < y1 at `level`."""
+        if x1 <= x0 or y1 <= y0 or len(self.coords) == 0:
+            return np.zeros(0, dtype=np.int64)
+        gx = np.arange(max(x0, 0) // self.cell_size, (x1 - 1) // self.cell_size + 1)
+        gy = np.arange(max(y0, 0) // self.cell_size, (y1 - 1) // self.cell_size + 1)
+        keys = self._keys(gx[None, :], gy[:, None], level).ravel()
+        pos = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        pos = pos[self.cell_keys[pos] == keys]
+        if len(pos) == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([self.order[self.cell_offsets[p]:self.cell_offsets[p + 1]] for p in pos])
+        c = self.coords[rows]
+        inside = (c[:, 0] >= x0) & (c[:, 0] < x1) & (c[:, 1] >= y0) & (c[:, 1] < y1)
+        return np.sort(rows[inside])
+
+    def neighbors(self, x, y, radius, level=0):
+        """Rows of the patches within `radius` of (x, y), nearest first."""
+        rows = self.query(x - radius, y - radius, x + radius + 1, y + radius + 1, level)
+        d2 = ((self.coords[rows, :2] - np.array([x, y])) ** 2).sum(axis=1)
+        keep = d2 <= radius * radius
+        return rows[keep][np.argsort(d2[keep], kind='stable')]
+
+    def save(self, file, name='spatial_index'):
+        if name in file:
+            del file[name]
+        group = file.create_group(name)
+        group.attrs['cell_size'] = self.cell_size
+        group.create_dataset('order', data=self.order)
+        group.create_dataset('cell_keys', data=self.cell_keys)
+        group.create_dataset('cell_offsets', data=self.cell_offsets)
+
+    @classmethod
+    def load(cls, file, coords, name='spatial_index'):
+        group = file[name]
+        return cls(coords, group.attrs['cell_size'], group['order'][:], group['cell_keys'][:], group['cell_offsets'][:])
+
+
+class HDF5BagWriter:
+    """Streams the patch features of one bag (and optionally their
+    coordinates) into an HDF5 file that stays open until `close`.
+
+    Rows are buffered and written a whole chunk at a time; chunks are row
+    blocks of about 1 MiB, so appends and row-range reads touch few chunks.
+    Opened with mode='a' on an existing bag, it continues appending to it.
+    With coordinates, a SpatialIndex with cells of `cell_size` pixels is
+    stored next to them on close.
+    """
+    def __init__(self, path, feature_dim=768, dtype='float32', chunk_rows=None, compression=None,
+                 with_coords=False, mode='w', cell_size=4096):
+        self.path = path
+        self.cell_size = cell_size
+        self.file = h5py.File(path, mode)
+        dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows or hdf5_chunk_rows((feature_dim,), dtype.itemsize)
+        if 'features' in self.file:
+            self.features = self.file['features']
+        else:
+            self.features = self.file.create_dataset('features', shape=(0, feature_dim), maxshape=(None, feature_dim),
+                                                     chunks=(self.chunk_rows, feature_dim), dtype=dtype,
+                                                     compression=compression, shuffle=compression is not None)
+        self.coords = None
+        if 'coords' in self.file:
+            self.coords = self.file['coords']
+        elif with_coords:
+            # (x, y, level) per patch
+            self.coords = self.file.create_dataset('coords', shape=(0, 3), maxshape=(None, 3),
+                                                   chunks=(self.chunk_rows * 16, 3), dtype='int32',
+                                                   compression=compression)
+        self._features = []
+        self._coords = []
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.features) + self._buffered
+
+    def append(self, features, coords=None):
+        if torch.is_tensor(features):
+            features = features.detach().cpu().numpy()
+        features = np.asarray(features, dtype=self.features.dtype).reshape(-1, self.features.shape[1])
+        if self.coords is not None:
+            if coords is None:
+                raise ValueError('this bag stores coordinates: append(features, coords)')
+            if torch.is_tensor(coords):
+                coords = coords.cpu().numpy()
+            self._coords.append(np.asarray(coords, dtype=np.int32).reshape(-1, 3))
+        self._features.append(features)
+        self._buffered += len(features)
+        if self._buffered >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self._buffered == 0:
+            return
+        n = len(self.features)
+        self.features.resize(n + self._buffered, axis=0)
+        self.features[n:] = np.concatenate(self._features)
+        if self.coords is not None:
+            self.coords.resize(n + self._buffered, axis=0)
+            self.coords[n:] = np.concatenate(self._coords)
+        self._features, self._coords, self._buffered = [], [], 0
+
+    def close(self):
+        if self.file.id.valid:
+            self.flush()
+            if self.coords is not None:
+                SpatialIndex(self.coords[:], self.cell_size).save(self.file)
+            self.file.close()
+
+
+class HDF5BagReader:
+    """Random access to a bag written by HDF5BagWriter (or save_hdf5 with a
+    'features' dataset) without loading the whole bag."""
+    def __init__(self, path):
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.features = self.file['features']
+        self.coords = self.file['coords'] if 'coords' in self.file else None
+        self._spatial_index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.features)
+
+    def _read(self, dset, rows):
+        if rows is None:
+            return dset[:]
+        if isinstance(rows, slice):
+            return dset[rows]
+        # h5py point selections must be increasing: read sorted, restore order
+        rows = np.asarray(rows, dtype=np.int64)
+        unique, inverse = np.unique(rows, return_inverse=True)
+        return dset[unique][inverse]
+
+    def read(self, rows=None):
+        """Features of `rows` (None: all, a slice, or an index array) as a tensor."""
+        return torch.from_numpy(self._read(self.features, rows))
+
+    def read_coords(self, rows=None):
+        if self.coords is None:
+            raise KeyError(f'{self.path} has no coordinates')
+        return self._read(self.coords, rows)
+
+    @property
+    def spatial_index(self):
+        if self._spatial_index is None:
+            coords = self.read_coords()
+            if 'spatial_index' in self.file:
+                self._spatial_index = SpatialIndex.load(self.file, coords)
+            else:
+                self._spatial_index = SpatialIndex(coords)
+        return self._spatial_index
+
+    def read_region(self, x0, y0, x1, y1, level=0):
+        """(rows, features, coords) of the patches inside a bounding box; only
+        those rows are read from disk."""
+        rows = self.spatial_index.query(x0, y0, x1, y1, level)
+        return rows, self.read(rows), self.spatial_index.coords[rows]
+
+    def read_neighbors(self, x, y, radius, level=0):
+        """(rows, features, coords) of the patches within `radius` of (x, y),
+        nearest first."""
+        rows = self.spatial_index.neighbors(x, y, radius, level)
+        return rows, self.read(rows), self.spatial_index.coords[rows]
+
+    def close(self):
+        if self.file.id.valid:
+            self.file.close()
+
+
+def load_bag(path):
+    """All features of a bag saved with torch.save (.pt) or as HDF5 (.h5)."""
+    if path.endswith('.h5'):
+        with HDF5BagReader(path) as reader:
+            return reader.read()
+    return torch.load(path, map_location=torch.device('cpu'))
+
+
+def bag_shape(path):
+    """(shape, dtype) of a bag without keeping its features in memory: HDF5
+    metadata, or a memory-mapped .pt (a full load on torch < 2.1 or for
+    legacy-format files)."""
+    if path.endswith('.h5'):
+        with h5py.File(path, 'r') as f:
+            features = f['features']
+            return tuple(features.shape), torch.from_numpy(np.empty(0, dtype=features.dtype)).dtype
+    try:
+        bag = torch.load(path, map_location=torch.device('cpu'), mmap=True)
+    except (TypeError, RuntimeError):
+        bag = torch.load(path, map_location=torch.device('cpu'))
+    return tuple(bag.shape), bag.dtype
+
+
+def snapshot_state(obj):
+    """Staging copy of a (nested) state dict: tensors are copied to CPU so the
+    caller can keep training while the copy is written."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_state(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    return obj
+
+def atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread.
+
+    Jobs are keyed (by default on the target path); a job submitted while an
+    older one with the same key is still queued replaces it, so only the
+    newest state is written. Every file is written to a temporary name and
+    renamed, so a crash never leaves a truncated checkpoint. Pending jobs are
+    flushed by `flush`, on interpreter exit and when used as a context manager.
+    """
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def submit(self, key, write_fn, *args):
+        with self.cond:
+            self._raise_error()
+            self.pending[key] = (write_fn, args)
+            self.cond.notify_all()
+
+    def save(self, obj, path):
+        self.submit(path, atomic_save, snapshot_state(obj), path)
+
+    def flush(self):
+        with self.cond:
+            while self.pending or self.busy:
+                self.cond.wait()
+            self._raise_error()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            print(f'CheckpointWriter: last write failed: {self.error!r}')
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                _, (write_fn, args) = self.pending.popitem(last=False)
+                self.busy = True
+            try:
+                write_fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+_checkpoint_writer = None
+
+def get_checkpoint_writer():
+    global _checkpoint_writer
+    if _checkpoint_writer is None:
+        _checkpoint_writer = CheckpointWriter()
+    return _checkpoint_writer
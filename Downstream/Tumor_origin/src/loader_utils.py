@@ -0,0 +1,148 @@
+import json
+import os
+import socket
+import time
+from functools import partial
+
+import torch
+from torch.utils.data import DataLoader, Sampler, RandomSampler, SequentialSampler
+
+
+class ReadAheadSampler(Sampler):
+    """Yields the indices of `sampler` unchanged, and keeps the feature files of
+    the next `depth` indices hinted to the kernel (POSIX_FADV_WILLNEED). Each
+    new window is hinted in inode order, which follows the on-disk layout of the
+    feature directory, so the device sees mostly sequential reads while the
+    loader still consumes bags in the requested order."""
+    def __init__(self, sampler, dataset, depth=8):
+        self.sampler = sampler
+        self.dataset = dataset
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def _hint(self, indices):
+        files = []
+        for idx in indices:
+            path = self.dataset.get_feature_path(idx)
+            try:
+                files.append((os.stat(path).st_ino, path))
+            except OSError:
+                continue  # reported by the dataset when it is read
+        for _, path in sorted(files):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+    def __iter__(self):
+        order = list(self.sampler)
+        if not hasattr(os, 'posix_fadvise'):
+            yield from order
+            return
+        hinted = 0
+        for pos, idx in enumerate(order):
+            if hinted <= pos:
+                hinted = min(pos + self.depth, len(order))
+                self._hint(order[pos:hinted])
+            yield idx
+
+
+class TimedLoader:
+    """Wraps a DataLoader and reports, after each pass, how long the consumer
+    was blocked waiting for the next batch."""
+    def __init__(self, loader, name='loader', verbose=True):
+        self.loader = loader
+        self.name = name
+        self.verbose = verbose
+        self.wait_time = 0.
+        self.total_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, item):
+        return getattr(self.loader, item)
+
+    def __iter__(self):
+        wait = 0.
+        start = time.perf_counter()
+        iterator = iter(self.loader)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            wait += time.perf_counter() - t0
+            yield batch
+        self.wait_time = wait
+        self.total_time = time.perf_counter() - start
+        if self.verbose:
+            print('\n{}: waited {:.2f}s for data in {:.2f}s ({:.1f}%)'.format(
+                self.name, wait, self.total_time, 100 * wait / max(self.total_time, 1e-9)))
+
+
+def _init_loader_worker(worker_id, affinity=False):
+    if affinity and hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, [cpus[worker_id % len(cpus)]])
+
+
+def build_dataloader(dataset, batch_size=None, shuffle=False, sampler=None, drop_last=False, num_workers=0,
+                     persistent_workers=True, prefetch_factor=2, pin_memory=False, worker_affinity=False,
+                     read_ahead=0, name='loader'):
+    """DataLoader with the options shared by every entry point, wrapped in a
+    TimedLoader. `read_ahead` > 0 hints that many upcoming feature files to the
+    kernel (needs dataset.get_feature_path)."""
+    if sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    if read_ahead > 0 and hasattr(dataset, 'get_feature_path'):
+        sampler = ReadAheadSampler(sampler, dataset, read_ahead)
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = dict(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor,
+                      worker_init_fn=partial(_init_loader_worker, affinity=worker_affinity))
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, drop_last=drop_last,
+                        num_workers=num_workers, pin_memory=pin_memory and torch.cuda.is_available(), **kwargs)
+    return TimedLoader(loader, name)
+
+
+def host_profile_path():
+    """$CHIEF_HOST_PROFILE, else ~/.chief/<hostname>.json (written by Get_CHIEF_autotune.py)."""
+    return os.environ.get('CHIEF_HOST_PROFILE') or os.path.join(
+        os.path.expanduser('~'), '.chief', socket.gethostname() + '.json')
+
+
+def load_host_profile(path=None):
+    """The autotuned settings of this host, {} when it has not been tuned."""
+    path = path or host_profile_path()
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_host_profile(profile=None):
+    """Sets the intra-/inter-op thread counts of the host profile; entry points
+    call it before any other torch work. Returns the profile."""
+    profile = load_host_profile() if profile is None else profile
+    if profile.get('intra_op_threads'):
+        torch.set_num_threads(profile['intra_op_threads'])
+    if profile.get('inter_op_threads'):
+        try:
+            torch.set_num_interop_threads(profile['inter_op_threads'])
+        except RuntimeError:
+            pass  # the inter-op pool has already started in this process
+    return profile
+
+
+def host_setting(value, key, default=0, profile=None):
+    """`value`, unless it is missing or 'auto': then the host profile's `key`,
+    else `default`."""
+    if value is not None and value != 'auto' and value != {}:
+        return value
+    profile = load_host_profile() if profile is None else profile
+    return profile.get(key, default)
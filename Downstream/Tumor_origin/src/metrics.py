@@ -0,0 +1,46 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from bootstrap import accuracy, auc_ovo
+
+
+class MetricsAccumulator:
+    """Epoch-level classification metrics without per-batch host syncs.
+
+    Logits, labels and the running loss stay in buffers preallocated on the
+    model device and sized to the dataset; accuracy and OvO AUC are computed
+    once, in `compute`, after a single device-to-host copy.
+    """
+    def __init__(self, n_samples, n_classes, device):
+        self.logits = torch.empty((n_samples, n_classes), dtype=torch.float32, device=device)
+        self.labels = torch.empty(n_samples, dtype=torch.long, device=device)
+        self.loss_sum = torch.zeros((), dtype=torch.float32, device=device)
+        self.n_samples = 0
+        self.n_batches = 0
+
+    def update(self, logits, labels, loss=None):
+        batch_size = logits.shape[0]
+        end = self.n_samples + batch_size
+        self.logits[self.n_samples:end].copy_(logits.detach())
+        self.labels[self.n_samples:end].copy_(labels, non_blocking=True)
+        if loss is not None:
+            self.loss_sum += loss.detach()
+        self.n_samples = end
+        self.n_batches += 1
+
+    def probs(self):
+        return F.softmax(self.logits[:self.n_samples], dim=1).cpu().numpy()
+
+    def gt_labels(self):
+        return self.labels[:self.n_samples].cpu().numpy()
+
+    def compute(self):
+        """Returns (avg batch loss, accuracy, OvO AUC)."""
+        probs = self.probs()
+        labels = self.gt_labels()
+        ones = np.ones((1, len(labels)))
+        acc = accuracy(labels, np.argmax(probs, axis=1), ones)[0]
+        auc = auc_ovo(labels, probs, ones)[0]
+        loss = self.loss_sum.item() / max(self.n_batches, 1)
+        return loss, acc, auc
@@ -1,7 +1,11 @@
+import contextlib
+import functools
+import inspect
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 def initialize_weights(module):
     for m in module.modules():
@@ -20,6 +24,60 @@ def init_max_weights(module):
             m.weight.data.normal_(0, stdv)
             m.bias.data.zero_()
 
+def autocast_context(precision='fp32', device=torch.device('cpu')):
+    """Mixed precision for the aggregator forward pass. 'bf16' runs the
+    linear layers in bfloat16 (AMX/AVX512-BF16 on recent CPUs); softmax and
+    losses are kept in fp32 by the callers. 'fp32' is a no-op."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision == 'bf16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    raise NotImplementedError(precision)
+
+
+# torch < 1.11 has no use_reentrant keyword: only the reentrant checkpoint
+REENTRANT_CHECKPOINT_ONLY = 'use_reentrant' not in inspect.signature(checkpoint).parameters
+
+
+def _pool_chunk(attention_net, h):
+    A, h = attention_net(h)  # n x 1, n x D
+    A = A.float()
+    m = A.max()
+    S = torch.mm(torch.exp(A - m.detach()).t(), h)  # 1 x D, softmax numerator of the chunk
+    return A, S, m
+
+
+def _checkpoint_chunk(attention_net, h_chunk):
+    if not torch.is_grad_enabled():
+        return _pool_chunk(attention_net, h_chunk)
+    if not REENTRANT_CHECKPOINT_ONLY:
+        return checkpoint(_pool_chunk, attention_net, h_chunk, use_reentrant=False)
+    # the reentrant checkpoint takes tensor inputs only, and the weights of
+    # attention_net get gradients only if one of them requires grad
+    if not h_chunk.requires_grad:
+        h_chunk = h_chunk.detach().requires_grad_()
+    return checkpoint(functools.partial(_pool_chunk, attention_net), h_chunk)
+
+def checkpointed_attention_pool(attention_net, h, chunk_size):
+    """Attention pooling over a bag in chunks of `chunk_size` patches with
+    activation checkpointing: only the attention logits (N x 1) and one pooled
+    sum per chunk are kept for backward; the chunk activations are recomputed.
+    Chunk sums are combined with a log-sum-exp rescaling, so the result and the
+    gradients equal those of the unchunked softmax pooling.
+    Returns A_raw (1 x N) and M (1 x D)."""
+    A_list, S_list, m_list = [], [], []
+    for h_chunk in torch.split(h, chunk_size, dim=0):
+        A, S, m = _checkpoint_chunk(attention_net, h_chunk)
+        A_list.append(A)
+        S_list.append(S)
+        m_list.append(m.detach())
+    m_chunks = torch.stack(m_list)
+    m = m_chunks.max()
+    A_raw = torch.cat(A_list, dim=0)
+    Z = torch.exp(A_raw - m).sum()
+    M = (torch.exp(m_chunks - m)[:, None] * torch.cat(S_list, dim=0)).sum(dim=0, keepdim=True) / Z
+    return torch.transpose(A_raw, 1, 0), M
+
 
 
 class Att_Head(nn.Module):
@@ -95,7 +153,7 @@ class Attn_Net_Gated(nn.Module):
 
 class CHIEF_Tumor_origin(nn.Module):
     def __init__(self, gate=True, size_arg="small", dropout=True, n_classes=2,
-                 instance_loss_fn=nn.CrossEntropyLoss(),**kwargs):
+                 instance_loss_fn=nn.CrossEntropyLoss(), chunk_size=None, **kwargs):
         super(CHIEF_Tumor_origin, self).__init__()
         self.size_dict = {'xs': [384, 256, 256], "small": [768, 512, 256], "big": [1024, 512, 384], 'large': [2048, 1024, 512]}
         size = self.size_dict[size_arg]
@@ -112,6 +170,7 @@ class CHIEF_Tumor_origin(nn.Module):
         self.attention_net = nn.Sequential(*fc)
         self.classifiers = nn.Linear(size[1], n_classes)
         self.n_classes = n_classes
+        self.chunk_size = chunk_size
         initialize_weights(self)
 
 
@@ -153,18 +212,26 @@ class CHIEF_Tumor_origin(nn.Module):
         instance_loss = self.instance_loss_fn(logits, p_targets)
         return instance_loss, p_preds, p_targets
 
-    def forward(self, h,epoch=0,label=None, instance_eval=False, return_features=False, attention_only=False,):
+    def forward(self, h,epoch=0,label=None, instance_eval=False, return_features=False, attention_only=False, return_attention=False):
         h=h.squeeze(0)
-        A, h = self.attention_net(h)  # NxK
-        A = torch.transpose(A, 1, 0)  # KxN
-        if attention_only:
-            return A
-        A_raw = A
-        A = F.softmax(A, dim=1)  # softmax over N
+        if self.chunk_size and h.shape[0] > self.chunk_size:
+            # huge bags: bounded activation memory, same result
+            A_raw, M = checkpointed_attention_pool(self.attention_net, h, self.chunk_size)
+            if attention_only:
+                return A_raw
+        else:
+            A, h = self.attention_net(h)  # NxK
+            A = torch.transpose(A, 1, 0)  # KxN
+            if attention_only:
+                return A
+            A_raw = A
+            A = F.softmax(A.float(), dim=1)  # softmax over N
 
-        M = torch.mm(A, h)  # A: 1 * N h: N * 512 => M: 1 * 512
+            M = torch.mm(A, h)  # A: 1 * N h: N * 512 => M: 1 * 512
 
         logits = self.classifiers(M)  # 1 * K
-        Y_prob = F.softmax(logits, dim=1)
+        Y_prob = F.softmax(logits.float(), dim=1)
 
+        if return_attention:
+            return logits, Y_prob, A_raw
         return logits, Y_prob
\ No newline at end of file
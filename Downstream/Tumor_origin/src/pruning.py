@@ -0,0 +1,50 @@
+import torch
+
+
+class AttentionPruner:
+    """Attention-guided patch pruning for MIL training.
+
+    During full-bag epochs the per-patch attention logits (`attention_raw`) of
+    every bag seen are recorded and the indices of its `topk` patches cached.
+    Other epochs train on those cached patches plus `explore` patches drawn
+    uniformly at random from the whole bag, so patches whose attention grows
+    can still enter the top-k at the next full-bag epoch. Bags without a cached
+    selection are always passed in full.
+
+    args:
+        topk: patches kept per bag (0 disables pruning)
+        explore: random patches added to the cached top-k
+        full_every: a full-bag epoch runs every `full_every` epochs
+        warmup: number of initial full-bag epochs
+    """
+    def __init__(self, topk=0, explore=0, full_every=10, warmup=10, seed=1):
+        self.topk = topk
+        self.explore = explore
+        self.full_every = max(full_every, 1)
+        self.warmup = warmup
+        self.generator = torch.Generator().manual_seed(seed)
+        self.cache = {}
+
+    @property
+    def enabled(self):
+        return self.topk > 0
+
+    def is_full_epoch(self, epoch):
+        if not self.enabled or epoch < self.warmup:
+            return True
+        return (epoch - self.warmup) % self.full_every == 0
+
+    def record(self, case_id, attention_raw):
+        A = attention_raw.detach().float().reshape(-1)
+        k = min(self.topk, A.numel())
+        self.cache[case_id] = torch.topk(A, k)[1].cpu()
+
+    def select(self, case_id, n_patches):
+        """Patch indices to train on, or None for the full bag."""
+        top_ids = self.cache.get(case_id)
+        if top_ids is None or n_patches <= self.topk + self.explore:
+            return None
+        if self.explore > 0:
+            random_ids = torch.randint(n_patches, (self.explore,), generator=self.generator)
+            top_ids = torch.cat([top_ids, random_ids])
+        return torch.unique(top_ids)
@@ -6,6 +6,7 @@ import json
 
 # internal imports
 from classification import Tumor_origin
+from loader_utils import apply_host_profile
 
 parser = argparse.ArgumentParser(description='Model Training Script')
 
@@ -18,12 +19,13 @@ parser.add_argument('--val_csv', type=str, default='./csv/val_tcga.csv')
 parser.add_argument('--test_csv', type=str, default='./csv/test_tcga.csv')
 
 parser.add_argument('--histology_feature_path', type=str, default='./feature/tcga')
+parser.add_argument('--feature_suffix', type=str, choices=['.pt', '.h5'], default='.pt', help='bag format: torch tensors (.pt) or HDF5 written by HDF5BagWriter (.h5)')
 parser.add_argument('--results_dir', default='../results/', help='results directory (default: ../results)')
 parser.add_argument('--exp_name', type=str, default='exp_01')
 
 # training related parameters
 parser.add_argument('--classification_type', type=str, default='tumor_origin')
-parser.add_argument('--exec_mode', type=str, choices=['train', 'eval', 'interpret'], default='train')
+parser.add_argument('--exec_mode', type=str, choices=['train', 'eval', 'interpret', 'precision_report'], default='train')
 parser.add_argument('--split_name', type=str, choices=['test'], default='test')
 parser.add_argument('--model_name', type=str, default='MM_MLP')
 parser.add_argument('--hidden_neurons_mm', type=int, default=512, help='features length')
@@ -45,6 +47,23 @@ parser.add_argument('--k_end', type=int, default=2, help='end fold (default: -1,
 parser.add_argument('--seed', type=int, default=1, help='random seed for reproducible experiment (default: 1)')
 parser.add_argument('--site_name', type=str, default='Metastatic Recurrence')  # 'Metastatic Recurrence'
 parser.add_argument('--balance_met', action='store_true', default=False)  # 'Metastatic Recurrence'
+parser.add_argument('--prune_topk', type=int, default=0, help='train pruned epochs on the top-k attention patches of each bag (0 disables)')
+parser.add_argument('--prune_explore', type=int, default=0, help='random patches added to the cached top-k')
+parser.add_argument('--prune_full_every', type=int, default=10, help='run a full-bag epoch (and refresh attention) every n epochs')
+parser.add_argument('--prune_warmup', type=int, default=10, help='full-bag epochs before pruning starts')
+parser.add_argument('--async_valid', action='store_true', default=False, help='validate each epoch in a background process while the next one trains')
+parser.add_argument('--async_valid_threads', type=int, default=4, help='intra-op threads of the validation process')
+parser.add_argument('--checkpoint_chunk_size', type=int, default=0, help='activation checkpointing over chunks of n patches for huge bags (0 disables; reentrant on torch < 1.11)')
+parser.add_argument('--num_workers', type=int, default=None, help='DataLoader worker processes (default: host profile, else 4)')
+parser.add_argument('--persistent_workers', action=argparse.BooleanOptionalAction, default=True, help='keep loader workers alive across epochs')
+parser.add_argument('--prefetch_factor', type=int, default=2, help='batches prefetched per worker')
+parser.add_argument('--pin_memory', action='store_true', default=False, help='page-locked batches for faster host-to-GPU copies')
+parser.add_argument('--worker_affinity', action='store_true', default=False, help='pin each loader worker to one core')
+parser.add_argument('--read_ahead', type=int, default=0, help='hint the next n feature files to the kernel in on-disk order (0 disables)')
+parser.add_argument('--preload', action='store_true', default=False, help='load every bag once into shared memory before training/evaluation')
+parser.add_argument('--precision', type=str, choices=['fp32', 'bf16'], default='fp32', help='autocast precision of the aggregator')
+parser.add_argument('--n_bootstrap', type=int, default=1000, help='bootstrap resamples for test CIs (0 disables)')
+parser.add_argument('--n_jobs', type=int, default=1, help='processes for the bootstrap')
 
 args = parser.parse_args()
 args.results_dir = os.path.join(args.results_dir, args.exp_name)
@@ -60,8 +79,11 @@ class_names = [class_name for class_name in args.label_dict.keys()]
 args.n_classes = len(args.label_dict)
 
 if __name__ == "__main__":
+    apply_host_profile()
     obj = Tumor_origin(args)
     if args.exec_mode == 'train':
         obj.train_valid()
     elif args.exec_mode == 'eval':
         obj.eval(split_name=args.split_name)
+    elif args.exec_mode == 'precision_report':
+        obj.precision_report()
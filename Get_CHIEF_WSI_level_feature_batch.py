@@ -2,7 +2,8 @@ import torch, torchvision
 import torch.nn as nn
 from models.CHIEF import CHIEF
 from datasets.dataloader_factory import create_dataloader
-from utils.utils import read_yaml
+from utils.utils import read_yaml, autocast_context
+from datasets.loader_utils import apply_host_profile
 import argparse
 from tqdm import tqdm
 import os
@@ -11,6 +12,7 @@ parser.add_argument('--config_path', type=str, default='./configs/get_wsi_level_
 parser.add_argument('--dataset_name', type=str, default='test_set')
 args = parser.parse_args()
 
+apply_host_profile()
 cfg = read_yaml(args.config_path)
 result_dir = os.path.join(cfg.General.result_dir,'WSI_level_feature', args.dataset_name)
 
@@ -30,8 +32,9 @@ with torch.no_grad():
         for idx, batch in enumerate(dataloader):
             x, tmp_z,id = batch['x'].to(device, dtype=torch.float32), \
                 batch['z'].to(device, dtype=torch.long),batch['id']
-            result = model(x, x_anatomic=tmp_z)
-            wsi_feature_emb = result['WSI_feature']  ###[1,768]
+            with autocast_context(cfg.General.precision or 'fp32', device):
+                result = model(x, x_anatomic=tmp_z)
+            wsi_feature_emb = result['WSI_feature'].float()  ###[1,768]
             print(wsi_feature_emb.size())
             torch.save(wsi_feature_emb, os.path.join(result_dir,id+'.pt'))
 
@@ -0,0 +1,80 @@
+import torch
+import numpy as np
+import pandas as pd
+from datasets.BagDataset import anatomic_ids
+from datasets.hdf5_bags import load_bag
+from datasets.manifest import BagManifest
+from utils.extraction import SlideExtractor, load_models
+from utils.utils import read_yaml, autocast_context
+from datasets.loader_utils import apply_host_profile
+import argparse
+from tqdm import tqdm
+import os
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', type=str, default='./configs/anytime_exsample.yaml')
+parser.add_argument('--dataset_name', type=str, default='test_set')
+parser.add_argument('--calibrate', action='store_true',
+                    help='fit Anytime.temperature on the full bags of Data.data_dir and exit')
+args = parser.parse_args()
+
+
+def fit_temperature(logits, labels, steps=100):
+    """Temperature that minimises the NLL of softmax(logits / T) on labelled slides."""
+    log_t = torch.zeros(1, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_t], lr=0.1, max_iter=steps)
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    def closure():
+        optimizer.zero_grad()
+        loss = loss_fn(logits / log_t.exp(), labels)
+        loss.backward()
+        return loss
+    optimizer.step(closure)
+    return log_t.exp().item()
+
+
+if __name__ == '__main__':
+    apply_host_profile()
+    cfg = read_yaml(args.config_path)
+    result_dir = os.path.join(cfg.General.result_dir, 'anytime', args.dataset_name)
+    os.makedirs(result_dir, exist_ok=True)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    precision = cfg.General.precision or 'fp32'
+
+    encoder, model = load_models(cfg.Extraction, device)
+
+    df = pd.read_csv(cfg.Data.external_dir)
+    df.rename(columns={'slide_id': 'case_id'}, inplace=True)
+    anatomic = anatomic_ids(df, cfg.Data.get('anatomic', None))
+
+    if args.calibrate:
+        manifest = BagManifest.from_dir(df['case_id'], cfg.Data.data_dir, labels=df['label'],
+                                        suffix=cfg.Data.get('feature_suffix', '.h5'))
+        logits = []
+        with torch.no_grad():
+            for path, z in zip(manifest.paths, anatomic):
+                with autocast_context(precision, device):
+                    result = model(load_bag(path).to(device), x_anatomic=torch.tensor([z], device=device))
+                logits.append(result['bag_logits'].float().cpu())
+        temperature = fit_temperature(torch.cat(logits), torch.as_tensor(manifest.labels, dtype=torch.long))
+        print('Anytime.temperature: {:.4f}'.format(temperature))
+        raise SystemExit
+
+    if 'slide_path' in df.columns:
+        paths = df['slide_path'].values
+    else:
+        paths = (os.path.join(cfg.Data.slide_dir, '') + df['case_id'].astype(str) + cfg.Data.get('slide_suffix', '.svs')).values
+    extractor = SlideExtractor(encoder, cfg.Extraction, chief=model, device=device, precision=precision)
+
+    rows = []
+    for slide_id, path, z in tqdm(zip(df['case_id'].astype(str), paths, anatomic), total=len(df)):
+        prob, stats = extractor.stream(path, torch.tensor([z]), cfg.Anytime)
+        prob = np.full(2, np.nan) if prob is None else prob
+        rows.append(dict(case_id=slide_id, prob_0=prob[0], prob_1=prob[1], **stats))
+    preds = pd.DataFrame(rows)
+    if 'label' in df.columns:
+        preds.insert(1, 'label', df['label'].values)
+    preds.to_csv(os.path.join(result_dir, 'anytime_preds.csv'), index=False)
+    print('tiles used: {} of {} ({:.1f}%)'.format(preds['n_used'].sum(), preds['n_tiles'].sum(),
+                                                   100 * preds['n_used'].sum() / max(preds['n_tiles'].sum(), 1)))
+    print(preds['stop'].value_counts().to_string())
@@ -0,0 +1,92 @@
+import torch
+import pandas as pd
+from datasets.hdf5_bags import save_bag
+from datasets.loader_utils import host_profile_path, load_host_profile
+from utils.autotune import aggregation_trial, encoder_trial, pick, pipeline_trial, run_isolated
+import argparse
+import datetime
+import json
+import os
+import socket
+import tempfile
+parser = argparse.ArgumentParser()
+parser.add_argument('--encoder', type=str, default='ctranspath', help='ctranspath | ctranspath_xs')
+parser.add_argument('--precision', type=str, choices=['fp32', 'bf16'], default='fp32')
+parser.add_argument('--sdpa', action='store_true', help='tune the SDPA window-attention path')
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 16, 32, 64, 128])
+parser.add_argument('--intra_threads', type=int, nargs='+', default=None,
+                    help='intra-op thread counts (default: powers of two up to the available cores, and all cores)')
+parser.add_argument('--inter_threads', type=int, nargs='+', default=[1, 2, 4])
+parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8])
+parser.add_argument('--n_batches', type=int, default=3, help='timed encoder batches per trial')
+parser.add_argument('--n_tiles', type=int, default=512, help='synthetic tiles per pipeline trial')
+parser.add_argument('--n_bags', type=int, default=16, help='synthetic bags per aggregation trial')
+parser.add_argument('--bag_size', type=int, default=4000, help='patches per synthetic bag')
+parser.add_argument('--output', type=str, default=None,
+                    help='profile path (default: $CHIEF_HOST_PROFILE or ~/.chief/<hostname>.json)')
+args = parser.parse_args()
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def grid(trials, stage, fn, settings, **fixed):
+    """fn(**fixed, **setting) in its own process for each setting, smallest
+    first; returns [(setting, throughput)] and logs each trial in `trials`."""
+    results = []
+    for setting in settings:
+        value = run_isolated(fn, **fixed, **setting)
+        trials.append(dict(stage=stage, **fixed, **setting, throughput=value))
+        print('{:<12}{:<40}{}'.format(stage, json.dumps(setting),
+                                       'failed' if value is None else '{:.1f}/s'.format(value)))
+        results.append((setting, value))
+    return results
+
+
+if __name__ == '__main__':
+    cores = available_cores()
+    intra_threads = args.intra_threads or sorted({2 ** i for i in range(cores.bit_length())} | {cores})
+    inter_threads = [n for n in args.inter_threads if n <= cores] or [1]
+    workers = [n for n in args.workers if n < cores] or [0]
+    batch_sizes = sorted(args.batch_sizes)
+    trials = []
+    encoder = dict(arch=args.encoder, precision=args.precision, sdpa=args.sdpa)
+
+    # coordinate search: threads at a middle batch size, then the batch size at
+    # those threads, then tile reader workers and bag reader workers next to them
+    threads = pick(grid(trials, 'threads', encoder_trial,
+                        [dict(intra=a, inter=b) for a in intra_threads for b in inter_threads],
+                        batch_size=batch_sizes[len(batch_sizes) // 2], n_batches=args.n_batches, **encoder))
+    batch_size = pick(grid(trials, 'batch_size', encoder_trial, [dict(batch_size=n) for n in batch_sizes],
+                           n_batches=args.n_batches, **threads, **encoder))['batch_size']
+    tile_workers = pick(grid(trials, 'tile_workers', pipeline_trial, [dict(workers=n) for n in workers],
+                             batch_size=batch_size, n_tiles=args.n_tiles, **threads, **encoder))['workers']
+    with tempfile.TemporaryDirectory() as bag_dir:
+        paths = [save_bag(os.path.join(bag_dir, '{}.h5'.format(i)), torch.randn(args.bag_size, 768))
+                 for i in range(args.n_bags)]
+        bag_workers = pick(grid(trials, 'bag_workers', aggregation_trial, [dict(workers=n) for n in workers],
+                                paths=paths, precision=args.precision, **threads))['workers']
+
+    output = args.output or host_profile_path()
+    profile = load_host_profile(output)
+    profile.update({
+        'host': socket.gethostname(),
+        'cores': cores,
+        'torch': torch.__version__,
+        'tuned': datetime.datetime.now().isoformat(timespec='seconds'),
+        'intra_op_threads': threads['intra'],
+        'inter_op_threads': threads['inter'],
+        'batch_size_' + args.encoder: batch_size,
+        'tile_workers': tile_workers,
+        'bag_workers': bag_workers,
+    })
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(profile, f, indent=2)
+    trials = pd.DataFrame(trials).drop(columns=['paths'], errors='ignore')
+    trials.to_csv(os.path.splitext(output)[0] + '_trials.csv', index=False)
+    print(json.dumps(profile, indent=2))
+    print('host profile written to {}'.format(output))
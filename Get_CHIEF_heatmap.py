@@ -0,0 +1,69 @@
+import torch
+import pandas as pd
+from models.CHIEF import CHIEF
+from datasets.hdf5_bags import HDF5BagReader
+from datasets.manifest import BagManifest
+from utils.utils import read_yaml, autocast_context
+from datasets.loader_utils import apply_host_profile
+from utils.heatmap import HeatmapExporter
+import argparse
+from tqdm import tqdm
+import os
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', type=str, default='./configs/heatmap_exsample.yaml')
+parser.add_argument('--dataset_name', type=str, default='test_set')
+parser.add_argument('--topk', type=int, default=0, help='also write the k highest patch_prob patches per slide (0 disables)')
+parser.add_argument('--topk_only', action='store_true',
+                    help='write only the top-k patches, scored with early stopping (no heatmap)')
+args = parser.parse_args()
+
+
+def topk_of(patch_prob, k, coords):
+    """patch_topk's output from the patch_prob of every patch."""
+    prob, ids = torch.topk(patch_prob.float().reshape(-1), min(k, len(coords)))
+    return {'topk_prob': prob, 'topk_index': ids, 'topk_coords': coords[ids.cpu().numpy()]}
+
+
+def write_topk(path, evidence):
+    pd.DataFrame({'patch': evidence['topk_index'].cpu().numpy(),
+                  'x': evidence['topk_coords'][:, 0], 'y': evidence['topk_coords'][:, 1],
+                  'level': evidence['topk_coords'][:, 2],
+                  'patch_prob': evidence['topk_prob'].cpu().numpy()}).to_csv(path, index=False)
+
+
+if __name__ == '__main__':
+    apply_host_profile()
+    if args.topk_only and args.topk <= 0:
+        raise ValueError('--topk_only needs --topk > 0')
+    cfg = read_yaml(args.config_path)
+    result_dir = os.path.join(cfg.General.result_dir, 'heatmap', args.dataset_name)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    model = CHIEF(size_arg="small", dropout=True, n_classes=2)
+    td = torch.load(r'./model_weight/CHIEF_pretraining.pth', map_location=device)
+    model.load_state_dict(td, strict=True)
+    model.to(device)
+    model.eval()
+
+    # bags must be HDF5 files with patch coordinates (HDF5BagWriter(with_coords=True))
+    df = pd.read_csv(cfg.Data.external_dir)
+    df.rename(columns={'slide_id': 'case_id'}, inplace=True)
+    manifest = BagManifest.from_dir(df['case_id'], cfg.Data.data_dir, suffix='.h5')
+    anatomic = torch.tensor([cfg.Data.anatomic], device=device)
+
+    with HeatmapExporter(result_dir, **cfg.Heatmap) as exporter:
+        with torch.no_grad():
+            for slide_id, path in tqdm(zip(manifest.ids, manifest.paths), total=len(manifest)):
+                with HDF5BagReader(path) as reader:
+                    features, coords = reader.read(), reader.read_coords()
+                with autocast_context(cfg.General.precision or 'fp32', device):
+                    if args.topk_only:
+                        # without a heatmap only the top-k patches need classifying
+                        evidence = model.patch_topk(features.to(device), anatomic, k=args.topk, coords=coords)
+                    else:
+                        result = model.patch_probs(features.to(device), anatomic)
+                        evidence = topk_of(result['patch_prob'], args.topk, coords) if args.topk > 0 else None
+                if not args.topk_only:
+                    exporter.submit(slide_id, coords, result['patch_prob'].float().cpu().numpy())
+                if evidence is not None:
+                    write_topk(os.path.join(result_dir, slide_id + '_topk.csv'), evidence)
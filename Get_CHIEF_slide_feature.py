@@ -0,0 +1,121 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+import pandas as pd
+from sklearn.metrics import roc_auc_score
+from datasets.BagDataset import anatomic_ids
+from datasets.hdf5_bags import save_bag
+from models.ctran import PrunedCTransPath
+from utils.extraction import SlideExtractor, load_models
+from utils.utils import read_yaml, autocast_context
+from datasets.loader_utils import apply_host_profile
+import argparse
+from tqdm import tqdm
+import os
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', type=str, default='./configs/slide_feature_exsample.yaml')
+parser.add_argument('--dataset_name', type=str, default='test_set')
+parser.add_argument('--mode', type=str, default=None, help='full | dense | cascade (default: Extraction.mode)')
+parser.add_argument('--report', action='store_true',
+                    help='also extract every slide in full mode with the unpruned encoder and compare cost, '
+                         'features and CHIEF predictions')
+args = parser.parse_args()
+
+
+def slide_paths(df, cfg):
+    if 'slide_path' in df.columns:
+        return df['slide_path'].values
+    return (os.path.join(cfg.Data.slide_dir, '') + df['case_id'].astype(str) + cfg.Data.get('slide_suffix', '.svs')).values
+
+
+def bag_prob(model, features, anatomic, device, precision='fp32'):
+    if len(features) == 0:
+        return np.nan
+    with torch.no_grad():
+        with autocast_context(precision, device):
+            result = model(features.to(device), x_anatomic=torch.tensor([anatomic], device=device))
+    return torch.softmax(result['bag_logits'].float(), dim=1)[0, 1].item()
+
+
+def summarize(report, mode):
+    """Cohort-level cost and accuracy of `mode` against full extraction."""
+    summary = {
+        'slides': len(report),
+        'encoded_full': report['n_encoded_full'].sum(),
+        'encoded_' + mode: report['n_encoded_' + mode].sum(),
+        'cost_ratio': report['n_encoded_' + mode].sum() / max(report['n_encoded_full'].sum(), 1),
+        'speedup': report['seconds_full'].sum() / max(report['seconds_' + mode].sum(), 1e-9),
+        'mean_abs_prob_diff': (report['prob_full'] - report['prob_' + mode]).abs().mean(),
+        'agreement': ((report['prob_full'] >= 0.5) == (report['prob_' + mode] >= 0.5)).mean(),
+    }
+    if 'feature_cosine' in report.columns:
+        summary['min_feature_cosine'] = report['feature_cosine'].min()
+        summary['mean_feature_cosine'] = report['feature_cosine_mean'].mean()
+    if 'flops_saved_' + mode in report.columns:
+        summary['flops_saved'] = report['flops_saved_' + mode].mean()
+    if 'label' in report.columns and report['label'].nunique() == 2:
+        summary['auc_full'] = roc_auc_score(report['label'], report['prob_full'].fillna(0))
+        summary['auc_' + mode] = roc_auc_score(report['label'], report['prob_' + mode].fillna(0))
+    return pd.DataFrame([summary])
+
+
+if __name__ == '__main__':
+    apply_host_profile()
+    cfg = read_yaml(args.config_path)
+    mode = args.mode or cfg.Extraction.get('mode', 'full')
+    pruned = cfg.Extraction.get('prune_background', False)
+    if args.report and mode == 'full' and not pruned:
+        raise ValueError('--report compares dense, cascade or background-pruned extraction with full extraction')
+    result_dir = os.path.join(cfg.General.result_dir, 'slide_feature', args.dataset_name)
+    os.makedirs(result_dir, exist_ok=True)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    precision = cfg.General.precision or 'fp32'
+
+    encoder, model = load_models(cfg.Extraction, device, with_chief=mode == 'cascade' or args.report)
+    extractor = SlideExtractor(encoder, cfg.Extraction, cfg.Cascade, model, device, precision)
+    # the reference side of --report is full extraction with the unpruned encoder
+    reference = SlideExtractor(encoder.model if isinstance(encoder, PrunedCTransPath) else encoder, cfg.Extraction,
+                               device=device, precision=precision)
+    name = 'pruned' if mode == 'full' else mode
+
+    df = pd.read_csv(cfg.Data.external_dir)
+    df.rename(columns={'slide_id': 'case_id'}, inplace=True)
+    suffix = cfg.Data.get('feature_suffix', '.h5')
+    rows, extraction_stats = [], []
+    for i, (slide_id, path) in enumerate(tqdm(zip(df['case_id'].astype(str), slide_paths(df, cfg)), total=len(df))):
+        features, coords, stats = extractor(path, mode)
+        save_bag(os.path.join(result_dir, slide_id + suffix), features, coords if suffix == '.h5' else None)
+        extraction_stats.append(dict(case_id=slide_id, **stats))
+        if not args.report:
+            continue
+        full_dir = os.path.join(result_dir, 'full')
+        os.makedirs(full_dir, exist_ok=True)
+        full_features, full_coords, full_stats = reference(path, 'full')
+        save_bag(os.path.join(full_dir, slide_id + suffix), full_features, full_coords if suffix == '.h5' else None)
+        anatomic = anatomic_ids(df.iloc[[i]], cfg.Data.get('anatomic', None))[0]
+        row = {'case_id': slide_id}
+        if 'label' in df.columns:
+            row['label'] = df['label'].values[i]
+        row.update({key + '_full': value for key, value in full_stats.items()})
+        row.update({key + '_' + name: value for key, value in stats.items()})
+        row['prob_full'] = bag_prob(model, full_features, anatomic, device, precision)
+        row['prob_' + name] = bag_prob(model, features, anatomic, device, precision)
+        if mode in ('dense', 'full') and len(features) > 0:
+            # same tiles: how close the shared-stage or pruned features are to per-tile unpruned ones
+            cosine = F.cosine_similarity(features, full_features)
+            row['feature_cosine'] = cosine.min().item()
+            row['feature_cosine_mean'] = cosine.mean().item()
+        rows.append(row)
+
+    extraction_stats = pd.DataFrame(extraction_stats)
+    extraction_stats.to_csv(os.path.join(result_dir, mode + '_stats.csv'), index=False)
+    if 'flops_saved' in extraction_stats.columns:
+        print('encoder FLOPs saved by background pruning: {:.1%} per slide on average'.format(
+            extraction_stats['flops_saved'].mean()))
+
+    if args.report:
+        report = pd.DataFrame(rows)
+        report.to_csv(os.path.join(result_dir, mode + '_report.csv'), index=False)
+        summary = summarize(report, name)
+        summary.to_csv(os.path.join(result_dir, mode + '_summary.csv'), index=False)
+        print(summary.T.to_string(header=False))
@@ -0,0 +1,194 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+import pandas as pd
+from sklearn.metrics import roc_auc_score
+from torch.utils.data import ConcatDataset
+from torchvision import transforms
+from models.CHIEF import CHIEF
+from models.ctran import ctranspath_xs
+from datasets.BagDataset import anatomic_ids
+from datasets.hdf5_bags import load_bag, save_bag
+from datasets.loader_utils import apply_host_profile, build_dataloader, host_setting
+from datasets.wsi import TileDataset, open_slide, tile_transform
+from utils.extraction import SlideExtractor, encoder_throughput, extraction_options, load_chief, load_encoder
+from utils.utils import read_yaml, seed_torch, autocast_context
+import argparse
+from tqdm import tqdm
+import os
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', type=str, default='./configs/student_exsample.yaml')
+parser.add_argument('--stage', type=str, default='all', help='distill | heads | report | all')
+args = parser.parse_args()
+
+
+def read_cohort(csv_path, cfg):
+    df = pd.read_csv(csv_path)
+    df.rename(columns={'slide_id': 'case_id'}, inplace=True)
+    df['case_id'] = df['case_id'].astype(str)
+    if 'slide_path' not in df.columns:
+        df['slide_path'] = os.path.join(cfg.Data.slide_dir, '') + df['case_id'] + cfg.Data.get('slide_suffix', '.svs')
+    return df
+
+
+def distill(cfg, teacher, device):
+    """Trains ctranspath_xs so that a linear projection of its 384-d features
+    matches the 768-d CTransPath features of tiles sampled from the slides."""
+    options = cfg.Distill
+    df = read_cohort(cfg.Data.external_dir, cfg)
+    augment = transforms.Compose([transforms.RandomHorizontalFlip(), transforms.RandomVerticalFlip(),
+                                  tile_transform()])
+    extractor = SlideExtractor(teacher, cfg.Extraction)
+    rng = np.random.default_rng(cfg.General.get('seed', 2023))
+    tiles = []
+    for path in df['slide_path']:
+        spec, coords, _, _ = extractor.tissue(open_slide(path))
+        coords = coords[rng.permutation(len(coords))[:options.get('tiles_per_slide', 256)]]
+        tiles.append(TileDataset(path, spec, coords, transform=augment))
+    loader = build_dataloader(ConcatDataset(tiles), batch_size=options.get('batch_size', 64), shuffle=True,
+                              drop_last=True, num_workers=host_setting(options.get('num_worker'), 'tile_workers'),
+                              name='distill')
+
+    student = ctranspath_xs()
+    student.head = nn.Identity()
+    projector = nn.Linear(student.num_features, teacher.num_features)
+    student.to(device)
+    projector.to(device)
+    params = list(student.parameters()) + list(projector.parameters())
+    optimizer = torch.optim.AdamW(params, lr=options.get('lr', 5e-4), weight_decay=options.get('weight_decay', 0.05))
+    epochs = options.get('epochs', 10)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=epochs * max(len(loader), 1))
+    for epoch in range(epochs):
+        student.train()
+        total = 0.
+        for x in loader:
+            x = x.to(device)
+            with torch.no_grad():
+                target = teacher(x).float()
+            pred = projector(student(x))
+            cosine = (1 - F.cosine_similarity(pred, target)).mean()
+            loss = F.mse_loss(pred, target) + options.get('cosine_weight', 1.) * cosine
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            total += loss.item()
+        print('Distill Epoch: {}, loss: {:.4f}'.format(epoch, total / max(len(loader), 1)))
+    torch.save({'model': student.state_dict()}, options.get('student_weights', './model_weight/CHIEF_CTransPath_xs.pth'))
+    student.eval()
+    return student
+
+
+def extract_bags(df, encoder, cfg, bag_dir, device):
+    """Full-magnification bags of every slide of `df` (existing bags are kept)."""
+    os.makedirs(bag_dir, exist_ok=True)
+    extractor = SlideExtractor(encoder, cfg.Extraction, device=device, precision=cfg.General.precision or 'fp32')
+    paths = []
+    for slide_id, slide_path in tqdm(zip(df['case_id'], df['slide_path']), total=len(df)):
+        path = os.path.join(bag_dir, slide_id + '.h5')
+        if not os.path.exists(path):
+            features, coords, _ = extractor(slide_path, 'full')
+            save_bag(path, features, coords)
+        paths.append(path)
+    return paths
+
+
+def slide_logits(model, paths, anatomic, device, precision='fp32'):
+    logits = []
+    with torch.no_grad():
+        for path, z in zip(paths, anatomic):
+            with autocast_context(precision, device):
+                result = model(load_bag(path).to(device), x_anatomic=torch.tensor([z], device=device))
+            logits.append(result['bag_logits'].float().cpu())
+    return torch.cat(logits)
+
+
+def train_heads(cfg, teacher_chief, teacher_paths, student_paths, labels, anatomic, device):
+    """CHIEF at size_arg='xs' on student bags, supervised by the slide labels
+    and distilled from the bag logits of the pretrained CHIEF on teacher bags."""
+    options = cfg.Heads
+    T = options.get('kd_temperature', 2.)
+    targets = slide_logits(teacher_chief, teacher_paths, anatomic, device)
+    model = CHIEF(size_arg='xs', dropout=True, n_classes=2).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=options.get('lr', 2e-4), weight_decay=options.get('reg', 1e-5))
+    bags = [load_bag(path) for path in student_paths]
+    for epoch in range(options.get('epochs', 20)):
+        model.train()
+        total = 0.
+        for i in np.random.permutation(len(bags)):
+            logits = model(bags[i].to(device), x_anatomic=torch.tensor([anatomic[i]], device=device))['bag_logits']
+            loss = F.cross_entropy(logits, torch.tensor([labels[i]], device=device))
+            kd = F.kl_div(F.log_softmax(logits / T, dim=1), F.softmax(targets[i:i + 1].to(device) / T, dim=1),
+                          reduction='batchmean') * T * T
+            loss = loss + options.get('kd_weight', 1.) * kd
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item()
+        print('Heads Epoch: {}, loss: {:.4f}'.format(epoch, total / max(len(bags), 1)))
+    torch.save(model.state_dict(), options.get('chief_weights', './model_weight/CHIEF_xs.pth'))
+    model.eval()
+    return model
+
+
+def report(cfg, pipelines, df, result_dir, device):
+    """Throughput, bag size and accuracy of each (name, encoder, CHIEF, bag_dir)
+    pipeline on the test cohort."""
+    anatomic = anatomic_ids(df, cfg.Data.get('anatomic', None))
+    rows = {'case_id': df['case_id'].values}
+    if 'label' in df.columns:
+        rows['label'] = df['label'].values
+    summary = []
+    for name, encoder, chief, bag_dir in pipelines:
+        paths = extract_bags(df, encoder, cfg, bag_dir, device)
+        prob = torch.softmax(slide_logits(chief, paths, anatomic, device), dim=1)[:, 1].numpy()
+        rows['prob_' + name] = prob
+        entry = {'pipeline': name, 'feature_dim': encoder.num_features,
+                 'tiles_per_second': encoder_throughput(encoder, extraction_options(cfg.Extraction)[0], device=device),
+                 # float32 feature bytes per slide (files also hold coordinates and chunk padding)
+                 'bag_mbytes': np.mean([len(load_bag(path)) for path in paths]) * encoder.num_features * 4 / 2 ** 20}
+        if 'label' in df.columns and df['label'].nunique() == 2:
+            entry['auc'] = roc_auc_score(df['label'], prob)
+        summary.append(entry)
+    rows = pd.DataFrame(rows)
+    rows.to_csv(os.path.join(result_dir, 'student_report.csv'), index=False)
+    summary = pd.DataFrame(summary)
+    summary['agreement'] = ((rows['prob_' + pipelines[0][0]] >= 0.5) == (rows['prob_' + pipelines[1][0]] >= 0.5)).mean()
+    summary.to_csv(os.path.join(result_dir, 'student_summary.csv'), index=False)
+    print(summary.to_string(index=False))
+
+
+if __name__ == '__main__':
+    apply_host_profile()
+    cfg = read_yaml(args.config_path)
+    result_dir = os.path.join(cfg.General.result_dir, 'student')
+    os.makedirs(result_dir, exist_ok=True)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    seed_torch(device, cfg.General.get('seed', 2023))
+    student_weights = cfg.Distill.get('student_weights', './model_weight/CHIEF_CTransPath_xs.pth')
+    chief_weights = cfg.Heads.get('chief_weights', './model_weight/CHIEF_xs.pth')
+
+    teacher = load_encoder(cfg.Extraction.get('encoder_weights', './model_weight/CHIEF_CTransPath.pth'), device)
+    teacher_chief = load_chief(cfg.Extraction.get('chief_weights', './model_weight/CHIEF_pretraining.pth'), device)
+    bag_dir = os.path.join(result_dir, 'bags')
+
+    if args.stage in ('distill', 'all'):
+        student = distill(cfg, teacher, device)
+    else:
+        student = load_encoder(student_weights, device, 'ctranspath_xs')
+
+    if args.stage in ('heads', 'all'):
+        df = read_cohort(cfg.Data.external_dir, cfg)
+        teacher_paths = extract_bags(df, teacher, cfg, os.path.join(bag_dir, 'teacher'), device)
+        student_paths = extract_bags(df, student, cfg, os.path.join(bag_dir, 'student'), device)
+        student_chief = train_heads(cfg, teacher_chief, teacher_paths, student_paths, df['label'].values,
+                                    anatomic_ids(df, cfg.Data.get('anatomic', None)), device)
+    elif args.stage == 'report':
+        student_chief = load_chief(chief_weights, device, 'xs')
+
+    if args.stage in ('report', 'all'):
+        df = read_cohort(cfg.Data.test_dir, cfg)
+        report(cfg, [('ctranspath', teacher, teacher_chief, os.path.join(bag_dir, 'test_teacher')),
+                     ('ctranspath_xs', student, student_chief, os.path.join(bag_dir, 'test_student'))],
+               df, result_dir, device)
@@ -1,38 +1,78 @@
-import os
-
+import functools
 import h5py
 import torch
 import numpy as np
 import pandas as pd
 from torch.utils.data import Dataset
+from datasets.manifest import BagManifest
+from datasets.hdf5_bags import load_bag, HDF5BagReader
+from utils.utils import read_yaml
+
+ANATOMIC_MAPPING = './configs/anatomic_mapping.yaml'
+
+
+@functools.lru_cache()
+def anatomic_sites(mapping_path=ANATOMIC_MAPPING):
+    """organ -> index of CHIEF's anatomic text embedding."""
+    return {site.lower(): int(i) for site, i in read_yaml(mapping_path).Anatomic.items()}
+
+
+def anatomic_ids(df, anatomic=None, mapping_path=ANATOMIC_MAPPING):
+    """Per-slide anatomic index: the csv's `anatomic` column (index or organ
+    name from `mapping_path`) where present, else the config's `anatomic`."""
+    if 'anatomic' not in df.columns:
+        if anatomic is None:
+            raise ValueError('no anatomic column in the csv and no Data.anatomic in the config')
+        return np.full(len(df), anatomic, dtype=np.int64)
+    column = df['anatomic']
+    if column.map(lambda site: isinstance(site, str)).any():
+        sites = anatomic_sites(mapping_path)
+        column = column.map(lambda site: sites.get(site.strip().lower(), site) if isinstance(site, str) else site)
+    if anatomic is not None:
+        column = column.fillna(anatomic)
+    if column.isna().any():
+        raise ValueError('{} slides have no anatomic site'.format(column.isna().sum()))
+    return pd.to_numeric(column).astype(np.int64).values
 
 
 class BagDataset(Dataset):
-    def __init__(self, df, data_dir,anatomic, **kwargs):
+    def __init__(self, df, data_dir,anatomic=None, feature_suffix='.pt', **kwargs):
         super(BagDataset, self).__init__()
 
         self.data_dir = data_dir
         self.df = df
         self.anatomic = anatomic
+        self.anatomics = anatomic_ids(df, anatomic)
+        self.manifest = BagManifest.from_dir(df['case_id'], data_dir, suffix=feature_suffix)
     def __len__(self):
-        return len(self.df.values)
+        return len(self.manifest)
 
     def __getitem__(self, idx):
 
-        slide_id = str(self.df['case_id'].values[idx])
-        full_path = os.path.join(self.data_dir, slide_id + '.pt')
+        slide_id = self.manifest.ids[idx]
+        full_path = self.manifest.paths[idx]
 
-        features = torch.load(full_path, map_location=torch.device('cpu'))
+        features = load_bag(full_path)
 
         res = {
             'x': features,
-            'z': torch.tensor([self.anatomic]),
+            'z': torch.tensor([self.anatomics[idx]]),
             'id':slide_id
         }
 
 
         return res
 
+    def get_feature_path(self, idx):
+        return self.manifest.paths[idx]
+
+    def get_region(self, idx, x0, y0, x1, y1, level=0):
+        """Features and (x, y, level) coordinates of the patches of bag `idx`
+        inside a bounding box, read through the bag's spatial index (.h5 only)."""
+        with HDF5BagReader(self.manifest.paths[idx]) as reader:
+            rows, features, coords = reader.read_region(x0, y0, x1, y1, level)
+        return features, coords
+
     def get_balance_weight(self):
         # for data balance
         label = self.df['label'].values
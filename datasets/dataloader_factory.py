@@ -1,5 +1,6 @@
 import pandas as pd
-from torch.utils.data import DataLoader, WeightedRandomSampler
+from torch.utils.data import WeightedRandomSampler
+from datasets.loader_utils import build_dataloader, loader_options
 
 def create_dataloader(cfg):
 
@@ -14,7 +15,6 @@ def create_bag_dataloader( cfg):
 
     from datasets.BagDataset import BagDataset
     dataset = BagDataset(df, **cfg.Data)
-    dataloader = DataLoader(dataset, batch_size=None, shuffle=False,
-                                num_workers=1)
+    dataloader = build_dataloader(dataset, shuffle=False, name='wsi', **loader_options(cfg))
 
     return dataloader
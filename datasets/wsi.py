@@ -0,0 +1,155 @@
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+mean = (0.485, 0.456, 0.406)
+std = (0.229, 0.224, 0.225)
+
+
+def tile_transform(size=224):
+    return transforms.Compose(
+        [
+            transforms.Resize(size),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=mean, std=std)
+        ]
+    )
+
+
+def region_transform():
+    """tile_transform without the resize, for whole regions."""
+    return transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=mean, std=std)])
+
+
+def open_slide(slide):
+    """An openslide.OpenSlide for a path; anything else (an already opened
+    slide) is returned as it is."""
+    if not isinstance(slide, str):
+        return slide
+    import openslide
+    return openslide.OpenSlide(slide)
+
+
+def tissue_mask(slide, downsample=64, saturation=20, brightness=240):
+    """(mask, mask_downsample): a boolean tissue mask of a low-resolution level,
+    from the HSV saturation and value of its pixels (glass is bright and grey)."""
+    level = slide.get_best_level_for_downsample(downsample)
+    thumbnail = slide.read_region((0, 0), level, slide.level_dimensions[level]).convert('RGB')
+    hsv = np.asarray(thumbnail.convert('HSV'))
+    mask = (hsv[..., 1] > saturation) & (hsv[..., 2] < brightness)
+    return mask, float(slide.level_downsamples[level])
+
+
+def tissue_fraction(mask, mask_downsample, xs, ys, size):
+    """Fraction of tissue pixels in the size x size (level 0) boxes at (xs, ys),
+    from one integral image of the mask."""
+    integral = np.pad(mask.astype(np.int64).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    height, width = mask.shape
+    x0 = np.clip((xs / mask_downsample).astype(np.int64), 0, width)
+    y0 = np.clip((ys / mask_downsample).astype(np.int64), 0, height)
+    x1 = np.clip(np.ceil((xs + size) / mask_downsample).astype(np.int64), 0, width)
+    y1 = np.clip(np.ceil((ys + size) / mask_downsample).astype(np.int64), 0, height)
+    area = np.maximum((x1 - x0) * (y1 - y0), 1)
+    return (integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]) / area
+
+
+class TileSpec:
+    """Tiles of `tile_size` pixels at `magnification`, every `stride` pixels.
+
+    Tiles are read from the closest level at or above the magnification and
+    resized; coordinates are the level-0 pixel positions of the tiles.
+    """
+    def __init__(self, slide, magnification=20, tile_size=224, stride=None, base_magnification=40):
+        base = float(slide.properties.get('openslide.objective-power', base_magnification))
+        self.magnification = magnification
+        self.tile_size = tile_size
+        self.stride = stride or tile_size
+        self.downsample = base / magnification  # level-0 pixels per tile pixel
+        self.level = slide.get_best_level_for_downsample(self.downsample * 1.001)
+        self.read_size = int(round(tile_size * self.downsample / slide.level_downsamples[self.level]))
+        self.footprint = int(round(tile_size * self.downsample))
+        self.step = int(round(self.stride * self.downsample))
+        self.dimensions = slide.dimensions
+
+    def grid_shape(self):
+        width, height = self.dimensions
+        return (max(0, (height - self.footprint) // self.step + 1),
+                max(0, (width - self.footprint) // self.step + 1))
+
+    def grid(self, mask=None, mask_downsample=1., min_tissue=0.5):
+        """(x, y, level) of every tile, row by row, keeping those with at least
+        `min_tissue` tissue when a mask is given."""
+        rows, cols = self.grid_shape()
+        yy, xx = np.meshgrid(np.arange(rows) * self.step, np.arange(cols) * self.step, indexing='ij')
+        xs, ys = xx.ravel(), yy.ravel()
+        if mask is not None:
+            keep = tissue_fraction(mask, mask_downsample, xs, ys, self.footprint) >= min_tissue
+            xs, ys = xs[keep], ys[keep]
+        return np.stack([xs, ys, np.full(len(xs), self.level)], axis=1).astype(np.int64)
+
+    def read(self, slide, x, y):
+        return self.read_region(slide, x, y, self.tile_size, self.tile_size)
+
+    def read_region(self, slide, x, y, width, height):
+        """width x height pixels (at the tile magnification) from level-0 (x, y)."""
+        scale = self.read_size / self.tile_size
+        size = (int(round(width * scale)), int(round(height * scale)))
+        region = slide.read_region((int(x), int(y)), self.level, size).convert('RGB')
+        if size != (width, height):
+            region = region.resize((width, height), Image.BILINEAR)
+        return region
+
+
+class TileDataset(Dataset):
+    """The tiles at `coords` of one slide; the slide is opened in each loader
+    worker on first use."""
+    def __init__(self, slide, spec, coords, transform=None):
+        super(TileDataset, self).__init__()
+        self.slide = slide
+        self.spec = spec
+        self.coords = np.asarray(coords)
+        self.transform = transform or tile_transform()
+        self._slide = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, idx):
+        if self._slide is None:
+            self._slide = open_slide(self.slide)
+        x, y = self.coords[idx, :2]
+        return self.transform(self.spec.read(self._slide, x, y))
+
+
+class RegionDataset(Dataset):
+    """Overlapping tiles grouped into regions of up to `region_tiles` x
+    `region_tiles` grid positions. Each item is one region read in a single
+    call: (pixels, tile offsets in pixels, tile indices into `coords`)."""
+    def __init__(self, slide, spec, coords, region_tiles=8):
+        super(RegionDataset, self).__init__()
+        self.slide = slide
+        self.spec = spec
+        self.coords = np.asarray(coords)
+        self.transform = region_transform()
+        keys = self.coords[:, :2] // (region_tiles * spec.step)
+        _, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        self.groups = np.split(order, np.flatnonzero(np.diff(inverse[order])) + 1) if len(order) else []
+        self._slide = None
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __getitem__(self, idx):
+        if self._slide is None:
+            self._slide = open_slide(self.slide)
+        index = self.groups[idx]
+        coords = self.coords[index, :2]
+        origin = coords.min(axis=0)
+        offsets = (coords - origin) // self.spec.step * self.spec.stride
+        width, height = offsets.max(axis=0) + self.spec.tile_size
+        region = self.spec.read_region(self._slide, origin[0], origin[1], int(width), int(height))
+        return self.transform(region), torch.from_numpy(offsets), torch.from_numpy(index)
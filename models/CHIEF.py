@@ -122,7 +122,7 @@ class CHIEF(nn.Module):
         A, h = self.attention_net(h)
         A = torch.transpose(A, 1, 0)
         A_raw = A
-        A = F.softmax(A, dim=1)
+        A = F.softmax(A.float(), dim=1)
 
         embed_batch = self.organ_embedding[batch]
         embed_batch=self.text_to_vision(embed_batch)
@@ -147,16 +147,16 @@ class CHIEF(nn.Module):
         A, h = self.attention_net(h)
         A_raw = A
         A = torch.transpose(A, 1, 0)
-        A = F.softmax(A, dim=1)
+        A = F.softmax(A.float(), dim=1)
 
         embed_batch = self.organ_embedding[batch]
         embed_batch=self.text_to_vision(embed_batch)
         M = torch.mm(A, h)
         M = M+embed_batch
         bag_logits = self.classifiers(M)
-        bag_prob = torch.softmax(bag_logits.squeeze(), dim=0)
+        bag_prob = torch.softmax(bag_logits.squeeze().float(), dim=0)
         patch_logits = self.classifiers(h+embed_batch)
-        patch_prob = torch.sigmoid(A_raw.squeeze()) * torch.softmax(patch_logits, dim=1)[:, 1]
+        patch_prob = torch.sigmoid(A_raw.squeeze()) * torch.softmax(patch_logits.float(), dim=1)[:, 1]
 
         return{
             'bag_prob': bag_prob,
@@ -164,3 +164,82 @@ class CHIEF(nn.Module):
             'attention_raw': A_raw.squeeze()
         }
 
+    def patch_topk(self, h, x_anatomic, k=10, overfetch=None, block_size=1024, coords=None):
+        """The k patches with the highest patch_prob, without classifying every patch.
+
+        patch_prob = sigmoid(A) * p_tumor <= sigmoid(A), so patches are scored
+        in descending order of attention, one block at a time, and scoring stops
+        once the k-th best score reaches the bound of the next unscored patch:
+        the result is exactly the top k of `patch_probs`. With `overfetch`, only
+        the overfetch * k most attended patches are scored (approximate).
+        """
+        A, h = self.attention_net(h)
+        A_raw = A.squeeze(1).float()
+        embed_batch = self.text_to_vision(self.organ_embedding[x_anatomic])
+        bound, order = torch.sort(torch.sigmoid(A_raw), descending=True)
+        n = len(order)
+        k = min(k, n)
+        n_max = n if overfetch is None else min(n, int(overfetch * k))
+        block_size = max(block_size, k)
+
+        scores = bound.new_empty(0)
+        ids = order.new_empty(0)
+        n_scored = 0
+        while n_scored < n_max:
+            block = order[n_scored:min(n_scored + block_size, n_max)]
+            patch_logits = self.classifiers(h[block] + embed_batch)
+            block_scores = bound[n_scored:n_scored + len(block)] * torch.softmax(patch_logits.float(), dim=1)[:, 1]
+            scores, keep = torch.topk(torch.cat([scores, block_scores]), min(k, len(scores) + len(block)))
+            ids = torch.cat([ids, block])[keep]
+            n_scored += len(block)
+            if overfetch is None and len(scores) == k and n_scored < n and scores[-1] >= bound[n_scored]:
+                break
+
+        result = {
+            'topk_prob': scores,
+            'topk_index': ids,
+            'attention_raw': A_raw,
+            'n_scored': n_scored
+        }
+        if coords is not None:
+            result['topk_coords'] = coords[ids.cpu().numpy()] if isinstance(coords, np.ndarray) else coords[ids]
+        return result
+
+
+
+class OnlineAttentionPool:
+    """CHIEF's attention pooling over a stream of patch feature blocks.
+
+    Keeps the running max, softmax normaliser and weighted sum of the attended
+    features (online softmax), so `bag_logits` can be read after any block and
+    equals CHIEF.forward once every patch has been added. Use with the model
+    in eval mode.
+    """
+    def __init__(self, model, x_anatomic):
+        self.model = model
+        with torch.no_grad():
+            self.embed = model.text_to_vision(model.organ_embedding[x_anatomic])
+        self.max = None
+        self.norm = None
+        self.pooled = None
+        self.n = 0
+
+    def update(self, h):
+        with torch.no_grad():
+            A, h = self.model.attention_net(h)
+            A = A.squeeze(1).float()
+            block_max = A.max()
+            new_max = block_max if self.max is None else torch.maximum(self.max, block_max)
+            w = torch.exp(A - new_max)
+            if self.max is None:
+                self.norm, self.pooled = w.sum(), w @ h.float()
+            else:
+                scale = torch.exp(self.max - new_max)
+                self.norm = self.norm * scale + w.sum()
+                self.pooled = self.pooled * scale + w @ h.float()
+            self.max = new_max
+        self.n += len(h)
+
+    def bag_logits(self):
+        with torch.no_grad():
+            return self.model.classifiers((self.pooled / self.norm)[None] + self.embed)
@@ -1,5 +1,8 @@
 from timm.models.layers.helpers import to_2tuple
 import timm
+import torch
+import torch.nn.functional as F
+from timm.models.swin_transformer import SwinTransformer, WindowAttention, window_partition, window_reverse
 import torch.nn as nn
 
 
@@ -45,4 +48,282 @@ class ConvStem(nn.Module):
 
 def ctranspath():
     model = timm.create_model('swin_tiny_patch4_window7_224', embed_layer=ConvStem, pretrained=False)
-    return model
\ No newline at end of file
+    return model
+
+def ctranspath_xs():
+    """Half-width CTransPath (embed_dim 48, 384-d features) for CHIEF
+    size_arg='xs'; trained by distillation from ctranspath()."""
+    model = SwinTransformer(patch_size=4, window_size=7, embed_dim=48, depths=(2, 2, 6, 2), num_heads=(2, 4, 8, 16),
+                            embed_layer=ConvStem)
+    return model
+
+
+class SDPAWindowAttention(WindowAttention):
+    """timm's WindowAttention computed with F.scaled_dot_product_attention
+    (fused kernels, no materialised attention matrix); the relative position
+    bias and the shifted-window mask are passed as one additive attn_mask.
+    Same parameters and buffers, so CHIEF_CTransPath.pth loads unchanged."""
+    def forward(self, x, mask=None):
+        B_, N, C = x.shape
+        qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0)
+        bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(N, N, -1)
+        bias = bias.permute(2, 0, 1).unsqueeze(0)  # 1, nH, N, N
+        if mask is not None:
+            # windows of one image share the bias; each window has its own mask
+            nW = mask.shape[0]
+            q, k, v = (t.view(B_ // nW, nW, self.num_heads, N, -1) for t in (q, k, v))
+            bias = bias.unsqueeze(0) + mask.unsqueeze(1).unsqueeze(0)  # 1, nW, nH, N, N
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=bias.to(q.dtype),
+                                           dropout_p=self.attn_drop.p if self.training else 0.)
+        x = x.reshape(B_, self.num_heads, N, -1).transpose(1, 2).reshape(B_, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+
+def use_sdpa(model):
+    """Switches every window attention of a Swin model to SDPAWindowAttention
+    in place (needs torch >= 2.0)."""
+    if not hasattr(F, 'scaled_dot_product_attention'):
+        raise NotImplementedError('scaled_dot_product_attention needs torch >= 2.0')
+    for module in model.modules():
+        if type(module) is WindowAttention:
+            module.__class__ = SDPAWindowAttention
+    return model
+
+
+def shift_mask(H, W, window_size, shift_size, device=None):
+    """The SW-MSA attention mask of timm's SwinTransformerBlock for an H x W
+    token grid."""
+    img_mask = torch.zeros((1, H, W, 1), device=device)
+    slices = (slice(0, -window_size), slice(-window_size, -shift_size), slice(-shift_size, None))
+    cnt = 0
+    for h in slices:
+        for w in slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+    mask_windows = window_partition(img_mask, window_size).view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    return attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+
+
+def block_forward(blk, x, H, W):
+    """SwinTransformerBlock.forward for a B x (H*W) x C token grid of any size
+    (H and W multiples of the window)."""
+    B, L, C = x.shape
+    ws, shift = blk.window_size, blk.shift_size
+    shortcut = x
+    x = blk.norm1(x).view(B, H, W, C)
+    if shift > 0:
+        x = torch.roll(x, shifts=(-shift, -shift), dims=(1, 2))
+    windows = window_partition(x, ws).view(-1, ws * ws, C)
+    windows = blk.attn(windows, mask=shift_mask(H, W, ws, shift, x.device) if shift > 0 else None)
+    x = window_reverse(windows.view(-1, ws, ws, C), ws, H, W)
+    if shift > 0:
+        x = torch.roll(x, shifts=(shift, shift), dims=(1, 2))
+    x = shortcut + blk.drop_path(x.reshape(B, H * W, C))
+    return x + blk.drop_path(blk.mlp(blk.norm2(x)))
+
+
+def merge_forward(merge, x, H, W):
+    """PatchMerging.forward for an H x W token grid of any (even) size."""
+    B, L, C = x.shape
+    x = x.view(B, H, W, C)
+    x = torch.cat([x[:, 0::2, 0::2], x[:, 1::2, 0::2], x[:, 0::2, 1::2], x[:, 1::2, 1::2]], -1)
+    return merge.reduction(merge.norm(x.view(B, -1, 4 * C)))
+
+
+class DenseCTransPath(nn.Module):
+    """CTransPath for overlapping tiles of one region: the stem and the first
+    `shared_stages` Swin stages run once on the whole region, and each tile
+    only runs the later stages on its crop of the region's token grid.
+
+    This is an approximation of per-tile extraction: tokens near a tile border
+    see the neighbouring tissue instead of the tile's zero padding and its
+    shifted windows do not wrap around at the tile edge. Tile offsets must be
+    multiples of `align` pixels, so unshifted windows line up with the tiles.
+    """
+    def __init__(self, model, shared_stages=1, tile_size=224):
+        super().__init__()
+        self.model = model
+        self.shared_stages = shared_stages
+        self.num_features = model.num_features
+        self.token_size = 4 * 2 ** shared_stages  # region pixels per token after the shared stages
+        self.tile_tokens = tile_size // self.token_size
+        self.align = 4 if shared_stages == 0 else 28 * 2 ** shared_stages
+
+    def forward(self, region, offsets):
+        """region: [1, 3, H, W] normalised pixels; offsets: [N, 2] (x, y) pixel
+        positions of the tiles in the region. Returns [N, D] features."""
+        model = self.model
+        x = model.patch_embed.proj(region)
+        _, _, H, W = x.shape
+        x = model.patch_embed.norm(x.flatten(2).transpose(1, 2))
+        if model.absolute_pos_embed is not None:
+            raise NotImplementedError('dense extraction needs relative position bias only')
+        for layer in model.layers[:self.shared_stages]:
+            for blk in layer.blocks:
+                x = block_forward(blk, x, H, W)
+            if layer.downsample is not None:
+                x = merge_forward(layer.downsample, x, H, W)
+                H, W = H // 2, W // 2
+        x = x.view(H, W, -1)
+        n = self.tile_tokens
+        cells = (torch.as_tensor(offsets) // self.token_size).tolist()
+        x = torch.stack([x[row:row + n, col:col + n] for col, row in cells]).flatten(1, 2)
+        for layer in model.layers[self.shared_stages:]:
+            x = layer(x)
+        x = model.norm(x)
+        x = torch.flatten(model.avgpool(x.transpose(1, 2)), 1)
+        return model.head(x)
+
+
+def window_flops(blk, dim):
+    """Multiply-adds of attention and MLP for one window of a block."""
+    n = blk.window_size * blk.window_size
+    return n * dim * (4 * dim + 2 * blk.mlp.fc1.out_features) + 2 * n * n * dim
+
+
+def active_windows(token_mask, window_size, shift_size):
+    """[B * nW] True for the windows (after the cyclic shift) holding at least
+    one foreground token."""
+    m = token_mask[..., None].float()
+    if shift_size > 0:
+        m = torch.roll(m, shifts=(-shift_size, -shift_size), dims=(1, 2))
+    return window_partition(m, window_size).flatten(1).amax(1) > 0
+
+
+def pruned_block_forward(blk, x, H, W, token_mask):
+    """block_forward that skips attention and MLP for windows without
+    foreground tokens (those tokens pass through on the residual path).
+    Returns (x, active windows); with every window active it is block_forward."""
+    B, L, C = x.shape
+    ws, shift = blk.window_size, blk.shift_size
+    active = active_windows(token_mask, ws, shift)
+    if active.all():
+        return block_forward(blk, x, H, W), active
+    index = active.nonzero().squeeze(1)
+    windows = window_partition(blk.norm1(x).view(B, H, W, C).roll((-shift, -shift), (1, 2)), ws).view(-1, ws * ws, C)
+    out = torch.zeros_like(windows)
+    if len(index) > 0:
+        mask = shift_mask(H, W, ws, shift, x.device)[index % (windows.shape[0] // B)] if shift > 0 else None
+        out[index] = blk.attn(windows[index], mask=mask)
+    x = x + blk.drop_path(window_reverse(out.view(-1, ws, ws, C), ws, H, W).roll((shift, shift), (1, 2)).reshape(B, L, C))
+    tokens = window_reverse(active.float()[:, None, None, None].expand(-1, ws, ws, 1), ws, H, W)
+    tokens = tokens.roll((shift, shift), (1, 2)).reshape(-1) > 0
+    x = x.reshape(-1, C)
+    x = x.index_add(0, tokens.nonzero().squeeze(1), blk.drop_path(blk.mlp(blk.norm2(x[tokens]))))
+    return x.view(B, L, C), active
+
+
+class PrunedCTransPath(nn.Module):
+    """CTransPath that skips background inside the Swin blocks.
+
+    A token is foreground when any of its 4 x 4 pixels looks like tissue (HSV
+    saturation and value thresholds as in datasets.wsi.tissue_mask); merged
+    tokens are foreground when any of their children is. Windows without
+    foreground are skipped in attention and MLP, so tiles whose windows all
+    hold tissue give exactly the ctranspath() features. Multiply-adds run and
+    skipped are counted in `flops_run` / `flops_total`.
+    """
+    def __init__(self, model, saturation=20, brightness=240):
+        super().__init__()
+        self.model = model
+        self.num_features = model.num_features
+        self.saturation = saturation / 255.
+        self.brightness = brightness / 255.
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+        self.fixed_flops = self._fixed_flops()
+        self.reset_flops()
+
+    def _fixed_flops(self):
+        """Multiply-adds per tile that are never skipped: the stem convolutions
+        and the patch merging layers."""
+        flops = []
+        hooks = [m.register_forward_hook(
+            lambda m, i, o: flops.append(o[0].numel() * m.in_channels // m.groups * m.kernel_size[0] * m.kernel_size[1]))
+            for m in self.model.patch_embed.modules() if isinstance(m, nn.Conv2d)]
+        device = next(self.model.parameters()).device  # the encoder may already be on the GPU
+        with torch.no_grad():
+            self.model.patch_embed.proj(torch.zeros(1, 3, 224, 224, device=device))
+        for hook in hooks:
+            hook.remove()
+        for layer in self.model.layers:
+            if layer.downsample is not None:
+                H, W = layer.input_resolution
+                flops.append(H // 2 * W // 2 * 4 * layer.dim * 2 * layer.dim)
+        return sum(flops)
+
+    def reset_flops(self):
+        self.flops_run = 0
+        self.flops_total = 0
+
+    def flops_saved(self):
+        return 1 - self.flops_run / max(self.flops_total, 1)
+
+    def foreground(self, x):
+        rgb = x * self.std + self.mean
+        value = rgb.amax(1)
+        saturation = (value - rgb.amin(1)) / value.clamp(min=1e-6)
+        tissue = ((saturation > self.saturation) & (value < self.brightness)).float()
+        return F.max_pool2d(tissue[:, None], 4)[:, 0] > 0
+
+    def forward(self, x):
+        model = self.model
+        token_mask = self.foreground(x)
+        x = model.pos_drop(model.patch_embed(x) if model.absolute_pos_embed is None
+                           else model.patch_embed(x) + model.absolute_pos_embed)
+        flops_run = flops_total = self.fixed_flops * len(x)
+        for layer in model.layers:
+            H, W = layer.input_resolution
+            for blk in layer.blocks:
+                x, active = pruned_block_forward(blk, x, H, W, token_mask)
+                flops = window_flops(blk, layer.dim)
+                flops_run += int(active.sum()) * flops
+                flops_total += len(active) * flops
+            if layer.downsample is not None:
+                x = layer.downsample(x)
+                token_mask = F.max_pool2d(token_mask[:, None].float(), 2)[:, 0] > 0
+        self.flops_run += flops_run
+        self.flops_total += flops_total
+        x = model.norm(x)
+        x = torch.flatten(model.avgpool(x.transpose(1, 2)), 1)
+        return model.head(x)
+
+
+def sdpa_parity(weights='./model_weight/CHIEF_CTransPath.pth', batch_size=8, atol=1e-4):
+    """Features of ctranspath() with timm's and with SDPA window attention on
+    one random batch: returns (max abs difference, seconds timm, seconds SDPA)."""
+    import os
+    import time
+    reference = ctranspath()
+    reference.head = nn.Identity()
+    if os.path.exists(weights):
+        reference.load_state_dict(torch.load(weights, map_location='cpu')['model'], strict=True)
+    reference.eval()
+    fused = ctranspath()
+    fused.head = nn.Identity()
+    fused.load_state_dict(reference.state_dict(), strict=True)
+    use_sdpa(fused).eval()
+    x = torch.randn(batch_size, 3, 224, 224)
+    seconds = []
+    with torch.no_grad():
+        for model in (reference, fused):
+            model(x)
+            start = time.perf_counter()
+            out = model(x)
+            seconds.append(time.perf_counter() - start)
+            if model is reference:
+                expected = out
+    diff = (out - expected).abs().max().item()
+    if diff > atol:
+        raise AssertionError('SDPA features differ from timm by {:.2e}'.format(diff))
+    return diff, seconds[0], seconds[1]
+
+
+if __name__ == '__main__':
+    # parity check: python -m models.ctran
+    diff, timm_seconds, sdpa_seconds = sdpa_parity()
+    print('max abs diff {:.2e}, timm {:.3f}s, sdpa {:.3f}s'.format(diff, timm_seconds, sdpa_seconds))
@@ -0,0 +1,133 @@
+import io
+import multiprocessing
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from torch.utils.data import Dataset
+
+from datasets.hdf5_bags import load_bag
+from datasets.loader_utils import build_dataloader
+from datasets.wsi import tile_transform
+from models.CHIEF import CHIEF
+from models.ctran import use_sdpa
+from utils.extraction import encoder_throughput, encoders
+from utils.utils import autocast_context
+
+
+class SyntheticTiles(Dataset):
+    """JPEG-compressed smooth noise tiles of `read_size` pixels, decoded and
+    resized like the tiles of a 40x slide read at 20x."""
+    def __init__(self, n_tiles=512, read_size=448, n_images=8, seed=0):
+        super(SyntheticTiles, self).__init__()
+        rng = np.random.default_rng(seed)
+        self.n_tiles = n_tiles
+        self.images = []
+        for _ in range(n_images):
+            low = rng.integers(0, 256, (read_size // 8, read_size // 8, 3), dtype=np.uint8)
+            buffer = io.BytesIO()
+            Image.fromarray(low).resize((read_size, read_size), Image.BILINEAR).save(buffer, 'JPEG', quality=80)
+            self.images.append(buffer.getvalue())
+        self.transform = tile_transform()
+
+    def __len__(self):
+        return self.n_tiles
+
+    def __getitem__(self, idx):
+        return self.transform(Image.open(io.BytesIO(self.images[idx % len(self.images)])).convert('RGB'))
+
+
+class BagFiles(Dataset):
+    def __init__(self, paths):
+        super(BagFiles, self).__init__()
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return load_bag(self.paths[idx])
+
+
+def set_threads(intra, inter):
+    torch.set_num_threads(intra)
+    torch.set_num_interop_threads(inter)
+
+
+def random_encoder(arch='ctranspath', sdpa=False):
+    """An untrained encoder: throughput does not depend on the weights."""
+    model = encoders[arch]()
+    model.head = nn.Identity()
+    if sdpa:
+        use_sdpa(model)
+    return model.eval()
+
+
+def encoder_trial(arch='ctranspath', batch_size=32, intra=1, inter=1, n_batches=3, precision='fp32', sdpa=False):
+    """Encoder tiles per second on random batches."""
+    set_threads(intra, inter)
+    return encoder_throughput(random_encoder(arch, sdpa), batch_size, n_batches, precision)
+
+
+def pipeline_trial(arch='ctranspath', batch_size=32, intra=1, inter=1, workers=0, n_tiles=512, precision='fp32',
+                   sdpa=False):
+    """Tiles per second of decoding, resizing and encoding synthetic tiles with
+    `workers` loader processes next to the encoder threads."""
+    set_threads(intra, inter)
+    encoder = random_encoder(arch, sdpa)
+    loader = build_dataloader(SyntheticTiles(n_tiles), batch_size=batch_size, num_workers=workers,
+                              persistent_workers=False, name='tiles')
+    loader.verbose = False
+    with torch.no_grad():
+        with autocast_context(precision):
+            encoder(torch.randn(1, 3, 224, 224))
+            start = time.perf_counter()
+            for x in loader:
+                encoder(x)
+    return n_tiles / (time.perf_counter() - start)
+
+
+def aggregation_trial(paths=(), intra=1, inter=1, workers=0, precision='fp32'):
+    """Bags per second of loading feature bags with `workers` loader processes
+    and running CHIEF on them."""
+    set_threads(intra, inter)
+    model = CHIEF(size_arg='small', dropout=True, n_classes=2).eval()
+    loader = build_dataloader(BagFiles(paths), num_workers=workers, persistent_workers=False, name='bags')
+    loader.verbose = False
+    start = time.perf_counter()
+    with torch.no_grad():
+        for x in loader:
+            with autocast_context(precision):
+                model(x, x_anatomic=torch.zeros(1, dtype=torch.long))
+    return len(paths) / (time.perf_counter() - start)
+
+
+def _run(queue, fn, kwargs):
+    queue.put(fn(**kwargs))
+
+
+def run_isolated(fn, **kwargs):
+    """fn(**kwargs) in a fresh spawned process, so that every trial starts with
+    its own thread pools (the inter-op pool can only be sized once per
+    process). Returns None when the trial fails, e.g. out of memory."""
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.SimpleQueue()
+    process = ctx.Process(target=_run, args=(queue, fn, kwargs))
+    process.start()
+    process.join()
+    if process.exitcode != 0 or queue.empty():
+        return None
+    return queue.get()
+
+
+def pick(trials, tolerance=0.03):
+    """The first (smallest) setting of a grid within `tolerance` of the best
+    throughput, so that noise does not buy extra threads or workers; `trials`
+    is a list of (setting, throughput or None)."""
+    done = [(setting, value) for setting, value in trials if value is not None]
+    if not done:
+        raise ValueError('every autotune trial failed')
+    best = max(value for _, value in done)
+    return next(setting for setting, value in done if value >= (1 - tolerance) * best)
@@ -0,0 +1,307 @@
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from datasets.loader_utils import build_dataloader, host_setting, load_host_profile
+from datasets.wsi import RegionDataset, TileDataset, TileSpec, open_slide, tissue_fraction, tissue_mask
+from models.CHIEF import CHIEF, OnlineAttentionPool
+from models.ctran import DenseCTransPath, PrunedCTransPath, ctranspath, ctranspath_xs, use_sdpa
+from utils.utils import autocast_context
+
+encoders = {'ctranspath': ctranspath, 'ctranspath_xs': ctranspath_xs}
+# CHIEF size_arg matching each encoder's feature width
+chief_sizes = {'ctranspath': 'small', 'ctranspath_xs': 'xs'}
+
+
+def load_encoder(weights='./model_weight/CHIEF_CTransPath.pth', device=torch.device('cpu'), arch='ctranspath',
+                 sdpa=False):
+    model = encoders[arch]()
+    model.head = nn.Identity()
+    td = torch.load(weights, map_location='cpu')
+    model.load_state_dict(td['model'], strict=True)
+    if sdpa:
+        use_sdpa(model)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def load_chief(weights='./model_weight/CHIEF_pretraining.pth', device=torch.device('cpu'), size_arg='small'):
+    model = CHIEF(size_arg=size_arg, dropout=True, n_classes=2)
+    td = torch.load(weights, map_location=device)
+    model.load_state_dict(td, strict=True)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def load_models(extraction, device=torch.device('cpu'), with_chief=True):
+    """(encoder, CHIEF) named by an Extraction config section; CHIEF is
+    None without `with_chief`."""
+    arch = extraction.get('encoder', 'ctranspath')
+    encoder = load_encoder(extraction.get('encoder_weights', './model_weight/CHIEF_CTransPath.pth'), device, arch,
+                           extraction.get('sdpa', False))
+    if extraction.get('prune_background', False):
+        encoder = PrunedCTransPath(encoder).to(device).eval()
+    if not with_chief:
+        return encoder, None
+    chief = load_chief(extraction.get('chief_weights', './model_weight/CHIEF_pretraining.pth'), device,
+                       chief_sizes[arch])
+    return encoder, chief
+
+
+def extraction_options(extraction, profile=None):
+    """(batch_size, num_workers) of an Extraction section. Missing or 'auto'
+    values come from the host profile, else 64 tiles and no workers."""
+    profile = load_host_profile() if profile is None else profile
+    arch = extraction.get('encoder', 'ctranspath')
+    return (host_setting(extraction.get('batch_size'), 'batch_size_' + arch, 64, profile),
+            host_setting(extraction.get('num_worker'), 'tile_workers', 0, profile))
+
+
+def encoder_throughput(encoder, batch_size=64, n_batches=5, precision='fp32', device=torch.device('cpu')):
+    """Tiles per second of `encoder` on random 224 x 224 batches (after one
+    warm-up batch)."""
+    x = torch.randn(batch_size, 3, 224, 224, device=device)
+    with torch.no_grad():
+        with autocast_context(precision, device):
+            encoder(x)
+            start = time.perf_counter()
+            for _ in range(n_batches):
+                encoder(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+    return batch_size * n_batches / (time.perf_counter() - start)
+
+
+def encode_tiles(encoder, slide, spec, coords, batch_size=64, num_workers=0, precision='fp32',
+                 device=torch.device('cpu')):
+    """[N, D] features of the tiles of `spec` at `coords`."""
+    if len(coords) == 0:
+        return torch.zeros(0, encoder.num_features)
+    loader = build_dataloader(TileDataset(slide, spec, coords), batch_size=batch_size, num_workers=num_workers,
+                              persistent_workers=False, name='tiles')
+    loader.verbose = False
+    features = []
+    with torch.no_grad():
+        for x in loader:
+            with autocast_context(precision, device):
+                features.append(encoder(x.to(device)).float().cpu())
+    return torch.cat(features)
+
+
+def encode_regions(dense, slide, spec, coords, region_tiles=8, num_workers=0, precision='fp32',
+                   device=torch.device('cpu')):
+    """encode_tiles for overlapping tiles with DenseCTransPath, one region of
+    up to region_tiles x region_tiles tiles at a time."""
+    if spec.stride % dense.align != 0 or spec.tile_size != dense.tile_tokens * dense.token_size:
+        raise ValueError('dense extraction needs {}px tiles and a stride that is a multiple of {}px'.format(
+            dense.tile_tokens * dense.token_size, dense.align))
+    features = torch.zeros(len(coords), dense.num_features)
+    if len(coords) == 0:
+        return features
+    loader = build_dataloader(RegionDataset(slide, spec, coords, region_tiles), num_workers=num_workers,
+                              persistent_workers=False, name='regions')
+    loader.verbose = False
+    with torch.no_grad():
+        for region, offsets, index in loader:
+            with autocast_context(precision, device):
+                features[index] = dense(region[None].to(device), offsets).float().cpu()
+    return features
+
+
+def select_regions(scores, top_fraction=0.1, coverage_fraction=0., min_regions=1):
+    """Indices of the regions to refine: the `top_fraction` highest scores (at
+    least `min_regions`), plus `coverage_fraction` of all regions spread evenly
+    over the rest, in grid order, so no part of the slide goes unsampled."""
+    scores = np.asarray(scores)
+    n = len(scores)
+    order = np.argsort(-scores, kind='stable')
+    n_top = min(n, max(min_regions, int(np.ceil(top_fraction * n))))
+    selected = order[:n_top]
+    rest = np.sort(order[n_top:])
+    n_cover = min(len(rest), int(np.ceil(coverage_fraction * n)))
+    if n_cover > 0:
+        selected = np.concatenate([selected, rest[np.linspace(0, len(rest) - 1, n_cover).round().astype(np.int64)]])
+    return np.sort(selected)
+
+
+def region_of(coords, region_spec, tile_size):
+    """Grid cell (row * cols + col) of the coarse region containing the centre
+    of each fine tile; tiles past the last whole region belong to it."""
+    rows, cols = region_spec.grid_shape()
+    centre = coords[:, :2] + tile_size // 2
+    col = np.minimum(centre[:, 0] // region_spec.step, cols - 1)
+    row = np.minimum(centre[:, 1] // region_spec.step, rows - 1)
+    return row * cols + col
+
+
+def tile_order(coords, order='random', mask=None, mask_downsample=1., tile_size=224, seed=0):
+    """Permutation of the tiles for streaming inference: 'grid' (as tiled),
+    'random' (seeded) or 'tissue' (highest tissue fraction first)."""
+    if order == 'grid':
+        return np.arange(len(coords))
+    if order == 'random':
+        return np.random.default_rng(seed).permutation(len(coords))
+    if order == 'tissue':
+        fraction = tissue_fraction(mask, mask_downsample, coords[:, 0], coords[:, 1], tile_size)
+        return np.argsort(-fraction, kind='stable')
+    raise NotImplementedError(order)
+
+
+class EarlyExit:
+    """Stopping rule for streaming inference: once `min_tiles` tiles are in,
+    stop when the calibrated top-class probability reaches `confidence`, or
+    when the probabilities moved less than `tolerance` over the last
+    `patience` checks."""
+    def __init__(self, confidence=0.95, tolerance=0.01, patience=3, min_tiles=64, **kwargs):
+        self.confidence = confidence
+        self.tolerance = tolerance
+        self.patience = patience
+        self.min_tiles = min_tiles
+        self.history = []
+
+    def __call__(self, prob, n_tiles):
+        self.history.append(prob)
+        if n_tiles < self.min_tiles:
+            return None
+        if prob.max() >= self.confidence:
+            return 'confident'
+        if len(self.history) > self.patience:
+            recent = np.stack(self.history[-self.patience - 1:])
+            if np.abs(recent[1:] - recent[:-1]).max() < self.tolerance:
+                return 'stable'
+        return None
+
+
+class SlideExtractor:
+    """Tiles a slide and encodes it with CTransPath, either every tissue tile
+    at `magnification` ('full'), the same tiles with the early stages shared
+    between overlapping tiles ('dense', see DenseCTransPath), or
+    coarse-to-fine ('cascade').
+
+    The cascade encodes the slide at `Cascade.magnification` first, scores each
+    coarse region with the CHIEF attention network, and encodes full
+    magnification tiles only inside the regions picked by `select_regions`.
+    Both modes return (features, coords, stats), where coords are the
+    (x, y, level) of the fine tiles, so the bags load with BagDataset.
+    """
+    def __init__(self, encoder, extraction, cascade=None, chief=None, device=torch.device('cpu'), precision='fp32'):
+        self.encoder = encoder
+        self.extraction = extraction
+        self.cascade = cascade
+        self.chief = chief
+        self.device = device
+        self.precision = precision
+        self.dense_encoder = None
+        self.batch_size, self.num_workers = extraction_options(extraction)
+
+    def spec(self, slide, magnification, stride=None):
+        return TileSpec(slide, magnification, self.extraction.get('tile_size', 224), stride,
+                        self.extraction.get('base_magnification', 40))
+
+    def encode(self, slide, spec, coords):
+        return encode_tiles(self.encoder, slide, spec, coords, self.batch_size, self.num_workers, self.precision,
+                            self.device)
+
+    def tissue(self, slide):
+        mask, mask_downsample = tissue_mask(slide, self.extraction.get('mask_downsample', 64))
+        spec = self.spec(slide, self.extraction.get('magnification', 20), self.extraction.get('stride', None))
+        coords = spec.grid(mask, mask_downsample, self.extraction.get('min_tissue', 0.5))
+        return spec, coords, mask, mask_downsample
+
+    def full(self, slide_path):
+        slide = open_slide(slide_path)
+        start = time.perf_counter()
+        spec, coords, _, _ = self.tissue(slide)
+        if isinstance(self.encoder, PrunedCTransPath):
+            self.encoder.reset_flops()
+        features = self.encode(slide_path, spec, coords)
+        stats = {'n_tiles': len(coords), 'n_coarse': 0, 'n_fine': len(coords), 'n_encoded': len(coords),
+                 'seconds': time.perf_counter() - start}
+        if isinstance(self.encoder, PrunedCTransPath):
+            stats['flops_saved'] = self.encoder.flops_saved()
+        return features, coords, stats
+
+    def dense(self, slide_path):
+        if self.dense_encoder is None:
+            encoder = self.encoder.model if isinstance(self.encoder, PrunedCTransPath) else self.encoder
+            self.dense_encoder = DenseCTransPath(encoder, self.extraction.get('shared_stages', 1),
+                                                 self.extraction.get('tile_size', 224))
+        slide = open_slide(slide_path)
+        start = time.perf_counter()
+        spec, coords, _, _ = self.tissue(slide)
+        features = encode_regions(self.dense_encoder, slide_path, spec, coords, self.extraction.get('region_tiles', 8),
+                                  self.num_workers, self.precision, self.device)
+        stats = {'n_tiles': len(coords), 'n_coarse': 0, 'n_fine': len(coords), 'n_encoded': len(coords),
+                 'seconds': time.perf_counter() - start}
+        return features, coords, stats
+
+    def scores(self, features):
+        """Raw CHIEF attention of each coarse region."""
+        with torch.no_grad():
+            A, _ = self.chief.attention_net(features.to(self.device))
+        return A.squeeze(1).float().cpu().numpy()
+
+    def coarse_to_fine(self, slide_path):
+        if self.chief is None or self.cascade is None:
+            raise ValueError('cascade extraction needs the CHIEF model and a Cascade section')
+        slide = open_slide(slide_path)
+        start = time.perf_counter()
+        spec, coords, mask, mask_downsample = self.tissue(slide)
+        region_spec = self.spec(slide, self.cascade.get('magnification', 5))
+        region_coords = region_spec.grid(mask, mask_downsample, self.cascade.get('min_tissue', 0.1))
+        region_features = self.encode(slide_path, region_spec, region_coords)
+        selected = select_regions(self.scores(region_features), self.cascade.get('top_fraction', 0.1),
+                                  self.cascade.get('coverage_fraction', 0.), self.cascade.get('min_regions', 1))
+        cells = region_of(region_coords[selected], region_spec, region_spec.footprint)
+        n_tiles = len(coords)
+        coords = coords[np.isin(region_of(coords, region_spec, spec.footprint), cells)]
+        features = self.encode(slide_path, spec, coords)
+        stats = {'n_tiles': n_tiles, 'n_coarse': len(region_coords), 'n_fine': len(coords),
+                 'n_encoded': len(region_coords) + len(coords),
+                 'seconds': time.perf_counter() - start}
+        return features, coords, stats
+
+    def __call__(self, slide_path, mode='full'):
+        if mode == 'full':
+            return self.full(slide_path)
+        if mode == 'cascade':
+            return self.coarse_to_fine(slide_path)
+        if mode == 'dense':
+            return self.dense(slide_path)
+        raise NotImplementedError(mode)
+
+    def stream(self, slide_path, x_anatomic, anytime):
+        """Anytime CHIEF prediction: tiles are encoded in `anytime.order`,
+        `check_every` at a time, and pooled online; encoding stops at the first
+        check where EarlyExit holds. Returns (prob, stats)."""
+        if self.chief is None:
+            raise ValueError('streaming inference needs the CHIEF model')
+        slide = open_slide(slide_path)
+        start = time.perf_counter()
+        spec, coords, mask, mask_downsample = self.tissue(slide)
+        coords = coords[tile_order(coords, anytime.get('order', 'random'), mask, mask_downsample, spec.footprint,
+                                   anytime.get('seed', 0))]
+        pool = OnlineAttentionPool(self.chief, x_anatomic.to(self.device))
+        early_exit = EarlyExit(**anytime)
+        temperature = anytime.get('temperature', 1.)
+        loader = build_dataloader(TileDataset(slide_path, spec, coords), batch_size=anytime.get('check_every', 32),
+                                  num_workers=self.num_workers, persistent_workers=False,
+                                  name='tiles')
+        loader.verbose = False
+        prob, reason = None, 'exhausted'
+        with torch.no_grad():
+            for x in loader:
+                with autocast_context(self.precision, self.device):
+                    pool.update(self.encoder(x.to(self.device)).float())
+                prob = torch.softmax(pool.bag_logits().float() / temperature, dim=1)[0].cpu().numpy()
+                stop = early_exit(prob, pool.n)
+                if stop is not None:
+                    reason = stop
+                    break
+        stats = {'n_tiles': len(coords), 'n_used': pool.n, 'checks': len(early_exit.history), 'stop': reason,
+                 'seconds': time.perf_counter() - start}
+        return prob, stats